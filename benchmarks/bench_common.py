@@ -0,0 +1,52 @@
+"""
+Helpers shared by the benchmark scripts: summary of timings, commit id and comparison with a baseline
+"""
+import os
+import statistics
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def summarize(timings):
+    return {
+        "repeat": len(timings),
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+
+
+def get_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+    return commit + ("-dirty" if dirty else "") if commit else None
+
+
+def compare(results, baseline, threshold):
+    """
+    Print the ratio of the median times (current / baseline). Returns the names of the benchmarks slower than the threshold.
+    """
+    regressions = []
+    width = max([len(name) for name in results["benchmarks"]] + [50])
+    print(f"\n{'benchmark':{width}s} {'baseline':>12s} {'current':>12s} {'ratio':>8s}")
+    for name, result in results["benchmarks"].items():
+        base = baseline["benchmarks"].get(name)
+        if "median" not in result or not base or "median" not in base:
+            print(f"{name:{width}s} {'-':>12s} {'-':>12s} {'-':>8s}")
+            continue
+        ratio = result["median"] / base["median"] if base["median"] else float("inf")
+        mark = ""
+        if ratio > 1 + threshold:
+            mark = "  SLOWER"
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            mark = "  faster"
+        print(f"{name:{width}s} {base['median'] * 1000:10.2f}ms {result['median'] * 1000:10.2f}ms {ratio:8.2f}{mark}")
+    if results["params"] != baseline.get("params"):
+        print("\nWarning: the benchmark parameters differ from the baseline.", baseline.get("params"))
+    return regressions
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""
+End-to-end benchmark of the dfast_qc and dqc_multi pipelines
+
+By default, the external tools are replaced with the deterministic fake tools (fake_tools.py) and the reference data
+is generated synthetically (synthetic_reference.py), so that the orchestration and Python cost of the pipeline
+can be measured on a plain Linux machine. Wall time of each stage, startup time and pipeline overhead
+(wall time not spent in external commands) are written as JSON, and can be compared with a baseline.
+
+    python benchmarks/e2e_bench.py -o e2e_base.json
+    python benchmarks/e2e_bench.py -o e2e_new.json --compare e2e_base.json
+    python benchmarks/e2e_bench.py --delay mash=0.5 --delay checkm=5 --busy   # simulate slow tools
+    python benchmarks/e2e_bench.py --real_tools --ref_dir /path/to/dqc_reference --inputs examples
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import platform
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dqc.config import config
+import fake_tools
+import synthetic_reference
+from bench_common import REPO_DIR, summarize, get_commit, compare
+
+
+def prepare_inputs(work_dir, inputs, num_synthetic, genome_size, seed):
+    """
+    Returns a dict of {label: fasta file}. Synthetic genomes include one Shigella genome to cover ShigaPass.
+    """
+    input_files = {}
+    if "examples" in inputs:
+        for fasta in sorted(glob.glob(os.path.join(REPO_DIR, "examples", "*.fna.gz"))):
+            input_files[os.path.basename(fasta).replace(".fna.gz", "")] = fasta
+    if "synthetic" in inputs:
+        input_dir = os.path.join(work_dir, "synthetic_inputs")
+        os.makedirs(input_dir, exist_ok=True)
+        for i in range(num_synthetic):
+            label = "synthetic_shigella_flexneri" if i == 0 else f"synthetic_{i}"
+            fasta = os.path.join(input_dir, f"{label}.fna.gz")
+            synthetic_reference.write_fasta(fasta, genome_size=genome_size, seed=seed + i)
+            input_files[label] = fasta
+    return input_files
+
+
+def get_env(bin_dir, profile_file):
+    env = dict(os.environ)
+    paths = [REPO_DIR] + ([bin_dir] if bin_dir else [])
+    env["PATH"] = os.pathsep.join(paths + [env.get("PATH", "")])
+    if profile_file:
+        env[fake_tools.PROFILE_ENV] = profile_file
+    return env
+
+
+def run(cmd, env, log_file):
+    t0 = time.perf_counter()
+    with open(log_file, "w") as f:
+        p = subprocess.run(cmd, env=env, stdout=f, stderr=subprocess.STDOUT)
+    wall = time.perf_counter() - t0
+    if p.returncode != 0:
+        sys.stderr.write(f"Failed: {' '.join(cmd)}\n" + "".join(open(log_file).readlines()[-20:]))
+        sys.exit(1)
+    return wall
+
+
+def run_dfast_qc(fasta, out_dir, ref_dir, env, enable_gtdb):
+    """
+    Returns a dict of timings (sec) and the result of a dfast_qc run
+    """
+    cmd = [sys.executable, os.path.join(REPO_DIR, "dfast_qc"), "-i", fasta, "-o", out_dir, "--ref_dir", ref_dir,
+           "--force", "--disable_auto_download"]
+    if enable_gtdb:
+        cmd.append("--enable_gtdb")
+    os.makedirs(out_dir, exist_ok=True)
+    wall = run(cmd, env, os.path.join(out_dir, "bench_stdout.log"))
+    dqc_result = json.load(open(os.path.join(out_dir, config.DQC_RESULT_JSON)))
+    metrics = dqc_result["metrics"]
+    command_time = sum(command["wall_time"] for command in metrics["commands"])
+    timings = {
+        "wall": wall,
+        "startup": wall - metrics["total"]["wall_time"],  # interpreter start, imports and argument parsing
+        "overhead": wall - command_time,  # wall time not spent in external commands
+        "cpu": metrics["total"]["cpu_time"],
+    }
+    for stage in metrics["stages"]:
+        timings[f"stage.{stage['name']}"] = stage["wall_time"]
+    tc_status = dqc_result["tc_result"][0]["status"] if dqc_result["tc_result"] else None
+    return timings, {"tc_status": tc_status, "shigapass": bool(dqc_result["shigapass_result"])}
+
+
+def run_dqc_multi(input_files, work_dir, ref_dir, env, threads, enable_gtdb, n):
+    input_dir = os.path.join(work_dir, "multi_input")
+    if not os.path.exists(input_dir):
+        os.makedirs(input_dir)
+        for label, fasta in input_files.items():
+            os.symlink(fasta, os.path.join(input_dir, f"{label}.fna.gz"))
+    out_dir = os.path.join(work_dir, "runs", "dqc_multi", str(n))
+    os.makedirs(out_dir, exist_ok=True)
+    cmd = [sys.executable, os.path.join(REPO_DIR, "dqc_multi"), input_dir, "--out_dir", out_dir,
+           "--output", os.path.join(out_dir, "dqc_report.tsv"), "--thread", str(threads), "--ref_dir", ref_dir]
+    if enable_gtdb:
+        cmd.append("--enable_gtdb")
+    wall = run(cmd, env, os.path.join(out_dir, "bench_stdout.log"))
+    return {"wall": wall, "per_genome": wall / len(input_files)}
+
+
+def parse_delays(delays):
+    D = {}
+    for delay in delays:
+        tool, _, seconds = delay.partition("=")
+        if tool not in fake_tools.TOOLS:
+            sys.stderr.write(f"Unknown tool in --delay: {tool}. Choose from {fake_tools.TOOLS}\n")
+            sys.exit(1)
+        D[tool] = float(seconds)
+    return D
+
+
+def parse_args():
+    parser = ArgumentParser(description="End-to-end benchmark of dfast_qc and dqc_multi with fake external tools")
+    parser.add_argument("-o", "--output", type=str, default="e2e_bench.json", help="Output JSON file (default: e2e_bench.json)", metavar="PATH")
+    parser.add_argument("--compare", type=str, default=None, help="Baseline JSON file to compare with", metavar="PATH")
+    parser.add_argument("--threshold", type=float, default=0.20, help="Ratio of slowdown reported as a regression (default: 0.20)", metavar="FLOAT")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of runs per input (default: 3)", metavar="INT")
+    parser.add_argument("--inputs", type=str, default="examples,synthetic", help="Query genomes: examples, synthetic or both (default: examples,synthetic)", metavar="STR")
+    parser.add_argument("--num_synthetic", type=int, default=3, help="Number of synthetic query genomes (default: 3)", metavar="INT")
+    parser.add_argument("--genome_size", type=int, default=3000000, help="Size of the synthetic query genomes (default: 3000000)", metavar="INT")
+    parser.add_argument("--num_genomes", type=int, default=1000, help="Number of synthetic reference genomes (default: 1000)", metavar="INT")
+    parser.add_argument("--delay", type=str, action="append", default=[], help="Time taken by a fake tool, e.g. --delay checkm=5 (repeatable)", metavar="TOOL=SEC")
+    parser.add_argument("--busy", action="store_true", help="Fake tools consume CPU during the delay instead of sleeping")
+    parser.add_argument("--enable_gtdb", action="store_true", help="Include GTDB search")
+    parser.add_argument("--multi_threads", type=int, default=2, help="Number of parallel jobs of dqc_multi (default: 2). 0 to skip dqc_multi", metavar="INT")
+    parser.add_argument("--real_tools", action="store_true", help="Use the external tools in PATH instead of the fake tools (requires --ref_dir)")
+    parser.add_argument("--ref_dir", type=str, default=None, help="Reference directory (default: synthetic reference data)", metavar="PATH")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic data (default: 0)", metavar="INT")
+    parser.add_argument("--work_dir", type=str, default=None, help="Working directory (default: a temporary directory, removed afterwards)", metavar="PATH")
+    args = parser.parse_args()
+    if args.real_tools and not args.ref_dir:
+        parser.error("--ref_dir is required with --real_tools")
+    return args
+
+
+def main():
+    args = parse_args()
+    config.LOG_FILE = None
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="dqc_e2e_bench_"))
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        if args.ref_dir:
+            ref_dir = os.path.abspath(args.ref_dir)
+        else:
+            ref_dir = os.path.join(work_dir, "dqc_reference")
+            print(f"Preparing synthetic reference data in {ref_dir}", file=sys.stderr)
+            synthetic_reference.build_pipeline_reference(ref_dir, num_genomes=args.num_genomes, seed=args.seed)
+        if args.real_tools:
+            bin_dir, profile_file = None, None
+        else:
+            bin_dir = os.path.join(work_dir, "bin")
+            fake_tools.install(bin_dir, reference_dir=ref_dir)
+            profile_file = os.path.join(work_dir, "fake_tools_profile.json")
+            with open(profile_file, "w") as f:
+                json.dump({"reference_dir": ref_dir, "delays": parse_delays(args.delay), "busy": args.busy}, f, indent=2)
+        env = get_env(bin_dir, profile_file)
+        input_files = prepare_inputs(work_dir, args.inputs.split(","), args.num_synthetic, args.genome_size, args.seed)
+
+        results = {
+            "commit": get_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {"inputs": sorted(input_files), "genome_size": args.genome_size, "num_genomes": args.num_genomes,
+                       "delays": parse_delays(args.delay), "busy": args.busy, "enable_gtdb": args.enable_gtdb,
+                       "multi_threads": args.multi_threads, "real_tools": args.real_tools},
+            "benchmarks": {},
+            "outputs": {},
+        }
+        for label, fasta in input_files.items():
+            timings = {}
+            for n in range(args.repeat):
+                out_dir = os.path.join(work_dir, "runs", label, str(n))
+                run_timings, output = run_dfast_qc(fasta, out_dir, ref_dir, env, args.enable_gtdb)
+                for key, value in run_timings.items():
+                    timings.setdefault(key, []).append(value)
+            results["outputs"][label] = output
+            for key, values in timings.items():
+                results["benchmarks"][f"dfast_qc[{label}].{key}"] = summarize(values)
+            print(f"dfast_qc [{label}] wall {summarize(timings['wall'])['median']:.2f}s, "
+                  f"overhead {summarize(timings['overhead'])['median']:.2f}s, result: {output}", file=sys.stderr)
+        if args.multi_threads > 0:
+            timings = {}
+            for n in range(args.repeat):
+                for key, value in run_dqc_multi(input_files, work_dir, ref_dir, env, args.multi_threads, args.enable_gtdb, n).items():
+                    timings.setdefault(key, []).append(value)
+            for key, values in timings.items():
+                results["benchmarks"][f"dqc_multi.{key}"] = summarize(values)
+            print(f"dqc_multi ({len(input_files)} genomes, {args.multi_threads} threads) wall {summarize(timings['wall'])['median']:.2f}s", file=sys.stderr)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results were written to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        baseline = json.load(open(args.compare))
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+Deterministic stand-ins for mash, skani, checkm, blastn and ShigaPass.sh used by e2e_bench.py
+
+Installed as symlinks named after each tool (see install()), and dispatched by the name of the program.
+They accept the arguments DFAST_QC passes, take a configurable time and write outputs in the format of the real tools.
+The behaviour is configured by the JSON file in the DQC_FAKE_TOOLS_PROFILE environment variable:
+
+    {
+        "reference_dir": "/path/to/synthetic/dqc_reference",  # built by synthetic_reference.build_pipeline_reference
+        "delays": {"mash": 0.5, "skani": 1.0, "checkm": 10, "shigapass": 1.0},  # seconds per invocation
+        "busy": false,  # consume CPU during the delay instead of sleeping
+        "completeness": 98.5, "contamination": 1.2, "strain_heterogeneity": 0.0,
+        "serotype": "SF1-5"
+    }
+
+Hits are decided by the query file name. If it contains a species name of the reference (e.g. shigella_flexneri.fna),
+the query is assigned to that species. Otherwise a species is chosen by a hash of the file name.
+"""
+import os
+import sys
+import json
+import time
+import zlib
+import contextlib
+import sqlite3
+
+PROFILE_ENV = "DQC_FAKE_TOOLS_PROFILE"
+TOOLS = ["mash", "skani", "checkm", "blastn", "shigapass"]
+
+DEFAULT_PROFILE = {
+    "reference_dir": None,
+    "delays": {},
+    "busy": False,
+    "completeness": 98.5,
+    "contamination": 1.2,
+    "strain_heterogeneity": 0.0,
+    "serotype": "SF1-5",
+}
+
+
+def load_profile():
+    profile = dict(DEFAULT_PROFILE)
+    profile_file = os.environ.get(PROFILE_ENV)
+    if profile_file:
+        profile.update(json.load(open(profile_file)))
+    return profile
+
+
+def spend(profile, tool):
+    delay = float(profile["delays"].get(tool, 0))
+    if delay <= 0:
+        return
+    if profile["busy"]:
+        end = time.perf_counter() + delay
+        while time.perf_counter() < end:
+            pass
+    else:
+        time.sleep(delay)
+
+
+def _hash(*keys):
+    return zlib.crc32(":".join(keys).encode())
+
+
+def _slug(name):
+    return name.lower().replace("s__", "").replace(" ", "_")
+
+
+def get_accession(genome_file):
+    return os.path.basename(genome_file).replace("_genomic.fna.gz", "").replace(".fna.gz", "")
+
+
+class ReferenceIndex:
+    """
+    Species and indistinguishable groups of the synthetic reference genomes
+    """
+    def __init__(self, reference_dir):
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+        from dqc.config import config
+        self.species = {}  # accession: species name
+        db = sqlite3.connect(os.path.join(reference_dir, config.SQLITE_REFERENCE_DB))
+        for accession, species_name in db.execute("SELECT accession, species_name FROM reference"):
+            self.species[accession] = species_name
+        for accession, gtdb_species in db.execute("SELECT accession, gtdb_species FROM gtdb_reference"):
+            self.species[accession] = gtdb_species.replace("s__", "")
+        db.close()
+        self.groups = {}  # species name: group_id
+        for line in open(os.path.join(reference_dir, config.INDISTINGUISHABLE_GROUPS_PROKARYOTE)):
+            if line.startswith("#") or not line.strip():
+                continue
+            group_id, _, name = line.strip("\n").split("\t")
+            self.groups[name] = group_id
+
+    def target_species(self, query_file, genome_files):
+        """
+        Species to which the query belongs, among the species of the genome files
+        """
+        query_name = os.path.basename(query_file).lower()
+        candidates = sorted(set(self.species.get(get_accession(genome_file), "") for genome_file in genome_files))
+        for species in candidates:
+            if species and _slug(species) in query_name:
+                return species
+        return min(candidates, key=lambda species: _hash(query_name, species))
+
+    def is_close(self, species, target):
+        return species == target or (species in self.groups and self.groups[species] == self.groups.get(target))
+
+
+def read_lines(file_name):
+    return [line.strip() for line in open(file_name) if line.strip() and not line.startswith("#")]
+
+
+def get_option(args, *names, default=None):
+    for name in names:
+        if name in args:
+            return args[args.index(name) + 1]
+    return default
+
+
+def fake_mash(args, profile):
+    # mash dist <sketch> <query> -p <threads>
+    if not args or args[0] != "dist":
+        sys.stderr.write(f"fake mash: unsupported arguments {args}\n")
+        return 1
+    sketch_file, query_file = args[1], args[2]
+    genome_files = read_lines(sketch_file)
+    index = ReferenceIndex(profile["reference_dir"])
+    target = index.target_species(query_file, genome_files)
+    spend(profile, "mash")
+    out = sys.stdout
+    for genome_file in genome_files:
+        h = _hash(query_file, genome_file)
+        if index.is_close(index.species.get(get_accession(genome_file)), target):
+            # species of the same indistinguishable group are as close as the target
+            distance = 0.001 + (h % 100) / 10000
+        else:
+            distance = 0.05 + (h % 1000) / 10000
+        shared = max(1000 - int(distance * 10000), 0)
+        out.write(f"{genome_file}\t{query_file}\t{distance:.6f}\t0\t{shared}/1000\n")
+    return 0
+
+
+def fake_skani(args, profile):
+    # skani sketch -l <list> -o <db> -t <threads>
+    # skani search <query> -d <db> [-o <out>] -t <threads>  (standard output if -o is not given)
+    if args and args[0] == "sketch":
+        list_file, db_dir = get_option(args, "-l"), get_option(args, "-o")
+        os.makedirs(db_dir, exist_ok=True)
+        spend(profile, "skani")
+        with open(os.path.join(db_dir, "reference_list.txt"), "w") as f:
+            f.write("\n".join(read_lines(list_file)) + "\n")
+        return 0
+    if args and args[0] == "search":
+        query_file, db_dir, out_file = args[1], get_option(args, "-d"), get_option(args, "-o")
+        genome_files = read_lines(os.path.join(db_dir, "reference_list.txt"))
+        index = ReferenceIndex(profile["reference_dir"])
+        target = index.target_species(query_file, genome_files)
+        spend(profile, "skani")
+        hits = []
+        for genome_file in genome_files:
+            h = _hash(query_file, genome_file)
+            species = index.species.get(get_accession(genome_file))
+            if species == target:
+                ani = 99.0 + (h % 90) / 100
+            elif index.is_close(species, target):
+                ani = 97.0 + (h % 150) / 100
+            else:
+                ani = 80.0 + (h % 800) / 100
+            hits.append((ani, genome_file))
+        with (open(out_file, "w") if out_file else contextlib.nullcontext(sys.stdout)) as f:
+            f.write("Ref_file\tQuery_file\tANI\tAlign_fraction_ref\tAlign_fraction_query\tRef_name\tQuery_name\n")
+            for ani, genome_file in sorted(hits, reverse=True):
+                f.write(f"{genome_file}\t{query_file}\t{ani:.2f}\t{ani - 5:.2f}\t{ani - 6:.2f}\t{get_accession(genome_file)}\tquery\n")
+        return 0
+    sys.stderr.write(f"fake skani: unsupported arguments {args}\n")
+    return 1
+
+
+def fake_checkm(args, profile):
+    # checkm taxonomy_wf --tab_table -f <result> -t <threads> <rank> <taxon> <input_dir> <result_dir>
+    result_file, result_dir = get_option(args, "-f"), args[-1]
+    spend(profile, "checkm")
+    os.makedirs(result_dir, exist_ok=True)
+    with open(os.path.join(result_dir, "checkm.log"), "w") as f:
+        f.write(f"fake checkm {' '.join(args)}\n")
+    header = ["Bin Id", "Marker lineage", "# genomes", "# markers", "# marker sets", "0", "1", "2", "3", "4", "5+",
+              "Completeness", "Contamination", "Strain heterogeneity"]
+    row = ["query", f"{args[-4]} ({args[-3]})", "100", "300", "150", "2", "296", "2", "0", "0", "0",
+           str(profile["completeness"]), str(profile["contamination"]), str(profile["strain_heterogeneity"])]
+    with open(result_file, "w") as f:
+        f.write("\t".join(header) + "\n" + "\t".join(row) + "\n")
+    return 0
+
+
+def fake_blastn(args, profile):
+    spend(profile, "blastn")
+    return 0
+
+
+def fake_shigapass(args, profile):
+    # ShigaPass.sh -l <input_list> -o <out_dir> -p <db_dir> -t <threads>
+    input_list, out_dir = get_option(args, "-l"), get_option(args, "-o")
+    os.makedirs(out_dir, exist_ok=True)
+    spend(profile, "shigapass")
+    serotype = profile["serotype"]
+    with open(os.path.join(out_dir, "ShigaPass_summary.csv"), "w") as f:
+        f.write("Name;rfb;rfb_hits,(%);MLST;fliC;CRISPR;ipaH;Predicted_Serotype;Predicted_FlexSerotype;Comments\n")
+        for fasta in read_lines(input_list):
+            name = os.path.basename(fasta)
+            f.write(f"{name};A1;88.1;ST245;fliC-;SF1-5;ipaH+;{serotype};;\n")
+    return 0
+
+
+def install(bin_dir, reference_dir=None):
+    """
+    Create symlinks to this script named mash, skani, checkm and blastn in bin_dir. If reference_dir is given,
+    a wrapper script is installed as the ShigaPass script of the reference directory.
+    """
+    script = os.path.realpath(__file__)
+    os.makedirs(bin_dir, exist_ok=True)
+    for tool in ["mash", "skani", "checkm", "blastn"]:
+        link = os.path.join(bin_dir, tool)
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(script, link)
+    if reference_dir:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(script)))
+        from dqc.config import config
+        shigapass_script = os.path.join(reference_dir, config.SHIGAPASS_SCRIPT)
+        os.makedirs(os.path.dirname(shigapass_script), exist_ok=True)
+        os.makedirs(os.path.join(reference_dir, config.SHIGAPASS_DB_DIR), exist_ok=True)
+        with open(shigapass_script, "w") as f:
+            f.write(f'#!/bin/bash\nexec "{sys.executable}" "{script}" shigapass "$@"\n')
+
+
+def main():
+    tool = os.path.basename(sys.argv[0])
+    args = sys.argv[1:]
+    if tool not in TOOLS:
+        # called as 'fake_tools.py <tool> args...'
+        if not args or args[0] not in TOOLS:
+            sys.stderr.write(f"Usage: fake_tools.py {{{','.join(TOOLS)}}} [args...]\n")
+            return 1
+        tool, args = args[0], args[1:]
+    profile = load_profile()
+    return globals()[f"fake_{tool}"](args, profile)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+"""
+Microbenchmarks for the Python hot paths of DFAST_QC
+
+Runs offline on synthetic reference data (see synthetic_reference.py) and writes the results as JSON,
+which can be compared with the results of another commit.
+
+    python benchmarks/microbench.py -o bench_new.json
+    python benchmarks/microbench.py -o bench_new.json --compare bench_base.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import logging
+import platform
+import tempfile
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from dqc.config import config
+import synthetic_reference
+from bench_common import summarize, get_commit, compare
+
+BENCHMARKS = []
+
+
+def benchmark(group):
+    """
+    Register a benchmark. The decorated function receives the benchmark context and returns a callable to be timed
+    (or a pair of (setup, callable) if files need to be prepared before each call).
+    """
+    def _register(func):
+        BENCHMARKS.append((f"{group}.{func.__name__}", func))
+        return func
+    return _register
+
+
+class Context:
+    def __init__(self, work_dir, num_genomes, genome_size, seed):
+        self.work_dir = work_dir
+        self.ref_dir = os.path.join(work_dir, "dqc_reference")
+        self.num_genomes = num_genomes
+        self.rng = random.Random(seed)
+        self.taxonomy = synthetic_reference.build_reference(self.ref_dir, num_genomes=num_genomes, seed=seed)
+        self.species_taxids = list(self.taxonomy.species)
+        self.fasta = synthetic_reference.write_fasta(os.path.join(work_dir, "genome.fna"), genome_size=genome_size, seed=seed)
+        self.fasta_gz = synthetic_reference.write_fasta(os.path.join(work_dir, "genome.fna.gz"), genome_size=genome_size, seed=seed)
+
+    def ref_path(self, file_name):
+        return os.path.join(self.ref_dir, file_name)
+
+    def random_accessions(self, n):
+        return [f"GCA_{900000000 + self.rng.randrange(self.num_genomes):09d}.1" for _ in range(n)]
+
+
+# --- parsers ---
+@benchmark("parsers")
+def assembly_parse(ctx):
+    from dqc.admin.asm_report_parser import Assembly
+    asm_report_file = ctx.ref_path(config.ASSEMBLY_REPORT_FILE)
+    return lambda: sum(1 for _ in Assembly.parse(asm_report_file))
+
+
+@benchmark("parsers")
+def get_filtered_ANI_report(ctx):
+    from dqc.admin.ani_report_parser import get_filtered_ANI_report
+    ani_report_file = ctx.ref_path(config.ANI_REPORT_FILE)
+    return lambda: get_filtered_ANI_report(ani_report_file)
+
+
+@benchmark("parsers")
+def fasta_reader(ctx):
+    from dqc.common import fasta_reader
+    return lambda: fasta_reader(ctx.fasta)
+
+
+@benchmark("parsers")
+def get_genome_size(ctx):
+    from dqc.genome_size_check import get_genome_size
+    return lambda: get_genome_size(ctx.fasta)
+
+
+@benchmark("parsers")
+def get_genome_size_gz(ctx):
+    from dqc.genome_size_check import get_genome_size
+    return lambda: get_genome_size(ctx.fasta_gz)
+
+
+# --- classification ---
+@benchmark("classify")
+def get_indistinguishable_group(ctx):
+    from dqc.classify_tc_hits import get_indistinguishable_group
+    taxids = [ctx.rng.choice(ctx.species_taxids) for _ in range(1000)]
+    return lambda: [get_indistinguishable_group(taxid) for taxid in taxids]
+
+
+def _make_tc_results(ctx, num_results, num_hits):
+    tc_results = []
+    for _ in range(num_results):
+        hits = []
+        for _ in range(num_hits):
+            hits.append({"species_taxid": ctx.rng.choice(ctx.species_taxids), "ani": ctx.rng.uniform(80, 100),
+                         "ani_threshold": 95.0, "status": ""})
+        tc_results.append(hits)
+    return tc_results
+
+
+@benchmark("classify")
+def classify_tc_hits(ctx):
+    from dqc.classify_tc_hits import classify_tc_hits
+    tc_results = _make_tc_results(ctx, 200, 10)
+    return lambda: [classify_tc_hits(hits) for hits in tc_results]
+
+
+# --- reference lookups ---
+@benchmark("calc_ani")
+def reference_get_or_none(ctx):
+    from dqc.models import Reference
+    accessions = ctx.random_accessions(1000)
+    return lambda: [Reference.get_or_none(Reference.accession == accession) for accession in accessions]
+
+
+@benchmark("calc_ani")
+def add_organism_info_to_skani_result(ctx):
+    """
+    Parsing skani result, reference lookups and classification of the hits
+    """
+    from dqc.calc_ani import add_organism_info_to_skani_result, parse_skani_result
+    output_file = os.path.join(ctx.work_dir, "tc_result.tsv")
+    lines = ["Ref_file\tQuery_file\tANI\tAlign_fraction_ref\tAlign_fraction_query\tRef_name\tQuery_name\n"]
+    for accession in ctx.random_accessions(50):
+        ani = ctx.rng.uniform(80, 100)
+        lines.append(f"{ctx.ref_dir}/genomes/{accession}.fna.gz\tgenome.fna\t{ani:.2f}\t85.1\t86.2\t{accession}\tquery\n")
+    return lambda: add_organism_info_to_skani_result(parse_skani_result(lines), output_file)
+
+
+# --- ete3 lineage functions ---
+@benchmark("ete3_helper")
+def is_prokaryote(ctx):
+    from dqc.ete3_helper import is_prokaryote
+    taxids = [ctx.rng.choice(ctx.species_taxids) for _ in range(1000)]
+    return lambda: [is_prokaryote(taxid) for taxid in taxids]
+
+
+@benchmark("ete3_helper")
+def get_valid_name(ctx):
+    from dqc.ete3_helper import get_valid_name
+    taxids = [ctx.rng.choice(ctx.species_taxids) for _ in range(1000)]
+    return lambda: [get_valid_name(taxid) for taxid in taxids]
+
+
+@benchmark("ete3_helper")
+def get_taxid(ctx):
+    from dqc.ete3_helper import get_taxid
+    names = [ctx.taxonomy.species[ctx.rng.choice(ctx.species_taxids)][0] for _ in range(200)]
+    return lambda: [get_taxid(name, "species") for name in names]
+
+
+def run_benchmark(name, func, ctx, repeat):
+    try:
+        prepared = func(ctx)
+    except (ImportError, SystemExit) as e:
+        # e.g. an optional module is not installed. Reported as skipped rather than aborting the whole suite.
+        return {"skipped": f"{type(e).__name__}: {e}"}
+    setup, target = prepared if isinstance(prepared, tuple) else (None, prepared)
+    timings = []
+    for _ in range(repeat + 1):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        target()
+        timings.append(time.perf_counter() - t0)
+    return summarize(timings[1:])  # the first call is a warm-up (imports, page cache, sqlite connection)
+
+
+def parse_args():
+    parser = ArgumentParser(description="Microbenchmarks for DFAST_QC using synthetic reference data")
+    parser.add_argument("-o", "--output", type=str, default="microbench.json", help="Output JSON file (default: microbench.json)", metavar="PATH")
+    parser.add_argument("--compare", type=str, default=None, help="Baseline JSON file to compare with", metavar="PATH")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Ratio of slowdown reported as a regression (default: 0.10)", metavar="FLOAT")
+    parser.add_argument("-k", "--filter", type=str, default=None, help="Run only the benchmarks whose names contain this string", metavar="STR")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Number of measurements per benchmark (default: 5)", metavar="INT")
+    parser.add_argument("--num_genomes", type=int, default=20000, help="Number of synthetic reference genomes (default: 20000)", metavar="INT")
+    parser.add_argument("--genome_size", type=int, default=5000000, help="Size of the synthetic query genome (default: 5000000)", metavar="INT")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic data (default: 0)", metavar="INT")
+    parser.add_argument("--work_dir", type=str, default=None, help="Directory for the synthetic data (default: a temporary directory)", metavar="PATH")
+    parser.add_argument("--verbose", action="store_true", help="Show log messages of DFAST_QC")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config.LOG_FILE = None
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="dqc_microbench_")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        print(f"Preparing synthetic data in {work_dir}", file=sys.stderr)
+        ctx = Context(work_dir, args.num_genomes, args.genome_size, args.seed)
+        if not args.verbose:
+            logging.disable(logging.WARNING)
+        results = {
+            "commit": get_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "params": {"num_genomes": args.num_genomes, "genome_size": args.genome_size, "seed": args.seed},
+            "benchmarks": {},
+        }
+        for name, func in BENCHMARKS:
+            if args.filter and args.filter not in name:
+                continue
+            result = run_benchmark(name, func, ctx, args.repeat)
+            results["benchmarks"][name] = result
+            if "skipped" in result:
+                print(f"{name:50s} skipped ({result['skipped']})", file=sys.stderr)
+            else:
+                print(f"{name:50s} {result['median'] * 1000:10.2f}ms (min {result['min'] * 1000:.2f}ms)", file=sys.stderr)
+        logging.disable(logging.NOTSET)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results were written to {args.output}", file=sys.stderr)
+
+    if args.compare:
+        baseline = json.load(open(args.compare))
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}", file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
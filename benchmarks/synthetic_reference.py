@@ -0,0 +1,328 @@
+"""
+Synthetic reference data for the benchmarks
+
+Generates files that have the same format as the DFAST_QC reference data (and the NCBI master files they are
+built from), so that the benchmarks can be run offline without downloading the real reference data.
+The contents are random but deterministic for the same seed and size.
+
+    ref_dir = build_reference(ref_dir, num_genomes=20000)
+"""
+import os
+import gzip
+import json
+import random
+import sqlite3
+
+from dqc.config import config
+
+BACTERIA, ARCHAEA = 2, 2157
+FIRST_SPECIES_TAXID = 1000000
+FIRST_STRAIN_TAXID = 5000000
+NUM_GENERA = 200
+
+ANI_REPORT_HEADER = [
+    "# genbank-accession", "refseq-accession", "taxid", "species-taxid", "organism-name", "species-name",
+    "assembly-name", "assembly-type-category", "excluded-from-refseq", "declared-type-assembly",
+    "declared-type-organism-name", "declared-type-category", "declared-type-ANI", "declared-type-qcoverage",
+    "declared-type-scoverage", "best-match-type-assembly", "best-match-species-taxid", "best-match-species-name",
+    "best-match-type-category", "best-match-type-ANI", "best-match-type-qcoverage", "best-match-type-scoverage",
+    "best-match-status", "comment", "taxonomy-check-status"
+]
+
+ASSEMBLY_REPORT_HEADER = [
+    "#assembly_accession", "bioproject", "biosample", "wgs_master", "refseq_category", "taxid", "species_taxid",
+    "organism_name", "infraspecific_name", "isolate", "version_status", "assembly_level", "release_type",
+    "genome_rep", "seq_rel_date", "asm_name", "submitter", "gbrs_paired_asm", "paired_asm_comp", "ftp_path",
+    "excluded_from_refseq", "relation_to_type_material", "asm_not_live_date"
+]
+
+
+# E. coli and Shigella are included as an indistinguishable group to cover ShigaPass (real taxids)
+SHIGAPASS_GENERA = {561: "Escherichia", 620: "Shigella"}
+SHIGAPASS_SPECIES = {562: ("Escherichia coli", 561), 623: ("Shigella flexneri", 620)}
+
+
+class SyntheticTaxonomy:
+    """
+    Two domains > NUM_GENERA genera > species > strains. Species taxids are consecutive from FIRST_SPECIES_TAXID,
+    in addition to SHIGAPASS_SPECIES.
+    """
+    def __init__(self, num_species, seed=0):
+        rng = random.Random(seed)
+        self.genera = {taxid: (name, BACTERIA) for taxid, name in SHIGAPASS_GENERA.items()}  # taxid: (name, domain)
+        self.species = dict(SHIGAPASS_SPECIES)  # taxid: (name, genus_taxid)
+        for i in range(NUM_GENERA):
+            domain = ARCHAEA if i % 10 == 0 else BACTERIA
+            self.genera[100000 + i] = (f"Genus{i:04d}", domain)
+        genus_taxids = list(self.genera)
+        for i in range(num_species):
+            genus_taxid = rng.choice(genus_taxids)
+            genus_name = self.genera[genus_taxid][0]
+            self.species[FIRST_SPECIES_TAXID + i] = (f"{genus_name} species{i:05d}", genus_taxid)
+
+    def lineage(self, species_taxid):
+        genus_taxid = self.species[species_taxid][1]
+        domain = self.genera[genus_taxid][1]
+        return [1, 131567, domain, genus_taxid, species_taxid]
+
+
+def _accession(i):
+    return f"GCA_{900000000 + i:09d}.1"
+
+
+def _random_seq(rng, length):
+    return "".join(rng.choices("ACGT", k=length))
+
+
+def write_fasta(out_file, genome_size=5000000, num_contigs=100, seed=0, line_width=80):
+    """
+    Random genome FASTA. Compressed if out_file ends with .gz
+    """
+    rng = random.Random(seed)
+    contig_size = genome_size // num_contigs
+    opener = gzip.open if out_file.endswith(".gz") else open
+    with opener(out_file, "wt") as f:
+        for i in range(num_contigs):
+            seq = _random_seq(rng, contig_size)
+            # a run of Ns as an assembly gap
+            seq = seq[:contig_size // 2] + "N" * 100 + seq[contig_size // 2 + 100:]
+            f.write(f">contig{i + 1} synthetic sequence\n")
+            for pos in range(0, len(seq), line_width):
+                f.write(seq[pos:pos + line_width] + "\n")
+    return out_file
+
+
+def write_ani_report(out_file, taxonomy, num_genomes, seed=0):
+    rng = random.Random(seed)
+    species_taxids = list(taxonomy.species)
+    with open(out_file, "w") as f:
+        f.write("\t".join(ANI_REPORT_HEADER) + "\n")
+        for i in range(num_genomes):
+            species_taxid = rng.choice(species_taxids)
+            species_name = taxonomy.species[species_taxid][0]
+            type_category = rng.choice(["type", "type", "syntype", "na", "na", "na"])
+            status = rng.choice(["OK", "OK", "OK", "Inconclusive", "Failed"])
+            excluded = "na" if rng.random() < 0.9 else "derived from metagenome"
+            ani = f"{rng.uniform(95, 100):.2f}"
+            cols = [
+                _accession(i), _accession(i).replace("GCA", "GCF"), str(FIRST_STRAIN_TAXID + i), str(species_taxid),
+                f"{species_name} strain{i}", species_name, f"ASM{i}v1", type_category, excluded,
+                _accession(rng.randrange(num_genomes)), species_name, "type", ani, "90.1", "91.2",
+                _accession(rng.randrange(num_genomes)), str(species_taxid), species_name, "type", ani, "90.1", "91.2",
+                "match", "na", status
+            ]
+            f.write("\t".join(cols) + "\n")
+
+
+def write_assembly_report(out_file, taxonomy, num_genomes, seed=0):
+    rng = random.Random(seed)
+    species_taxids = list(taxonomy.species)
+    with open(out_file, "w") as f:
+        f.write("#   See ftp://ftp.ncbi.nlm.nih.gov/genomes/README_assembly_summary.txt for a description of the columns in this file.\n")
+        f.write("\t".join(ASSEMBLY_REPORT_HEADER) + "\n")
+        for i in range(num_genomes):
+            species_taxid = rng.choice(species_taxids)
+            species_name = taxonomy.species[species_taxid][0]
+            accession = _accession(i)
+            ftp_path = f"https://ftp.ncbi.nlm.nih.gov/genomes/all/GCA/{accession[4:7]}/{accession[7:10]}/{accession[10:13]}/{accession}_ASM{i}v1"
+            cols = [
+                accession, f"PRJNA{i}", f"SAMN{i:08d}", "na", "na", str(FIRST_STRAIN_TAXID + i), str(species_taxid),
+                species_name, f"strain=strain{i}", "na", "latest", rng.choice(["Complete Genome", "Contig", "Scaffold"]),
+                "Major", "Full", "2020/01/01", f"ASM{i}v1", "Synthetic", "na", "na", ftp_path, "na",
+                rng.choice(["assembly from type material", "na", "na"]), "na"
+            ]
+            f.write("\t".join(cols) + "\n")
+
+
+def write_indistinguishable_groups(out_file, taxonomy, num_groups, seed=0):
+    """
+    Groups of 2-5 species that are indistinguishable with ANI
+    """
+    rng = random.Random(seed)
+    species_taxids = [taxid for taxid in taxonomy.species if taxid not in SHIGAPASS_SPECIES]
+    rng.shuffle(species_taxids)
+    with open(out_file, "w") as f:
+        f.write("#group_id\ttaxid\tname\n")
+        for taxid, (name, _) in SHIGAPASS_SPECIES.items():
+            f.write(f"1\t{taxid}\t{name}\n")
+        for group_id in range(2, num_groups + 1):
+            for _ in range(rng.randint(2, 5)):
+                if not species_taxids:
+                    return
+                taxid = species_taxids.pop()
+                f.write(f"{group_id}\t{taxid}\t{taxonomy.species[taxid][0]}\n")
+
+
+def write_species_specific_threshold(out_file, taxonomy, seed=0):
+    rng = random.Random(seed)
+    with open(out_file, "w") as f:
+        f.write("#species_taxid\tspecies_name\tani_threshold\n")
+        for taxid, (name, _) in taxonomy.species.items():
+            if rng.random() < 0.05:
+                f.write(f"{taxid}\t{name}\t{rng.choice([92.5, 94.0, 96.0])}\n")
+
+
+def write_ete3_db(out_file, taxonomy):
+    """
+    Taxonomy database in the format of ete3 NCBITaxa (DB_VERSION=2)
+    """
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    db = sqlite3.connect(out_file)
+    db.executescript("""
+        CREATE TABLE stats (version INT PRIMARY KEY);
+        CREATE TABLE species (taxid INT PRIMARY KEY, parent INT, spname VARCHAR(50) COLLATE NOCASE, common VARCHAR(50) COLLATE NOCASE, rank VARCHAR(50), track TEXT);
+        CREATE TABLE synonym (taxid INT,spname VARCHAR(50) COLLATE NOCASE, PRIMARY KEY (spname, taxid));
+        CREATE TABLE merged (taxid_old INT, taxid_new INT);
+        CREATE INDEX spname1 ON species (spname COLLATE NOCASE);
+        CREATE INDEX spname2 ON synonym (spname COLLATE NOCASE);
+        INSERT INTO stats (version) VALUES (2);
+    """)
+    rows = [(1, 1, "root", "", "no rank", "1"),
+            (131567, 1, "cellular organisms", "", "no rank", "131567,1"),
+            (BACTERIA, 131567, "Bacteria", "", "superkingdom", f"{BACTERIA},131567,1"),
+            (ARCHAEA, 131567, "Archaea", "", "superkingdom", f"{ARCHAEA},131567,1")]
+    for taxid, (name, domain) in taxonomy.genera.items():
+        rows.append((taxid, domain, name, "", "genus", f"{taxid},{domain},131567,1"))
+    for taxid in taxonomy.species:
+        lineage = taxonomy.lineage(taxid)
+        rows.append((taxid, lineage[-2], taxonomy.species[taxid][0], "", "species", ",".join(map(str, reversed(lineage)))))
+    db.executemany("INSERT INTO species VALUES (?, ?, ?, ?, ?, ?)", rows)
+    db.commit()
+    db.close()
+
+
+def write_reference_db(taxonomy, num_genomes, seed=0):
+    """
+    Reference and Genome_Size tables of references.db. config.DQC_REFERENCE_DIR must be set beforehand.
+    """
+    from dqc.models import db, Reference, Genome_Size
+    rng = random.Random(seed)
+    species_taxids = list(taxonomy.species)
+    db.connect(reuse_if_open=True)
+    db.drop_tables([Reference, Genome_Size])
+    db.create_tables([Reference, Genome_Size])
+    references = []
+    for i in range(num_genomes):
+        # every species has at least one reference genome
+        species_taxid = species_taxids[i] if i < len(species_taxids) else rng.choice(species_taxids)
+        species_name = taxonomy.species[species_taxid][0]
+        references.append({
+            "accession": _accession(i), "taxid": FIRST_STRAIN_TAXID + i, "species_taxid": species_taxid,
+            "organism_name": species_name, "species_name": species_name, "infraspecific_name": f"strain=strain{i}",
+            "relation_to_type_material": "type strain", "is_valid": rng.random() < 0.9
+        })
+    genome_sizes = []
+    for taxid in species_taxids:
+        expected = rng.randint(1500000, 8000000)
+        genome_sizes.append({
+            "species_taxid": taxid, "min_ungapped_length": int(expected * 0.8), "max_ungapped_length": int(expected * 1.2),
+            "expected_ungapped_length": expected, "number_of_genomes": rng.randint(1, 100), "method_determined": "synthetic"
+        })
+    with db.atomic():
+        for i in range(0, len(references), 500):
+            Reference.insert_many(references[i:i + 500]).execute()
+        for i in range(0, len(genome_sizes), 500):
+            Genome_Size.insert_many(genome_sizes[i:i + 500]).execute()
+    db.close()
+
+
+def build_reference(ref_dir, num_genomes=20000, num_species=None, num_groups=None, seed=0):
+    """
+    Create synthetic reference data in ref_dir and set config.DQC_REFERENCE_DIR to it.
+    Must be called before importing the modules that read reference data at import time (e.g. dqc.models).
+    """
+    num_species = num_species or max(num_genomes // 10, 10)
+    num_groups = num_groups or max(num_species // 20, 1)
+    os.makedirs(ref_dir, exist_ok=True)
+    config.DQC_REFERENCE_DIR = os.path.abspath(ref_dir)
+    taxonomy = SyntheticTaxonomy(num_species, seed=seed)
+    write_ani_report(os.path.join(ref_dir, config.ANI_REPORT_FILE), taxonomy, num_genomes, seed=seed)
+    write_assembly_report(os.path.join(ref_dir, config.ASSEMBLY_REPORT_FILE), taxonomy, num_genomes, seed=seed)
+    write_indistinguishable_groups(os.path.join(ref_dir, config.INDISTINGUISHABLE_GROUPS_PROKARYOTE), taxonomy, num_groups, seed=seed)
+    write_species_specific_threshold(os.path.join(ref_dir, config.SPECIES_SPECIFIC_THRESHOLD), taxonomy, seed=seed)
+    write_ete3_db(os.path.join(ref_dir, config.ETE3_SQLITE_DB), taxonomy)
+    write_reference_db(taxonomy, num_genomes, seed=seed)
+    return taxonomy
+
+
+def write_checkm_taxa(taxonomy):
+    """
+    Taxon table for the completeness check (markers for domains and genera)
+    """
+    from dqc.models import db, Taxon
+    db.connect(reuse_if_open=True)
+    db.drop_tables([Taxon])
+    db.create_tables([Taxon])
+    rows = [{"taxid": 0, "rank": "life", "taxon": "Prokaryote", "genomes": 5656, "marker_genes": 56, "marker_sets": 24},
+            {"taxid": BACTERIA, "rank": "domain", "taxon": "Bacteria", "genomes": 5449, "marker_genes": 104, "marker_sets": 58},
+            {"taxid": ARCHAEA, "rank": "domain", "taxon": "Archaea", "genomes": 207, "marker_genes": 149, "marker_sets": 107}]
+    for taxid, (name, _) in taxonomy.genera.items():
+        rows.append({"taxid": taxid, "rank": "genus", "taxon": name, "genomes": 10, "marker_genes": 300, "marker_sets": 150})
+    with db.atomic():
+        Taxon.insert_many(rows).execute()
+    db.close()
+
+
+def write_gtdb_reference(taxonomy, ref_dir, seed=0):
+    """
+    One GTDB representative genome per species. Returns the paths of the genome files.
+    """
+    from dqc.common import get_ref_genome_fasta
+    from dqc.models import db, GTDB_Reference
+    rng = random.Random(seed)
+    db.connect(reuse_if_open=True)
+    db.drop_tables([GTDB_Reference])
+    db.create_tables([GTDB_Reference])
+    rows, genome_files = [], []
+    for i, (taxid, (name, genus_taxid)) in enumerate(taxonomy.species.items()):
+        accession = f"GCA_{800000000 + i:09d}.1"
+        domain = "Archaea" if taxonomy.genera[genus_taxid][1] == ARCHAEA else "Bacteria"
+        genus = taxonomy.genera[genus_taxid][0]
+        rows.append({
+            "accession": accession, "gtdb_species": f"s__{name}",
+            "gtdb_taxonomy": f"d__{domain};p__Synthetic;c__Synthetic;o__Synthetic;f__Synthetic;g__{genus};s__{name}",
+            "ani_circumscription_radius": 95.0, "mean_intra_species_ani": "98.5", "min_intra_species_ani": "96.1",
+            "mean_intra_species_af": "0.91", "min_intra_species_af": "0.82", "num_clustered_genomes": 1, "clustered_genomes": accession
+        })
+        genome_file = get_ref_genome_fasta(accession, for_gtdb=True)
+        os.makedirs(os.path.dirname(genome_file), exist_ok=True)
+        genome_files.append(write_fasta(genome_file, genome_size=2000, num_contigs=1, seed=rng.randrange(2 ** 32)))
+    with db.atomic():
+        for i in range(0, len(rows), 500):
+            GTDB_Reference.insert_many(rows[i:i + 500]).execute()
+    db.close()
+    return genome_files
+
+
+def write_fake_sketch(out_file, genome_files):
+    """
+    Stand-in for a MASH sketch file: the list of the sketched genomes. Readable only by the fake mash of the benchmarks.
+    """
+    with open(out_file, "w") as f:
+        f.write("# synthetic sketch for benchmarks/fake_tools.py\n")
+        f.write("\n".join(genome_files) + "\n")
+
+
+def build_pipeline_reference(ref_dir, num_genomes=1000, seed=0):
+    """
+    Reference data to run the whole DFAST_QC pipeline with the fake external tools (see fake_tools.py):
+    in addition to build_reference(), small genome files, CheckM taxa, GTDB references and fake MASH sketches.
+    """
+    taxonomy = build_reference(ref_dir, num_genomes=num_genomes, seed=seed)
+    from dqc.common import get_ref_genome_fasta
+    from dqc.models import Reference
+    rng = random.Random(seed)
+    genome_files = []
+    for ref in Reference.select(Reference.accession):
+        genome_file = get_ref_genome_fasta(ref.accession)
+        os.makedirs(os.path.dirname(genome_file), exist_ok=True)
+        genome_files.append(write_fasta(genome_file, genome_size=2000, num_contigs=1, seed=rng.randrange(2 ** 32)))
+    write_fake_sketch(os.path.join(ref_dir, config.MASH_SKETCH_FILE), genome_files)
+    write_checkm_taxa(taxonomy)
+    gtdb_genome_files = write_gtdb_reference(taxonomy, ref_dir, seed=seed)
+    write_fake_sketch(os.path.join(ref_dir, config.GTDB_MASH_SKETCH_FILE), gtdb_genome_files)
+    os.makedirs(os.path.join(ref_dir, config.CHECKM_DATA_ROOT), exist_ok=True)
+    with open(os.path.join(ref_dir, config.REFERENCE_INF), "w") as f:
+        json.dump({"version": "synthetic", "type": "benchmark"}, f)
+    return taxonomy
@@ -21,11 +21,16 @@ def get_existing_genomes(genome_dir):
     # Todo: check eof, broken file
     existing_genomes = []
     for file_name in os.listdir(genome_dir):
+        if not file_name.endswith(".fna.gz"):
+            continue  # skip lock files and partially downloaded files
         if os.path.getsize(os.path.join(genome_dir, file_name)) > 0:
             existing_genomes.append(file_name.replace(".fna.gz", ""))
     return existing_genomes
 
 def download_all_genomes():
+    """
+    Returns the number of genomes added or deleted.
+    """
 
     asm_report = get_ref_path(config.ASSEMBLY_REPORT_FILE)
     ani_report = get_ref_path(config.ANI_REPORT_FILE)
@@ -54,6 +59,7 @@ def download_all_genomes():
     logger.info("Number of new genomes to be downloaded: %d", len(new_genomes))    
     logger.info("Number of unwanted genomes to be deleted: %d", len(unwanted_genomes))
 
+    num_succeeded = 0
     if new_genomes:
         new_genomes = sorted(new_genomes)
         logger.info("Start downloading new genomes.")
@@ -65,6 +71,7 @@ def download_all_genomes():
         delete_unwanted_genomes(unwanted_genomes, genome_dir)
         logger.info("Deleted %d genomes.", len(unwanted_genomes))
     logger.info("===== Completed downloading reference genomes =====")
+    return num_succeeded + len(unwanted_genomes)
 
 
 if __name__ == '__main__':
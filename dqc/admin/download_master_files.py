@@ -1,25 +1,65 @@
 import os
 import gzip
+import shutil
+from datetime import datetime
 from argparse import ArgumentParser
-from urllib.request import urlretrieve
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from ..common import get_logger
+from ..common import get_logger, get_ref_inf, update_ref_inf
 from ..config import config
 
 logger = get_logger(__name__)
 
+COPY_BUFSIZE = 1024 * 1024
 
-def download_file(url, out_dir):
+
+def download_file(url, out_dir, validators=None):
+    """
+    Download a file by streaming it to the output directory. '.txt.gz' files are decompressed while downloading.
+    If validators (ETag/Last-Modified recorded at the previous download) are given, a conditional request is sent
+    and the download is skipped when the file has not been changed on the server.
+    Returns validators of the downloaded file, or None if the file was not changed.
+    """
     os.makedirs(out_dir, exist_ok=True)
     base_name = os.path.basename(url)
-    out_file = os.path.join(out_dir, base_name)
+    decompress = base_name.endswith(".txt.gz")
+    out_file = os.path.join(out_dir, base_name.replace(".gz", "") if decompress else base_name)
+
+    request = Request(url)
+    if validators and os.path.exists(out_file):
+        if validators.get("etag"):
+            request.add_header("If-None-Match", validators["etag"])
+        if validators.get("last_modified"):
+            request.add_header("If-Modified-Since", validators["last_modified"])
     logger.info("Downloading %s to %s", base_name, out_dir)
     logger.debug("Source URL: %s", url)
-    urlretrieve(url, out_file)
+    try:
+        response = urlopen(request)
+    except HTTPError as e:
+        if e.code == 304:
+            logger.info("%s has not been changed since the last download. Skipped.", base_name)
+            return None
+        raise
+    tmp_file = out_file + ".part"
+    with response:
+        with open(tmp_file, "wb") as f_out:
+            if decompress:
+                logger.info("Decompressing %s to %s", base_name, os.path.basename(out_file))
+                with gzip.GzipFile(fileobj=response) as f_in:
+                    shutil.copyfileobj(f_in, f_out, COPY_BUFSIZE)
+            else:
+                shutil.copyfileobj(response, f_out, COPY_BUFSIZE)
+        new_validators = {
+            "url": url,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "downloaded": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+    os.replace(tmp_file, out_file)
     logger.info("Downloaded %s", base_name)
-    if base_name.endswith(".txt.gz"):
-        decompress_gzip(out_file, out_dir)
+    return new_validators
 
 def decompress_gzip(gzip_file, out_dir):
     base_name = os.path.basename(gzip_file)
@@ -28,28 +68,41 @@ def decompress_gzip(gzip_file, out_dir):
     logger.info("Decompressing %s to %s", gzip_file, base_name)
     with gzip.open(gzip_file, "rb") as f_in:
         with open(out_file, "wb") as f_out:
-            f_out.write(f_in.read())
+            shutil.copyfileobj(f_in, f_out, COPY_BUFSIZE)
     os.remove(gzip_file)
 
 
-def download_master_files(target_files):
-    
+def download_master_files(target_files, force=False):
+    """
+    Download master files that have been changed since the last download.
+    Freshness metadata is recorded in dqc_ref_inf.json.
+    Returns the list of targets actually downloaded.
+    """
     out_dir = config.DQC_REFERENCE_DIR
     threads = config.NUM_THREADS
+    ref_inf = get_ref_inf()
+    master_files = ref_inf.get("master_files", {})
 
     logger.info("===== Download master files =====")
     logger.info("Files will be downloaded to %s", out_dir)
-    futures = []
+    futures = {}
     with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="thread") as executor:
         for target in target_files:
             if target in config.URLS:
                 target_url = config.URLS[target]
-                f = executor.submit(download_file, target_url, out_dir)
-                futures.append(f)
+                validators = None if force else master_files.get(target)
+                f = executor.submit(download_file, target_url, out_dir, validators)
+                futures[f] = target
             else:
-                logger.warn("Target file '%s' not found. Skipping...")
-    [f.result() for f in as_completed(futures)]  # wait until all the jobs finish
-
+                logger.warning("Target file '%s' not found. Skipping...", target)
+    updated_targets = []
+    for f in as_completed(futures):  # wait until all the jobs finish
+        new_validators = f.result()
+        if new_validators:
+            target = futures[f]
+            master_files[target] = new_validators
+            updated_targets.append(target)
+    update_ref_inf({"master_files": master_files})
+    logger.info("Updated master files: %s", ", ".join(sorted(updated_targets)) if updated_targets else "None")
     logger.info("===== Completed downloading master files =====")
-
-
+    return updated_targets
@@ -1,37 +1,28 @@
 import os
 import glob
-from ..common import run_command, get_ref_path 
+from ..common import get_ref_path 
 from ..config import config
+from .mash_sketch_cache import update_sketch
 from logging import getLogger
 
 logger = getLogger(__name__)
 
-def gtdb_sketching():
+def gtdb_sketching(num_shards=0):
     logger.info("===== Starting the sketch for GTDB genomes  =====") 
     # Setting the paths for GTDB genome dir & MASH sketch file.
-    gtdb_paths_file = os.path.join(config.DQC_REFERENCE_DIR, "gtdb_genome_files_paths.txt")
     gtdb_genome_dir = get_ref_path(config.GTDB_GENOME_DIR)
 
     # Use glob to find files matching the pattern
     gtdb_genome_paths = glob.glob(os.path.join(gtdb_genome_dir, '**', f'*.fna.gz'), recursive = True)
     logger.info(f"Found {len(gtdb_genome_paths)} genomes in {gtdb_genome_dir}")
 
-    # Write the list of genome file paths to a file
-    with open(gtdb_paths_file, "w") as file:
-        file.write("\n".join(gtdb_genome_paths))
-
-    # Define the command for running mash sketch with the specified parameters
+    # Only new genomes are sketched. The sketch file is rebuilt from the cached per-genome sketches.
     gtdb_mash_sketch_file = get_ref_path(config.GTDB_MASH_SKETCH_FILE)
-    # As a workaround for the issue of MASH hanging when using multiple threads, we will use single thread for MASH search for now. We will investigate the issue and update this part in the future.
-    num_threads = config.NUM_THREADS
-    if num_threads > 1:
-        logger.warning("MASH sketch with multiple threads may fail due to a known issue with MASH.")
-        logger.warning("If you get an error like 'ERROR: Did not find fasta records...', please try running with a single thread by setting --num_threads to 1.")
-    cmd_gtdb_sketch = ["mash", "sketch", "-l", gtdb_paths_file, "-o", gtdb_mash_sketch_file, "-p", str(num_threads)]
-    run_command(cmd_gtdb_sketch, task_name="mash sketching GTDB genomes")
+    shard_dir = get_ref_path(config.GTDB_MASH_SKETCH_SHARD_DIR)
+    update_sketch(gtdb_genome_paths, "gtdb", gtdb_mash_sketch_file, task_name="mash sketching GTDB genomes",
+                  shard_dir=shard_dir, num_shards=num_shards)
     
     logger.info("===== Sketching GTDB genomes is done =====") 
-    os.remove(gtdb_paths_file)  # Remove the temporary file used to store genome file paths
 
 if __name__ == "__main__":
-    gtdb_sketching()
\ No newline at end of file
+    gtdb_sketching()
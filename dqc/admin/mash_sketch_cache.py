@@ -0,0 +1,164 @@
+import os
+import glob
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from more_itertools import chunked, distribute
+from ..common import get_logger, get_ref_path, run_command, CommandError
+from ..config import config
+
+logger = get_logger(__name__)
+
+SHARD_SIZE = 100  # number of genomes processed in a task
+SKETCH_TIMEOUT = 600  # MASH sometimes hangs. The process is killed and retried after this time (sec).
+
+
+def get_cache_dir(name):
+    cache_dir = os.path.join(get_ref_path(config.MASH_SKETCH_CACHE_DIR), name)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def get_cached_sketch_path(cache_dir, genome_path):
+    base_name = os.path.basename(genome_path).replace(".fna.gz", "")
+    return os.path.join(cache_dir, base_name + ".msh")
+
+
+def is_valid_cache(cached_sketch, genome_path):
+    return os.path.exists(cached_sketch) and os.path.getmtime(cached_sketch) >= os.path.getmtime(genome_path)
+
+
+def sketch_genome(genome_path, cached_sketch):
+    """
+    Sketch a single genome with a single thread. Returns True if succeeded.
+    MASH may hang or fail with multiple threads, so parallelism is achieved by running multiple MASH processes.
+    """
+    out_prefix = cached_sketch[:-len(".msh")]
+    log_file = out_prefix + ".log"
+    cmd = ["mash", "sketch", "-p", "1", "-o", out_prefix, genome_path]
+    try:
+        # retries are controlled by sketch_shard
+        run_command(cmd, task_name=f"mash_sketch ({os.path.basename(genome_path)})", timeout=SKETCH_TIMEOUT,
+                    retries=0, log_file=log_file, verbose=False)
+        is_succeeded = True
+    except CommandError as e:
+        logger.warning("Failed to sketch %s [%s]", genome_path, e)
+        is_succeeded = False
+        if os.path.exists(cached_sketch):
+            os.remove(cached_sketch)
+    if os.path.exists(log_file):
+        os.remove(log_file)
+    return is_succeeded
+
+
+def sketch_shard(shard, max_retry=3):
+    """
+    Sketch genomes in a shard. Failed genomes are retried up to max_retry times.
+    Returns the list of genomes failed.
+    """
+    failed_genomes = []
+    for genome_path, cached_sketch in shard:
+        n_trial = 1
+        while not sketch_genome(genome_path, cached_sketch):
+            if n_trial >= max_retry:
+                logger.error("Failed to sketch %s after %d trials.", genome_path, max_retry)
+                failed_genomes.append(genome_path)
+                break
+            n_trial += 1
+            logger.warning("(Try %d/%d [%s])", n_trial, max_retry, genome_path)
+    return failed_genomes
+
+
+def sketch_genomes(genome_sketch_pairs):
+    """
+    Split genomes into shards and sketch them in parallel with single-threaded MASH processes.
+    Returns the list of genomes failed.
+    """
+    threads = config.NUM_THREADS
+    shards = list(chunked(genome_sketch_pairs, SHARD_SIZE))
+    logger.info("Sketching %d genomes in %d shards using %d threads.", len(genome_sketch_pairs), len(shards), threads)
+    failed_genomes, num_processed = [], 0
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="thread") as executor:
+        futures = {executor.submit(sketch_shard, shard): len(shard) for shard in shards}
+        for f in as_completed(futures):
+            failed_genomes.extend(f.result())
+            num_processed += futures[f]
+            logger.info("\tSketched %d/%d genomes.", num_processed, len(genome_sketch_pairs))
+    return failed_genomes
+
+
+def paste_sketches(cached_sketches, out_sketch_file, task_name=None):
+    """
+    Merge per-genome sketches into a sketch file using 'mash paste'.
+    The sketch file is replaced atomically.
+    """
+    list_file = out_sketch_file + ".list"
+    tmp_prefix = out_sketch_file[:-len(".msh")] + ".tmp"
+    tmp_sketch_file = tmp_prefix + ".msh"
+    if os.path.exists(tmp_sketch_file):
+        os.remove(tmp_sketch_file)
+    with open(list_file, "w") as f:
+        f.write("\n".join(cached_sketches) + "\n")
+    cmd = ["mash", "paste", "-l", tmp_prefix, list_file]
+    run_command(cmd, task_name=task_name)
+    os.replace(tmp_sketch_file, out_sketch_file)
+    os.remove(list_file)
+
+
+def paste_shards(cached_sketches, shard_dir, num_shards):
+    """
+    Merge per-genome sketches into num_shards sketch files (shard_000.msh, shard_001.msh, ...) in shard_dir.
+    Shards are searched in parallel at query time.
+    """
+    tmp_shard_dir = shard_dir + ".tmp"
+    if os.path.exists(tmp_shard_dir):
+        shutil.rmtree(tmp_shard_dir)
+    os.makedirs(tmp_shard_dir)
+    num_shards = min(num_shards, len(cached_sketches))
+    for i, shard in enumerate(distribute(num_shards, cached_sketches)):
+        shard_file = os.path.join(tmp_shard_dir, f"shard_{i:03d}.msh")
+        paste_sketches(list(shard), shard_file, task_name=f"mash paste shard {i + 1}/{num_shards}")
+    if os.path.exists(shard_dir):
+        old_shard_dir = shard_dir + ".old"
+        os.rename(shard_dir, old_shard_dir)
+        os.rename(tmp_shard_dir, shard_dir)
+        shutil.rmtree(old_shard_dir)
+    else:
+        os.rename(tmp_shard_dir, shard_dir)
+    logger.info("Created %d sketch shards in %s", num_shards, shard_dir)
+
+
+def update_sketch(genome_paths, cache_name, out_sketch_file, task_name=None, shard_dir=None, num_shards=0):
+    """
+    Update the MASH sketch file incrementally.
+    Only new (or modified) genomes are sketched, sketches for the removed genomes are dropped,
+    and then the sketch file is rebuilt from the per-genome sketches with 'mash paste'.
+    If num_shards > 0, the sketches are also stored as shards in shard_dir.
+    If num_shards == 0 and shards already exist, they are rebuilt with the same number of shards.
+    """
+    cache_dir = get_cache_dir(cache_name)
+    dict_cached_sketch = {get_cached_sketch_path(cache_dir, genome_path): genome_path for genome_path in genome_paths}
+
+    # drop sketches for the removed genomes
+    num_removed = 0
+    for file_name in os.listdir(cache_dir):
+        cached_sketch = os.path.join(cache_dir, file_name)
+        if file_name.endswith(".msh") and cached_sketch not in dict_cached_sketch:
+            os.remove(cached_sketch)
+            num_removed += 1
+
+    pending = [(genome_path, cached_sketch) for cached_sketch, genome_path in dict_cached_sketch.items()
+               if not is_valid_cache(cached_sketch, genome_path)]
+    logger.info("Number of genomes to be sketched: %d (cached: %d, removed: %d)",
+                len(pending), len(genome_paths) - len(pending), num_removed)
+    failed_genomes = sketch_genomes(pending)
+    if failed_genomes:
+        logger.error("Failed to sketch %d genomes. Aborted. [%s]", len(failed_genomes), ", ".join(failed_genomes))
+        exit(1)
+
+    cached_sketches = sorted(dict_cached_sketch.keys())
+    logger.info("Merging %d sketches into %s", len(cached_sketches), out_sketch_file)
+    paste_sketches(cached_sketches, out_sketch_file, task_name=task_name)
+    if num_shards == 0 and shard_dir and os.path.isdir(shard_dir):
+        num_shards = len(glob.glob(os.path.join(shard_dir, "shard_*.msh")))
+    if num_shards > 0:
+        paste_shards(cached_sketches, shard_dir, num_shards)
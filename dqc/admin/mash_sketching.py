@@ -1,36 +1,27 @@
 import os
 import glob
-from ..common import run_command, get_ref_path, get_logger
+from ..common import get_ref_path, get_logger
 from ..config import config
+from .mash_sketch_cache import update_sketch
 
 logger = get_logger(__name__)
 
-def sketching():
+def sketching(num_shards=0):
     logger.info("===== Starting the sketch for referance genomes  =====") 
     # Setting the paths for refereance genome dir & MASH sketch file.
-    paths_file = os.path.join(config.DQC_REFERENCE_DIR, "genome_files_paths.txt")
     reference_genome_dir = get_ref_path(config.REFERENCE_GENOME_DIR)
 
     # Use glob to find files matching the pattern
     genome_files_paths = glob.glob(os.path.join(reference_genome_dir, "*.fna.gz"))
     logger.info(f"Found {len(genome_files_paths)} genomes in {reference_genome_dir}")
-    
-    # Write the list of genome file paths to a file
-    with open(paths_file, "w") as file:
-        file.write("\n".join(genome_files_paths))
 
-    # Define the command for running mash sketch with the specified parameters
+    # Only new genomes are sketched. The sketch file is rebuilt from the cached per-genome sketches.
     mash_sketch_file = get_ref_path(config.MASH_SKETCH_FILE)
-    # As a workaround for the issue of MASH hanging when using multiple threads, we will use single thread for MASH search for now. We will investigate the issue and update this part in the future.
-    num_threads = config.NUM_THREADS
-    if num_threads > 1:
-        logger.warning("MASH sketch with multiple threads may fail due to a known issue with MASH.")
-        logger.warning("If you get an error like 'ERROR: Did not find fasta records...', please try running with a single thread by setting --num_threads to 1.")
-    cmd_sketch = ["mash", "sketch", "-l", paths_file, "-o", mash_sketch_file, "-p", str(num_threads)]
-    run_command(cmd_sketch, task_name="mash sketching reference genomes")
+    shard_dir = get_ref_path(config.MASH_SKETCH_SHARD_DIR)
+    update_sketch(genome_files_paths, "ref", mash_sketch_file, task_name="mash sketching reference genomes",
+                  shard_dir=shard_dir, num_shards=num_shards)
     
     logger.info("===== Sketching reference genomes is done =====")
-    os.remove(paths_file)  # Remove the temporary file used to store genome file paths
 
 if __name__ == "__main__":
     sketching()
@@ -43,9 +43,13 @@ def download_expected_genome_size_file():
     url = config.URLS["egs"]  # egs: expected genome size
     download_file(url, out_dir)
 
-def prepare_genome_size_data():
+def prepare_genome_size_data(download=True):
+    """
+    download: False if the expected genome size file has already been downloaded (e.g. by update_all)
+    """
     logger.info("===== Prepare expected genome size data =====")
-    download_expected_genome_size_file()
+    if download:
+        download_expected_genome_size_file()
     add_genome_size_to_db()
     logger.info("===== Completed preparing expected genome size data =====")
 
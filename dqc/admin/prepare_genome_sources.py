@@ -0,0 +1,94 @@
+import os
+import re
+from urllib.request import urlopen
+from urllib.error import HTTPError, URLError
+from http.client import RemoteDisconnected
+from concurrent.futures import ThreadPoolExecutor
+from ..common import get_logger, get_ref_path
+from ..config import config
+from ..models import init_db, db, GTDB_Reference, Genome_Source
+from .asm_report_parser import Assembly
+from .ani_report_parser import get_filtered_ANI_report
+
+logger = get_logger(__name__)
+
+
+def get_genomic_fasta_url(ftp_path):
+    """
+    Resolve URL of genomic FASTA from ftp_path column of the assembly summary
+    e.g. https://ftp.ncbi.nlm.nih.gov/genomes/all/GCA/000/829/395/GCA_000829395.1_ASM82939v1
+      ==> https://ftp.ncbi.nlm.nih.gov/genomes/all/GCA/000/829/395/GCA_000829395.1_ASM82939v1/GCA_000829395.1_ASM82939v1_genomic.fna.gz
+    """
+    if not ftp_path or ftp_path == "na":
+        return None
+    ftp_path = ftp_path.rstrip("/").replace("ftp://", "https://")
+    return ftp_path + "/" + os.path.basename(ftp_path) + "_genomic.fna.gz"
+
+
+def fetch_md5(url):
+    base_dir, target_file = url.rsplit("/", 1)
+    target_file_escaped = target_file.replace(".", "\\.")
+    pat_md5 = re.compile(f"(.+?)\\s+?\\./({target_file_escaped})")
+    try:
+        resp_md5 = urlopen(base_dir + "/md5checksums.txt").read().decode()
+    except (HTTPError, URLError, RemoteDisconnected) as e:
+        logger.warning("Failed to get MD5 for %s. [%s]", target_file, e)
+        return None
+    m = pat_md5.search(resp_md5)
+    return None if not m else m.group(1)
+
+
+def get_target_accessions():
+    ani_report = get_ref_path(config.ANI_REPORT_FILE)
+    target_accessions = set(get_filtered_ANI_report(ani_report).keys())
+    if GTDB_Reference.table_exists():
+        gtdb_accessions = set([ref.accession for ref in GTDB_Reference.select(GTDB_Reference.accession)])
+        logger.info("Number of GTDB representative genomes: %d", len(gtdb_accessions))
+        target_accessions |= gtdb_accessions
+    return target_accessions
+
+
+def prepare_genome_sources(fetch_checksums=True):
+    logger.info("===== Prepare download URLs for reference genomes =====")
+    asm_report = get_ref_path(config.ASSEMBLY_REPORT_FILE)
+    threads = config.NUM_THREADS
+
+    sqlitedb_file = get_ref_path(config.SQLITE_REFERENCE_DB)
+    if os.path.exists(sqlitedb_file):
+        db.create_tables([Genome_Source])
+    else:
+        init_db()
+        logger.info("New SQLite DB is created. [%s]", sqlitedb_file)
+
+    target_accessions = get_target_accessions()
+    dict_url = {}
+    for asm in Assembly.parse(asm_report):
+        if asm.assembly_accession in target_accessions:
+            url = get_genomic_fasta_url(asm.ftp_path)
+            if url:
+                dict_url[asm.assembly_accession] = url
+    logger.info("Resolved download URLs for %d out of %d target genomes.", len(dict_url), len(target_accessions))
+
+    # MD5 is kept for the records whose URL has not been changed.
+    existing_sources = {source.accession: source for source in Genome_Source.select()}
+    dict_md5 = {}
+    for accession, url in dict_url.items():
+        source = existing_sources.get(accession)
+        if source and source.url == url:
+            dict_md5[accession] = source.md5
+    if fetch_checksums:
+        accessions_without_md5 = sorted([accession for accession in dict_url if not dict_md5.get(accession)])
+        logger.info("Fetching MD5 for %d genomes using %d threads.", len(accessions_without_md5), threads)
+        with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="thread") as executor:
+            urls = [dict_url[accession] for accession in accessions_without_md5]
+            for accession, md5 in zip(accessions_without_md5, executor.map(fetch_md5, urls)):
+                dict_md5[accession] = md5
+
+    with db.atomic():
+        Genome_Source.delete().execute()
+        rows = [{"accession": accession, "url": url, "md5": dict_md5.get(accession)} for accession, url in dict_url.items()]
+        for i in range(0, len(rows), 500):
+            Genome_Source.insert_many(rows[i: i + 500]).execute()
+    num_md5 = len([md5 for md5 in dict_md5.values() if md5])
+    logger.info("Inserted %d Genome_Source records. (with MD5: %d)", len(rows), num_md5)
+    logger.info("===== Completed preparing download URLs =====")
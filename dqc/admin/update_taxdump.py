@@ -2,7 +2,7 @@ import os
 import subprocess
 from io import StringIO
 from ete3 import NCBITaxa
-from ..common import get_logger
+from ..common import get_logger, get_ref_inf, update_ref_inf
 from ..config import config
 from ..models import Taxon, db
 from .download_master_files import download_file
@@ -14,13 +14,13 @@ logger = get_logger(__name__)
 #     ncbi_taxdump_file = download_taxdump(out_dir)
 #     update_ete3_db(ref_dir, ncbi_taxdump_file)
 
-def download_taxdump(out_dir):
+def download_taxdump(out_dir, validators=None):
     ncbi_taxdump_url = config.URLS["taxdump"]
     ncbi_taxdump_base_name = os.path.basename(ncbi_taxdump_url)
     logger.info("Downloading NCBI taxdump (%s)", ncbi_taxdump_base_name)
-    download_file(ncbi_taxdump_url, out_dir)
+    new_validators = download_file(ncbi_taxdump_url, out_dir, validators)
     ncbi_taxdump_file = os.path.join(out_dir, ncbi_taxdump_base_name)
-    return ncbi_taxdump_file
+    return ncbi_taxdump_file, new_validators
 
 def update_ete3_db(out_dir, ncbi_taxdump_file):
     ete3_db_file = os.path.join(out_dir, config.ETE3_SQLITE_DB)
@@ -34,9 +34,26 @@ def update_ete3_db(out_dir, ncbi_taxdump_file):
     return ete3_db_file
 
 
-def main():
+def main(force=False):
+    """
+    Returns True if the ETE3 database was updated.
+    """
     out_dir = config.DQC_REFERENCE_DIR
     logger.info("===== Update NCBI taxdump =====")
-    ncbi_taxdump_file = download_taxdump(out_dir)
-    update_ete3_db(out_dir, ncbi_taxdump_file)
+    master_files = get_ref_inf().get("master_files", {})
+    ete3_db_file = os.path.join(out_dir, config.ETE3_SQLITE_DB)
+    if force or not os.path.exists(ete3_db_file):
+        validators = None
+    else:
+        validators = master_files.get("taxdump")
+    ncbi_taxdump_file, new_validators = download_taxdump(out_dir, validators)
+    if new_validators is None:
+        logger.info("NCBI taxdump has not been changed. ETE3 database is not updated.")
+        updated = False
+    else:
+        update_ete3_db(out_dir, ncbi_taxdump_file)
+        master_files["taxdump"] = new_validators
+        update_ref_inf({"master_files": master_files})
+        updated = True
     logger.info("===== Completed updating NCBI taxdump =====")
+    return updated
@@ -0,0 +1,173 @@
+import os
+import glob
+import shutil
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from ..common import get_logger, get_ref_path, get_ref_genome_fasta, check_genome_file
+from ..config import config
+from ..models import Genome_Source
+
+logger = get_logger(__name__)
+
+MANIFEST_HEADER = ["path", "accession", "db", "size", "mtime", "md5", "status", "checked_at"]
+
+
+def _verify_worker(record):
+    try:
+        status, md5 = check_genome_file(record["abs_path"])
+    except OSError as e:
+        status, md5 = "unreadable", None
+        logger.debug("Failed to read %s: %s", record["abs_path"], e)
+    recorded_md5 = record.get("recorded_md5")
+    if status == "OK" and recorded_md5 and md5 != recorded_md5:
+        status = "checksum_mismatch"
+    record.update({"status": status, "md5": md5 or "-", "checked_at": datetime.now().strftime("%Y-%m-%dT%H:%M:%S")})
+    return record
+
+
+def get_genome_files(targets):
+    """
+    Return list of (db, accession, file_path) for the reference genomes.
+    db is either 'ref' (NCBI type strain genomes) or 'gtdb' (GTDB representative genomes)
+    """
+    genome_files = []
+    if "ref" in targets:
+        genome_dir = get_ref_path(config.REFERENCE_GENOME_DIR)
+        for file_name in glob.glob(os.path.join(genome_dir, "*.fna.gz")):
+            accession = os.path.basename(file_name).replace(".fna.gz", "")
+            genome_files.append(("ref", accession, file_name))
+    if "gtdb" in targets:
+        gtdb_genome_dir = get_ref_path(config.GTDB_GENOME_DIR)
+        glob_pat = os.path.join(gtdb_genome_dir, "*", "*", "*", "*", "*_genomic.fna.gz")
+        for file_name in glob.glob(glob_pat):
+            accession = os.path.basename(file_name).replace("_genomic.fna.gz", "")
+            genome_files.append(("gtdb", accession, file_name))
+    return genome_files
+
+
+def read_manifest(manifest_file):
+    manifest = {}
+    if not os.path.exists(manifest_file):
+        return manifest
+    with open(manifest_file) as f:
+        header = next(f).strip("\n").split("\t")
+        for line in f:
+            record = dict(zip(header, line.strip("\n").split("\t")))
+            manifest[record["path"]] = record
+    return manifest
+
+
+def write_manifest(manifest, manifest_file):
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        f.write("\t".join(MANIFEST_HEADER) + "\n")
+        for path in sorted(manifest):
+            record = manifest[path]
+            f.write("\t".join([str(record[key]) for key in MANIFEST_HEADER]) + "\n")
+    os.replace(tmp_file, manifest_file)
+
+
+def read_redownload_queue(queue_file):
+    queue = {}
+    if os.path.exists(queue_file):
+        for line in open(queue_file):
+            cols = line.strip("\n").split("\t")
+            if len(cols) == 2:
+                queue[cols[0]] = cols[1]
+    return queue
+
+
+def write_redownload_queue(queue, queue_file):
+    with open(queue_file, "w") as f:
+        for accession, db in sorted(queue.items()):
+            f.write(f"{accession}\t{db}\n")
+
+
+def quarantine_file(file_name):
+    quarantine_dir = get_ref_path(config.GENOME_QUARANTINE_DIR)
+    os.makedirs(quarantine_dir, exist_ok=True)
+    dest = os.path.join(quarantine_dir, os.path.basename(file_name))
+    shutil.move(file_name, dest)
+    logger.warning("Moved broken file to quarantine. [%s]", dest)
+
+
+def redownload_queued_genomes(queue_file):
+    from ..download_files import download_genomes_parallel
+    queue = read_redownload_queue(queue_file)
+    if not queue:
+        logger.info("No genomes are queued for re-download.")
+        return
+    threads = config.NUM_THREADS
+    for db in ["ref", "gtdb"]:
+        accessions = sorted([accession for accession, _db in queue.items() if _db == db])
+        if not accessions:
+            continue
+        logger.info("Re-downloading %d genomes (%s).", len(accessions), db)
+        download_genomes_parallel(accessions, threads=threads, for_gtdb=(db == "gtdb"))
+    # keep only the genomes that are still missing
+    remaining = {}
+    for accession, db in queue.items():
+        if not os.path.exists(get_ref_genome_fasta(accession, for_gtdb=(db == "gtdb"))):
+            remaining[accession] = db
+    write_redownload_queue(remaining, queue_file)
+    logger.info("Re-downloaded %d genomes. %d genomes remain in the queue.", len(queue) - len(remaining), len(remaining))
+
+
+def verify_genomes(targets=("ref", "gtdb"), incremental=False, redownload=False):
+    logger.info("===== Verify integrity of reference genomes =====")
+    manifest_file = get_ref_path(config.GENOME_MANIFEST)
+    queue_file = get_ref_path(config.GENOME_REDOWNLOAD_QUEUE)
+    threads = config.NUM_THREADS
+
+    previous_manifest = read_manifest(manifest_file)
+    # MD5 recorded by 'prepare_genome_sources' is used for the files not verified yet.
+    if Genome_Source.table_exists():
+        source_md5 = {source.accession: source.md5 for source in Genome_Source.select() if source.md5}
+    else:
+        source_md5 = {}
+    genome_files = get_genome_files(targets)
+    logger.info("Found %d genome files. [targets=%s]", len(genome_files), ",".join(targets))
+
+    manifest, records = {}, []
+    for db, accession, file_name in genome_files:
+        rel_path = os.path.relpath(file_name, config.DQC_REFERENCE_DIR)
+        stat = os.stat(file_name)
+        size, mtime = str(stat.st_size), str(int(stat.st_mtime))
+        previous = previous_manifest.get(rel_path)
+        if previous and previous["size"] == size and previous["mtime"] == mtime:
+            if incremental and previous["status"] == "OK":
+                manifest[rel_path] = previous
+                continue
+            # file has not been changed since the last verification, so the checksum must be identical.
+            recorded_md5 = previous["md5"] if previous["md5"] != "-" else None
+        else:
+            recorded_md5 = source_md5.get(accession)
+        records.append({"path": rel_path, "abs_path": file_name, "accession": accession, "db": db,
+                        "size": size, "mtime": mtime, "recorded_md5": recorded_md5})
+    logger.info("Number of files to be verified: %d (skipped: %d)", len(records), len(manifest))
+
+    queue = read_redownload_queue(queue_file)
+    num_broken = 0
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        for cnt, record in enumerate(executor.map(_verify_worker, records, chunksize=64), 1):
+            abs_path = record.pop("abs_path")
+            record.pop("recorded_md5")
+            if record["status"] != "OK":
+                num_broken += 1
+                logger.warning("%s\t%s\t%s", record["accession"], record["status"], abs_path)
+                quarantine_file(abs_path)
+                queue[record["accession"]] = record["db"]
+            manifest[record["path"]] = record
+            if cnt % 10000 == 0:
+                logger.info("\tVerified %d files.", cnt)
+
+    write_manifest(manifest, manifest_file)
+    write_redownload_queue(queue, queue_file)
+    logger.info("Manifest was written to %s", manifest_file)
+    logger.info("Verified %d files. Number of broken files: %d", len(records), num_broken)
+    if queue:
+        logger.info("%d genomes are queued for re-download. [%s]", len(queue), queue_file)
+    if redownload:
+        redownload_queued_genomes(queue_file)
+    logger.info("===== Completed verifying reference genomes =====")
+    return num_broken
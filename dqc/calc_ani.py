@@ -1,11 +1,12 @@
 import sys
 import os
-from .common import get_logger, run_command, get_ref_path
+from .common import get_logger, run_command, get_ref_path, tee_lines, is_empty_file
 from argparse import ArgumentError, ArgumentParser
 from .models import Reference, GTDB_Reference
 from .config import config
 from .download_files import download_genomes_parallel
 from .classify_tc_hits import classify_tc_hits , classify_tc_hits_GTDB
+from .select_target_genomes import main as select_target_genomes, search_mash, filter_by_distance, get_target_genomes, write_target_genome_list
 import shutil
 
 logger = get_logger(__name__)
@@ -57,35 +58,48 @@ def get_species_specific_threshold():
         D[species_taxid] = ani_threshold
     return D
 
-def run_skani(input_file, reference_list_file,skani_result_file,skani_database):
+def run_skani(input_file, reference_list_file, skani_database, debug_file=None, sketch_options=None):
+    """
+    Returns skani hits. The search result is parsed through a pipe while skani is running.
+        debug_file: file to keep the skani search result (debug mode)
+        sketch_options: additional options for skani sketch, e.g. ["--fast"]. skani search uses the parameters of the database.
+    """
     num_threads = config.NUM_THREADS
-    cmd_sketch = ["skani", "sketch", "-l", reference_list_file, "-o", skani_database, "-t", str(num_threads)]
-    cmd_skani = ["skani", "search", input_file, "-d", skani_database, "-o", skani_result_file, "-t" , str(num_threads)]
+    cmd_sketch = ["skani", "sketch", "-l", reference_list_file, "-o", skani_database, "-t", str(num_threads)] + (sketch_options or [])
+    cmd_skani = ["skani", "search", input_file, "-d", skani_database, "-t" , str(num_threads)]
+
+    def _parse(stdout):
+        return parse_skani_result(tee_lines(stdout, debug_file) if debug_file else stdout)
     run_command(cmd_sketch, task_name="skani_sketch")
-    run_command(cmd_skani, task_name="skani_search")
+    return run_command(cmd_skani, task_name="skani_search", stdout_handler=_parse)
 
-def add_organism_info_to_skani_result(skani_result_file, output_file):
+def parse_skani_result(lines):
+    """
+    Returns a list of (target_file, ani, align_fraction_ref, align_fraction_query) from skani output (file object or pipe)
+    """
+    hits = []
+    for line in lines:
+        if line.startswith("Ref_file"):  # header
+            continue
+        cols = line.strip("\n").split("\t")
+        hits.append((cols[0], float(cols[2]), float(cols[3]), float(cols[4])))
+    return hits
 
-    # Read the content of the original file, skipping the first line
-    with open(skani_result_file, 'r') as original_file:
-        lines = original_file.readlines()[1:]
+def add_organism_info_to_skani_result(skani_hits, output_file, ani_presets=None):
 
-    # Write the modified content to the new file
-    with open(skani_result_file, 'w') as new_file:
-        new_file.writelines(lines)
-    
     # parse Skani result and add organism info
     # also, result dict will be generated
+    # ani_presets: skani preset that produced the ANI of each target file (two-pass ANI). Added as 'ani_preset' column
 
     dict_species_specific_threthold = get_species_specific_threshold()
 
     header = ["organism_name", "strain", "accession", "taxid", "species_taxid", "relation_to_type", "validated", "ani", "align_fraction_ref", "align_fraction_query", "ani_threshold", "status"]
+    if ani_presets:
+        header.append("ani_preset")
     ret = "\t".join(header) + "\n"
     hit_cnt, hit_cnt_above_cutoff = 0, 0
     tc_result = []
-    for line in open(skani_result_file):
-        cols = line.strip("\n").split("\t")
-        target_file, ani_value, align_fraction_ref, align_fraction_query  = cols[0], float(cols[2]), float(cols[3]), float(cols[4])
+    for target_file, ani_value, align_fraction_ref, align_fraction_query in skani_hits:
         accession = os.path.basename(target_file).replace(".fna.gz", "")
         ref = Reference.get_or_none(Reference.accession==accession)
         if ref:
@@ -99,6 +113,8 @@ def add_organism_info_to_skani_result(skani_result_file, output_file):
         if ani_value > ani_threshold:
             hit_cnt_above_cutoff += 1
         result_row = [organism_name, strain, accession, taxid, species_taxid, relation_to_type_material, validated, ani_value, align_fraction_ref, align_fraction_query, ani_threshold, ""]
+        if ani_presets:
+            result_row.append(ani_presets[target_file])
         ret_dict = {key: value for key, value in zip(header, result_row)}
         tc_result.append(ret_dict)
     status = classify_tc_hits(tc_result)
@@ -112,27 +128,19 @@ def add_organism_info_to_skani_result(skani_result_file, output_file):
     logger.info("DFAST Taxonomy check result was written to %s", output_file)
     return tc_result    
 
-def add_organism_info_to_skani_result_for_gtdb(skani_result_file, output_file):
+def add_organism_info_to_skani_result_for_gtdb(skani_hits, output_file, ani_presets=None):
 
-    # Read the content of the original file, skipping the first line
-    with open(skani_result_file, 'r') as original_file:
-        lines = original_file.readlines()[1:]
-
-    # Write the modified content to the new file
-    with open(skani_result_file, 'w') as new_file:
-        new_file.writelines(lines)
-    
     # parse Skani result and add organism info
     # also, result dict will be generated
     header = ["accession", "gtdb_species", "ani", "align_fraction_ref", "align_fraction_query", 
         "gtdb_taxonomy", "ani_circumscription_radius", "mean_intra_species_ani", "min_intra_species_ani",
         "mean_intra_species_af", "min_intra_species_af", "num_clustered_genomes", "status"]
+    if ani_presets:
+        header.append("ani_preset")
     ret = "\t".join(header) + "\n"
     hit_cnt, hit_cnt_above_cutoff = 0, 0
     gtdb_result = []
-    for line in open(skani_result_file):
-        cols = line.strip("\n").split("\t")
-        target_file, ani_value, align_fraction_ref, align_fraction_query  = cols[0], float(cols[2]), float(cols[3]), float(cols[4])
+    for target_file, ani_value, align_fraction_ref, align_fraction_query in skani_hits:
         accession = os.path.basename(target_file).replace("_genomic.fna.gz", "")
         ref = GTDB_Reference.get_or_none(GTDB_Reference.accession==accession)
         if ref:
@@ -149,6 +157,8 @@ def add_organism_info_to_skani_result_for_gtdb(skani_result_file, output_file):
         result_row = [accession, gtdb_species, ani_value, align_fraction_ref, align_fraction_query,
             gtdb_taxonomy, ani_circumscription_radius, mean_intra_species_ani, min_intra_species_ani,
             mean_intra_species_af, min_intra_species_af, num_clustered_genomes, status]
+        if ani_presets:
+            result_row.append(ani_presets[target_file])
         ret_dict = {key: value for key, value in zip(header, result_row)}
         gtdb_result.append(ret_dict)
     status = classify_tc_hits_GTDB(gtdb_result)
@@ -162,27 +172,154 @@ def add_organism_info_to_skani_result_for_gtdb(skani_result_file, output_file):
     logger.info("GTDB search result was written to %s", output_file)
     return gtdb_result
 
-def main(query_fasta, reference_list, out_dir, for_gtdb=False):
+def search_references(query_fasta, reference_list, work_dir, for_gtdb=False, suffix="", sketch_options=None):
+    """
+    Run skani against the reference genomes in reference_list (file) and returns skani hits.
+        suffix: added to the names of the skani database and result, when skani is run more than once (adaptive hit selection, two-pass ANI)
+    """
     if for_gtdb:
-        skani_result_file = os.path.join(out_dir, config.GTDB_SKANI_RESULT)
-        result_file = os.path.join(out_dir, config.GTDB_RESULT)
-        skani_database = os.path.join(out_dir, config.SKANI_DATABASE_GTDB)
+        skani_result_file = os.path.join(work_dir, config.GTDB_SKANI_RESULT)
+        skani_database = os.path.join(work_dir, config.SKANI_DATABASE_GTDB + suffix)
     else:
-        skani_result_file = os.path.join(out_dir, config.SKANI_RESULT)
-        result_file = os.path.join(out_dir, config.TC_RESULT)
-        skani_database = os.path.join(out_dir, config.SKANI_DATABASE_REF)
+        skani_result_file = os.path.join(work_dir, config.SKANI_RESULT)
+        skani_database = os.path.join(work_dir, config.SKANI_DATABASE_REF + suffix)
+    root, ext = os.path.splitext(skani_result_file)
+    skani_result_file = root + suffix + ext
 
     check_fasta_existence(reference_list, for_gtdb=for_gtdb)
-    run_skani(query_fasta, reference_list,skani_result_file,skani_database)
-    if for_gtdb:
-        tc_result = add_organism_info_to_skani_result_for_gtdb(skani_result_file, result_file)
-    else:
-        tc_result = add_organism_info_to_skani_result(skani_result_file, result_file)
+    skani_hits = run_skani(query_fasta, reference_list, skani_database, debug_file=skani_result_file if config.DEBUG else None,
+                           sketch_options=sketch_options)
     if not config.DEBUG:
-        os.remove(skani_result_file)
         shutil.rmtree(skani_database)
+    return skani_hits
+
+def get_ani_thresholds(target_files, for_gtdb=False):
+    """
+    ANI threshold for each reference genome file: species-specific threshold (or the default threshold),
+    or ANI circumscription radius for GTDB
+    """
+    if for_gtdb:
+        accessions = {target_file: os.path.basename(target_file).replace("_genomic.fna.gz", "") for target_file in target_files}
+        query = GTDB_Reference.select(GTDB_Reference.accession, GTDB_Reference.ani_circumscription_radius).where(GTDB_Reference.accession.in_(list(accessions.values())))
+        dict_threshold = {ref.accession: ref.ani_circumscription_radius for ref in query}
+        return {target_file: dict_threshold.get(accession, 95) for target_file, accession in accessions.items()}
+    dict_species_specific_threthold = get_species_specific_threshold()
+    accessions = {target_file: os.path.basename(target_file).replace(".fna.gz", "") for target_file in target_files}
+    query = Reference.select(Reference.accession, Reference.species_taxid).where(Reference.accession.in_(list(accessions.values())))
+    dict_species_taxid = {ref.accession: ref.species_taxid for ref in query}
+    return {target_file: dict_species_specific_threthold.get(dict_species_taxid.get(accession), default_ani_threshold)
+            for target_file, accession in accessions.items()}
+
+def classify_skani_hits(skani_hits, out_dir, for_gtdb=False, ani_presets=None):
+    """
+    Add organism info to skani hits, classify them and write the result (tc_result.tsv or result_gtdb.tsv)
+        ani_presets: {target_file: "fast" or "precise"}. If specified, 'ani_preset' is added to each hit (two-pass ANI)
+    """
+    if for_gtdb:
+        return add_organism_info_to_skani_result_for_gtdb(skani_hits, os.path.join(out_dir, config.GTDB_RESULT), ani_presets=ani_presets)
+    else:
+        return add_organism_info_to_skani_result(skani_hits, os.path.join(out_dir, config.TC_RESULT), ani_presets=ani_presets)
+
+def main(query_fasta, reference_list, out_dir, for_gtdb=False, work_dir=None):
+    work_dir = work_dir or out_dir  # skani database is an intermediate file. skani result is written only in debug mode
+    skani_hits = search_references(query_fasta, reference_list, work_dir, for_gtdb=for_gtdb)
+    return classify_skani_hits(skani_hits, out_dir, for_gtdb=for_gtdb)
+
+def get_status(tc_result):
+    """
+    Status of the classified hits (see classify_tc_hits)
+    """
+    statuses = [hit["status"] for hit in tc_result if hit["status"] != "below_threshold"]
+    if statuses:
+        return statuses[0]
+    return "below_threshold" if tc_result else "no_hit"
+
+def needs_more_hits(status):
+    return status.startswith("inconclusive") or status in ("below_threshold", "no_hit")
+
+def run_adaptive(input_file, out_dir, work_dir, num_hits, for_gtdb=False):
+    """
+    Adaptive hit selection (--adaptive_hits).
+    ANI is first computed only for the MASH hits within config.ADAPTIVE_DISTANCE_MARGIN from the best hit (up to num_hits).
+    If the result is inconclusive or below the threshold, the candidates are expanded to num_hits, and then doubled
+    up to config.ADAPTIVE_MAX_HITS. ANI values already computed are reused, so skani is run only for the new candidates.
+    Returns the classified hits.
+    """
+    max_hits = max(config.ADAPTIVE_MAX_HITS, num_hits)
+    mash_hits = search_mash(input_file, max_hits, for_gtdb=for_gtdb, work_dir=work_dir)
+    candidates = get_target_genomes(mash_hits, for_gtdb=for_gtdb)
+    num_candidates = min(max(len(filter_by_distance(mash_hits, config.ADAPTIVE_DISTANCE_MARGIN)), 1), num_hits, len(candidates))
+    target_genome_list_file = os.path.join(out_dir, config.GTDB_TARGET_GENOME_LIST if for_gtdb else config.TARGET_GENOME_LIST)
+    skani_hits, done, step, tc_result = [], 0, 0, []
+    while done < num_candidates:
+        step += 1
+        step_list_file = os.path.join(work_dir, f"{os.path.splitext(os.path.basename(target_genome_list_file))[0]}_{step}.txt")
+        write_target_genome_list(candidates[done:num_candidates], step_list_file)
+        skani_hits += search_references(input_file, step_list_file, work_dir, for_gtdb=for_gtdb, suffix=f"_{step}")
+        if not config.DEBUG:
+            os.remove(step_list_file)
+        skani_hits.sort(key=lambda hit: hit[1], reverse=True)  # by ANI, as reported by skani
+        done = num_candidates
+        tc_result = classify_skani_hits(skani_hits, out_dir, for_gtdb=for_gtdb)
+        status = get_status(tc_result)
+        if not needs_more_hits(status):
+            break
+        num_candidates = min(num_hits if done < num_hits else done * 2, max_hits, len(candidates))
+        if done < num_candidates:
+            logger.info("The result is '%s' with %d candidates. Expanding the candidates to %d.", status, done, num_candidates)
+    write_target_genome_list(candidates[:done], target_genome_list_file)
+    logger.info("Adaptive hit selection: ANI was computed for %d of %d MASH hits in %d steps.", done, len(candidates), step)
     return tc_result
 
+def run_two_pass(input_file, out_dir, work_dir, num_hits, for_gtdb=False):
+    """
+    Two-pass ANI (--two_pass_ani).
+    The top config.TWO_PASS_HITS MASH hits are screened with skani using the fast preset (config.FAST_SKANI_OPTIONS), and
+    ANI is computed again with the default settings only for the hits whose fast ANI is within config.TWO_PASS_ANI_MARGIN
+    of the threshold of their species (or above it). The other hits keep the ANI values of the screen.
+    The preset that produced the ANI of each hit is reported as 'ani_preset' ("precise" or "fast").
+    Returns the classified hits (up to num_hits, or more if more hits are computed precisely).
+    """
+    mash_hits = search_mash(input_file, max(config.TWO_PASS_HITS, num_hits), for_gtdb=for_gtdb, work_dir=work_dir)
+    candidates = get_target_genomes(mash_hits, for_gtdb=for_gtdb)
+    target_genome_list_file = os.path.join(out_dir, config.GTDB_TARGET_GENOME_LIST if for_gtdb else config.TARGET_GENOME_LIST)
+    write_target_genome_list(candidates, target_genome_list_file)
+    if not candidates:
+        return []
+    fast_hits = search_references(input_file, target_genome_list_file, work_dir, for_gtdb=for_gtdb, suffix="_fast",
+                                  sketch_options=config.FAST_SKANI_OPTIONS)
+    thresholds = get_ani_thresholds([hit[0] for hit in fast_hits], for_gtdb=for_gtdb)
+    close_files = [hit[0] for hit in fast_hits if hit[1] >= thresholds[hit[0]] - config.TWO_PASS_ANI_MARGIN]
+    logger.info("Two-pass ANI: %d of %d screened hits are above the ANI threshold minus %.1f%%.", len(close_files), len(fast_hits), config.TWO_PASS_ANI_MARGIN)
+    precise_hits = []
+    if close_files:
+        close_list_file = os.path.join(work_dir, os.path.basename(target_genome_list_file).replace(".txt", "_close.txt"))
+        write_target_genome_list(close_files, close_list_file)
+        precise_hits = search_references(input_file, close_list_file, work_dir, for_gtdb=for_gtdb)
+        if not config.DEBUG:
+            os.remove(close_list_file)
+    screened_hits = [hit for hit in fast_hits if hit[0] not in set(close_files)]
+    ani_presets = {**{hit[0]: "fast" for hit in screened_hits}, **{hit[0]: "precise" for hit in precise_hits}}
+    skani_hits = precise_hits + screened_hits
+    skani_hits.sort(key=lambda hit: hit[1], reverse=True)  # by ANI, as reported by skani
+    return classify_skani_hits(skani_hits[:max(num_hits, len(precise_hits))], out_dir, for_gtdb=for_gtdb, ani_presets=ani_presets)
+
+def search_and_classify(query_fasta, out_dir, num_hits, for_gtdb=False, work_dir=None):
+    """
+    Select target genomes with MASH and compute ANI in the mode set in config (adaptive hit selection, two-pass ANI,
+    or ANI for the top num_hits). Used by both taxonomy check and GTDB search.
+    Returns the classified hits ([] if no target genome is found).
+    """
+    work_dir = work_dir or out_dir
+    if config.ADAPTIVE_HITS:
+        return run_adaptive(query_fasta, out_dir, work_dir, num_hits, for_gtdb=for_gtdb)
+    if config.TWO_PASS_ANI:
+        return run_two_pass(query_fasta, out_dir, work_dir, num_hits, for_gtdb=for_gtdb)
+    target_genome_list_file = select_target_genomes(query_fasta, out_dir, num_hits, for_gtdb=for_gtdb, work_dir=work_dir)
+    if is_empty_file(target_genome_list_file):
+        return []
+    return main(query_fasta, target_genome_list_file, out_dir, for_gtdb=for_gtdb, work_dir=work_dir)
+
 
 if __name__ == '__main__':
 
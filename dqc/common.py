@@ -5,8 +5,21 @@ import subprocess
 import shutil
 import json
 import tarfile
-from logging import StreamHandler, FileHandler, Formatter, INFO, DEBUG, getLogger
+import fcntl
+import re
+import signal
+import threading
+import atexit
+import tempfile
+import gzip
+import zlib
+import hashlib
+from collections import deque
+from datetime import datetime
+from contextlib import contextmanager
+from logging import StreamHandler, FileHandler, Formatter, INFO, DEBUG, getLogger, shutdown as shutdown_logging
 from .config import config
+from . import metrics
 
 def get_logger(name=None):
     if config.DEBUG:
@@ -32,22 +45,271 @@ def get_logger(name=None):
 logger = get_logger(__name__)
 
 
-def run_command(cmd, task_name=None, shell=True):
-    if task_name:
-        logger.info("Task started: %s", task_name)
-    if shell:
-        cmd = " ".join(cmd)
-    logger.info("Running command: %s", cmd)
-    p = subprocess.run(cmd, shell=shell, encoding='utf-8', stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if p.returncode != 0:
-        logger.error("Command failed. Aborted. [%s]", cmd)
-        logger.error("Output: %s\n%s", "-" * 80, p.stdout)
-        exit(1)
+class CommandError(Exception):
+    """
+    Raised when an external command is not completed successfully.
+    """
+    def __init__(self, message, cmd=None, task_name=None, returncode=None, log_file=None):
+        super().__init__(message)
+        self.cmd = cmd
+        self.task_name = task_name
+        self.returncode = returncode
+        self.log_file = log_file
+
+
+class CommandNotFoundError(CommandError):
+    pass
+
+
+class CommandFailedError(CommandError):
+    pass
+
+
+class CommandTimeoutError(CommandError):
+    pass
+
+
+def get_command_log_file(task_name):
+    if config.ADMIN:
+        log_dir = get_ref_path(config.COMMAND_LOG_DIR)
     else:
-        if task_name:
-            logger.info("Task succeeded: %s", task_name)
-        if p.stdout:
-            logger.debug("%s output %s\n%s%s", task_name, "-" * 50, p.stdout, "-" * 50)
+        log_dir = os.path.join(config.OUT_DIR, config.COMMAND_LOG_DIR)
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, re.sub(r"[^\w.-]+", "_", task_name) + ".log")
+
+
+def _get_log_tail(log_file, num_lines=50):
+    if not log_file or not os.path.exists(log_file):
+        return ""
+    with open(log_file, errors="replace") as f:
+        return "".join(deque(f, maxlen=num_lines))
+
+
+def _kill_process_group(p):
+    """
+    Kill the child and all of its descendants (e.g. the tools invoked from CheckM or ShigaPass).
+    """
+    for sig, wait_time in [(signal.SIGTERM, 10), (signal.SIGKILL, None)]:
+        try:
+            os.killpg(p.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            p.wait(timeout=wait_time)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def _run_once(cmd, task_name, shell, stdout_file, log_file, timeout, stdout_handler=None):
+    mode = "w" if stdout_file else "a"
+    with open(log_file, "a") as f_log, open(stdout_file or log_file, mode) as f_out:
+        f_log.write(f"# [{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {cmd if shell else ' '.join(cmd)}\n")
+        f_log.flush()
+        # The child runs in its own process group, so that it can be killed with its descendants on timeout.
+        try:
+            p = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE if stdout_handler else f_out, stderr=f_log,
+                                 start_new_session=True, text=bool(stdout_handler))
+        except FileNotFoundError as e:
+            raise CommandNotFoundError(f"Command not found. [{cmd[0]}]", cmd, task_name, log_file=log_file) from e
+        result = None
+        timed_out = threading.Event()
+        try:
+            if stdout_handler:
+                # The output is consumed while the command is running, so the timeout is enforced by a timer.
+                timer = threading.Timer(timeout, lambda: (timed_out.set(), _kill_process_group(p))) if timeout else None
+                if timer:
+                    timer.start()
+                try:
+                    with p.stdout:
+                        result = stdout_handler(p.stdout)
+                        for _ in p.stdout:  # drain the output not consumed by the handler
+                            pass
+                    returncode = p.wait()
+                finally:
+                    if timer:
+                        timer.cancel()
+                if timed_out.is_set():
+                    raise subprocess.TimeoutExpired(cmd, timeout)
+            else:
+                returncode = p.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            _kill_process_group(p)
+            raise CommandTimeoutError(f"Command timed out after {timeout} seconds. [{task_name}]", cmd, task_name,
+                                      p.returncode, log_file)
+        except BaseException:
+            # e.g. KeyboardInterrupt. Do not leave the child running.
+            _kill_process_group(p)
+            if timed_out.is_set():  # the handler failed on the output truncated by the timeout
+                raise CommandTimeoutError(f"Command timed out after {timeout} seconds. [{task_name}]", cmd, task_name,
+                                          p.returncode, log_file)
+            raise
+    if returncode != 0:
+        raise CommandFailedError(f"Command failed with exit status {returncode}. [{task_name}]", cmd, task_name,
+                                 returncode, log_file)
+    return result
+
+
+def run_command(cmd, task_name=None, shell=False, stdout_file=None, timeout=None, retries=None, log_file=None, verbose=True, stdout_handler=None):
+    """
+    Run an external command.
+        cmd: list of arguments. (a string if shell=True)
+        stdout_file: file to write standard output. If None, standard output is written to the log file.
+        stdout_handler: function to consume standard output (text stream) through a pipe while the command is running,
+                        e.g. an incremental parser. Its return value is returned. stdout_file is ignored.
+        timeout, retries: default values are taken from config.COMMAND_TIMEOUTS and config.COMMAND_RETRIES
+        log_file: file to write standard error. (default: OUT_DIR/logs/<task_name>.log)
+    Timeouts and abnormal terminations (killed by a signal) are retried (stdout_handler is called again for each attempt).
+    Raises CommandError if the command fails.
+    """
+    program = os.path.basename(cmd.split()[0] if shell else cmd[0])
+    task_name = task_name or program
+    timeout = timeout if timeout is not None else config.COMMAND_TIMEOUTS.get(program)
+    retries = retries if retries is not None else config.COMMAND_RETRIES.get(program, 0)
+    log_file = log_file or get_command_log_file(task_name)
+    log = logger.info if verbose else logger.debug
+    log("Task started: %s", task_name)
+    log("Running command: %s", cmd if shell else " ".join(cmd))
+    for n in range(1, retries + 2):
+        try:
+            with metrics.command(task_name, cmd) as record:
+                record["attempt"] = n
+                result = _run_once(cmd, task_name, shell, stdout_file, log_file, timeout, stdout_handler)
+            break
+        except (CommandTimeoutError, CommandFailedError) as e:
+            is_transient = isinstance(e, CommandTimeoutError) or (e.returncode is not None and e.returncode < 0)
+            if not is_transient or n > retries:
+                if verbose:
+                    logger.error("%s", e)
+                    logger.error("Output (%s): %s\n%s", log_file, "-" * 80, _get_log_tail(log_file))
+                raise
+            logger.warning("%s Retrying... (%d/%d)", e, n, retries)
+    log("Task succeeded: %s", task_name)
+    return result
+
+
+WORK_SPACE_FACTOR = 20  # space needed in the working directory, relative to the genome size (CheckM/prodigal outputs etc.)
+WORK_SPACE_MIN = 200 * 1024 * 1024
+
+
+def _get_filesystem_type(path):
+    """
+    Type of the file system (e.g. tmpfs) of the path, from /proc/mounts. None if unknown.
+    """
+    path = os.path.realpath(path)
+    fs_type, mount_point = None, ""
+    try:
+        with open("/proc/mounts") as f:
+            for line in f:
+                cols = line.split()
+                if len(cols) > 2 and (path == cols[1] or path.startswith(cols[1].rstrip("/") + "/")) and len(cols[1]) > len(mount_point):
+                    mount_point, fs_type = cols[1], cols[2]
+    except OSError:
+        pass
+    return fs_type
+
+
+_received_signal = None
+
+
+def _exit_on_signal(signum, frame):
+    # SystemExit unwinds the stack (run_command kills the running command), and then _exit_work_directory
+    # removes the working directory and delivers the signal again.
+    global _received_signal
+    _received_signal = signum
+    raise SystemExit(128 + signum)
+
+
+def _exit_work_directory():
+    """
+    atexit handler. If the process was stopped by a signal, it is killed by the same signal after the cleanup,
+    so that the parent (e.g. dqc_service) sees the termination by the signal rather than an exit status.
+    """
+    cleanup_work_directory()
+    if _received_signal is not None:
+        shutdown_logging()
+        signal.signal(_received_signal, signal.SIG_DFL)
+        os.kill(os.getpid(), _received_signal)
+
+
+def install_signal_handlers():
+    """
+    Exit via SystemExit on SIGTERM and SIGHUP. External commands run in their own process groups (see _run_once),
+    so they are not reached by a signal sent to the process group of dfast_qc. SystemExit lets run_command kill the
+    running command, and then the working directory is removed (see _exit_work_directory).
+    Called at startup of dfast_qc, wherever the working directory is (also in debug mode or when OUT_DIR is used).
+    """
+    atexit.register(_exit_work_directory)
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, _exit_on_signal)
+
+
+def prepare_work_directory():
+    """
+    Create the working directory for intermediate files (skani databases, CheckM input/output, ShigaPass output,
+    decompressed query) under config.TMP_DIR or $TMPDIR, so that they are not written to OUT_DIR.
+    It is removed when the process exits, including on failure, SIGTERM and SIGHUP (see install_signal_handlers).
+    If the space is not enough (e.g. small tmpfs), OUT_DIR is used instead. In debug mode, OUT_DIR is used to keep the files.
+    """
+    if config.DEBUG:
+        config.WORK_DIR = config.OUT_DIR
+        return config.WORK_DIR
+    tmp_dir = config.TMP_DIR or tempfile.gettempdir()
+    genome_size = os.path.getsize(config.QUERY_GENOME) * (4 if config.QUERY_GENOME.endswith(".gz") else 1)
+    required = max(genome_size * WORK_SPACE_FACTOR, WORK_SPACE_MIN)
+    try:
+        os.makedirs(tmp_dir, exist_ok=True)
+        free = shutil.disk_usage(tmp_dir).free
+    except OSError as e:
+        logger.warning("Cannot use the temporary directory %s. Intermediate files are written to %s. %s", tmp_dir, config.OUT_DIR, e)
+        config.WORK_DIR = config.OUT_DIR
+        return config.WORK_DIR
+    fs_type = _get_filesystem_type(tmp_dir)
+    if free < required:
+        logger.warning("Not enough space in the temporary directory %s%s (%d MB free, %d MB required). Intermediate files are written to %s.",
+                       tmp_dir, " (tmpfs)" if fs_type == "tmpfs" else "", free // 1024 ** 2, required // 1024 ** 2, config.OUT_DIR)
+        config.WORK_DIR = config.OUT_DIR
+        return config.WORK_DIR
+    config.WORK_DIR = tempfile.mkdtemp(prefix="dqc_", dir=tmp_dir)
+    if fs_type == "tmpfs":
+        logger.info("Working directory: %s (tmpfs, intermediate files use memory)", config.WORK_DIR)
+    else:
+        logger.info("Working directory: %s", config.WORK_DIR)
+    return config.WORK_DIR
+
+
+def cleanup_work_directory():
+    if config.WORK_DIR and config.WORK_DIR != config.OUT_DIR:
+        shutil.rmtree(config.WORK_DIR, ignore_errors=True)
+        logger.debug("Working directory was removed. %s", config.WORK_DIR)
+    config.WORK_DIR = None
+
+
+def tee_lines(lines, file_name):
+    """
+    Yield lines while writing them to a file (e.g. to keep the output of a tool in debug mode)
+    """
+    with open(file_name, "w") as f:
+        for line in lines:
+            f.write(line)
+            yield line
+
+
+def get_work_dir():
+    """
+    Directory for intermediate files. OUT_DIR if prepare_work_directory has not been called (e.g. admin tools)
+    """
+    return config.WORK_DIR or config.OUT_DIR
+
+
+def exit_on_command_error(exc_type, exc, tb):
+    """
+    sys.excepthook for the scripts. Aborts with an error message instead of a traceback if an external command fails.
+    """
+    if issubclass(exc_type, CommandError):
+        logger.error("%s Aborted. See %s for details.", exc, exc.log_file)
+    else:
+        sys.__excepthook__(exc_type, exc, tb)
 
 
 def prepare_output_directory():
@@ -76,6 +338,7 @@ def prepare_output_directory():
             config.SKANI_DATABASE_REF,
             config.SKANI_DATABASE_GTDB,
             config.SHIGAPASS_OUTPUT_DIR,
+            config.COMMAND_LOG_DIR,
         ]
         for dir_name in result_dir_names:
             dir_path = os.path.join(config.OUT_DIR, dir_name)
@@ -107,6 +370,9 @@ def is_empty_file(file_name):
             return False
 
 def get_ref_path(base_name):
+    if config.DQC_REFERENCE_ROOT and base_name.split(os.sep)[0] in config.SNAPSHOT_SHARED_ENTRIES:
+        # entries shared by all the reference snapshots (e.g. genomes) are placed in the root directory
+        return os.path.join(config.DQC_REFERENCE_ROOT, base_name)
     return os.path.join(config.DQC_REFERENCE_DIR, base_name)
 
 def get_gtdb_ref_genome_dir(accession):
@@ -134,6 +400,28 @@ def get_existing_gtdb_genomes():
             existing_genomes.append(accession)
     return existing_genomes
 
+@contextmanager
+def file_lock(lock_file):
+    """
+    Exclusive lock across processes using flock. Blocks until the lock is acquired.
+    The lock file is removed on release, so a waiter that acquired a lock on an already removed file tries again.
+    """
+    while True:
+        f = open(lock_file, "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            is_current = os.fstat(f.fileno()).st_ino == os.stat(lock_file).st_ino
+        except FileNotFoundError:
+            is_current = False
+        if is_current:
+            break
+        f.close()
+    try:
+        yield
+    finally:
+        os.remove(lock_file)
+        f.close()
+
 def fasta_reader(fasta_file_name):
     with open(fasta_file_name) as f:
         entries = f.read().strip(">").split("\n>")
@@ -145,6 +433,49 @@ def fasta_reader(fasta_file_name):
         D[seq_id] = seq
     return D
 
+class HashingReader:
+    """
+    File wrapper that computes a checksum (hashlib algorithm, e.g. md5, sha256) of the bytes read through it.
+    """
+    def __init__(self, f, algorithm="sha256"):
+        self.f = f
+        self.hash = hashlib.new(algorithm)
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.hash.update(data)
+        return data
+
+    def consume(self, chunk_size=1024 * 1024):
+        while self.read(chunk_size):
+            pass
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+def check_genome_file(file_name, chunk_size=1024 * 1024):
+    """
+    Check gzip integrity of a genome FASTA file and compute MD5 of the compressed file.
+    Returns (status, md5). status is one of OK, empty, not_fasta, broken_gzip
+    """
+    if os.path.getsize(file_name) == 0:
+        return "empty", None
+    with open(file_name, "rb") as f:
+        reader = HashingReader(f, "md5")
+        try:
+            with gzip.GzipFile(fileobj=reader) as f_gz:
+                first_chunk = f_gz.read(chunk_size)
+                if not first_chunk.lstrip().startswith(b">"):
+                    status = "not_fasta"
+                else:
+                    status = "OK"
+                while f_gz.read(chunk_size):
+                    pass
+        except (OSError, EOFError, zlib.error):
+            status = "broken_gzip"
+        reader.consume(chunk_size)  # hash trailing bytes not read by gzip
+    return status, reader.hexdigest()
+
 def get_ref_inf(as_str=False):
     dqc_ref_inf_json = get_ref_path(config.REFERENCE_INF)
     if os.path.exists(dqc_ref_inf_json):
@@ -158,6 +489,18 @@ def get_ref_inf(as_str=False):
     else:
         return dqc_ref_inf
 
+def update_ref_inf(new_values):
+    """
+    Merge values into dqc_ref_inf.json
+    """
+    dqc_ref_inf_json = get_ref_path(config.REFERENCE_INF)
+    dqc_ref_inf = get_ref_inf()
+    dqc_ref_inf.update(new_values)
+    tmp_file = dqc_ref_inf_json + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(dqc_ref_inf, f, indent=4)
+    os.replace(tmp_file, dqc_ref_inf_json)
+
 def safe_tar_extraction(target_tarfile, data_root):
     with tarfile.open(target_tarfile, "r:gz") as tar:
         def is_within_directory(directory, target):
@@ -3,7 +3,7 @@
 import os
 import shutil
 import gzip
-from .common import get_logger, run_command, get_ref_path
+from .common import get_logger, run_command, get_ref_path, get_work_dir
 from .ete3_helper import get_ascendants, get_names
 from .models import Taxon
 from .config import config
@@ -57,13 +57,14 @@ def parse_result(checkm_result_file):
 def run():
     input_file = config.QUERY_GENOME
     out_dir = config.OUT_DIR
+    work_dir = get_work_dir()  # for intermediate files
     if config.CHECKM_TAXID:
         checkm_taxid = config.CHECKM_TAXID
     else:
         checkm_taxid = 0
 
-    checkm_input_dir = os.path.join(out_dir, config.CHECKM_INPUT_DIR)
-    checkm_result_dir = os.path.join(out_dir, config.CHECKM_RESULT_DIR)
+    checkm_input_dir = os.path.join(work_dir, config.CHECKM_INPUT_DIR)
+    checkm_result_dir = os.path.join(work_dir, config.CHECKM_RESULT_DIR)
     checkm_result_file = os.path.join(out_dir, config.CC_RESULT)
 
     logger.info("===== Start completeness check using CheckM =====")
@@ -75,7 +76,7 @@ def run():
     prepare_checkm_genome(input_file, checkm_input_dir)
     cmd = [
         "checkm", "taxonomy_wf", "--tab_table", "-f", checkm_result_file, "-t", str(config.NUM_THREADS),
-        checkm_rank, f'"{checkm_taxon}"', checkm_input_dir, checkm_result_dir
+        checkm_rank, checkm_taxon, checkm_input_dir, checkm_result_dir
     ]
     run_command(cmd, task_name="CheckM")
     completeness, contamination, heterogeneity = parse_result(
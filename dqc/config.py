@@ -5,6 +5,8 @@ class DefaultConfig:
 
     QUERY_GENOME = None
     OUT_DIR = "OUT"
+    TMP_DIR = None  # directory where the working directory for intermediate files is created (--tmp_dir). Default: $TMPDIR
+    WORK_DIR = None  # working directory for intermediate files. Set by common.prepare_work_directory
     CHECKM_TAXID = None
     NUM_THREADS = 1
     LOG_FILE = "application.log"
@@ -21,7 +23,10 @@ class DefaultConfig:
     # Reference data
     DQC_REFERENCE_DIR = os.path.join(DQC_ROOT_DIR, "dqc_reference")
     MASH_SKETCH_FILE = "ref_genomes_sketch.msh"
+    MASH_SKETCH_CACHE_DIR = "mash_sketch_cache"  # per-genome sketches used to update MASH sketch files incrementally
+    MASH_SKETCH_SHARD_DIR = "ref_genomes_sketch_shards"  # optional. If exists, MASH is run against the shards in parallel.
     REFERENCE_INF = "dqc_ref_inf.json"
+    REFERENCE_MANIFEST = "dqc_ref_manifest.json"  # manifest of DQC_REFERENCE_COMPACT, used for delta updates
     REFERENCE_GENOME_DIR = "genomes"
     SQLITE_REFERENCE_DB = "references.db"
     REFERENCE_SUMMARY_TSV = "reference_summary.tsv"
@@ -34,9 +39,23 @@ class DefaultConfig:
     CHECKM_DATA_ROOT = "checkm_data"
     REFERENCE_GENOMES_TSV = "reference_genomes.tsv"
 
+    # Integrity verification of reference genomes (dqc_admin_tools.py verify_genomes)
+    GENOME_MANIFEST = "genome_manifest.tsv"
+    GENOME_QUARANTINE_DIR = "quarantine"
+    GENOME_REDOWNLOAD_QUEUE = "redownload_queue.tsv"
+
+    # Versioned reference snapshots (dqc_ref_manager.py snapshot)
+    DQC_REFERENCE_ROOT = None  # set to the original DQC_REFERENCE_DIR when a snapshot is pinned
+    SNAPSHOT_DIR = "snapshots"
+    CURRENT_SNAPSHOT_LINK = "current"
+    SNAPSHOT_LEASE_DIR = "leases"
+    SNAPSHOT_LEASE_TTL = 7 * 24 * 3600  # leases taken on other hosts are considered stale after this period (sec)
+    SNAPSHOT_SHARED_ENTRIES = [REFERENCE_GENOME_DIR, "gtdb_genomes_reps", MASH_SKETCH_CACHE_DIR, GENOME_QUARANTINE_DIR]
+
     # GTDB Reference data
     GTDB_GENOME_DIR = "gtdb_genomes_reps/database"  # Create a symlink to the directory containing GTDB representative genomes.
     GTDB_MASH_SKETCH_FILE = "gtdb_genomes_sketch.msh"
+    GTDB_MASH_SKETCH_SHARD_DIR = "gtdb_genomes_sketch_shards"  # optional. If exists, MASH is run against the shards in parallel.
     GTDB_SPECIES_LIST = "sp_clusters.tsv"
     GTDB_REFERENCE_SUMMARY_TSV = "reference_summary_gtdb.tsv"
 
@@ -66,6 +85,15 @@ class DefaultConfig:
     MASH_RESULT_REF = "mash_result_ref.tab"
     MASH_RESULT_GTDB = "mash_result_gtdb.tab"
     MASH_HITS_NUM_OPTION = 10
+    ADAPTIVE_HITS = False  # adaptive hit selection (--adaptive_hits). See calc_ani.run_adaptive
+    ADAPTIVE_DISTANCE_MARGIN = 0.01  # MASH distance from the best hit within which hits are used first (about 1% ANI)
+    ADAPTIVE_MAX_HITS = 40  # maximum number of hits when the candidates are expanded
+    MAX_HITS_PER_SPECIES = None  # cap of MASH hits per species (--max_hits_per_species). See select_target_genomes.cap_hits_per_species
+    MASH_HITS_POOL = 100  # MASH hits searched to be capped per species
+    TWO_PASS_ANI = False  # fast skani screen followed by precise ANI for close hits (--two_pass_ani). See calc_ani.run_two_pass
+    TWO_PASS_HITS = 30  # MASH hits screened with the fast preset
+    TWO_PASS_ANI_MARGIN = 2.0  # hits with fast ANI above (threshold - margin) are computed again with the default settings
+    FAST_SKANI_OPTIONS = ["--fast"]  # options of skani sketch for the screen
 
     # output file names and options for calc_ANI
     FASTANI_RESULT = "fastani_result.tsv"
@@ -86,8 +114,15 @@ class DefaultConfig:
     CHECKM_RESULT_DIR = "checkm_result"
     CC_RESULT = "cc_result.tsv"
 
+    # external commands (common.run_command)
+    COMMAND_LOG_DIR = "logs"  # standard error of each task is written to OUT_DIR/logs/<task_name>.log
+    COMMAND_TIMEOUTS = {"mash": 1800, "skani": 3600, "checkm": 14400, "bash": 7200}  # seconds. ShigaPass is run by bash
+    COMMAND_RETRIES = {"mash": 2}  # retries on timeout or abnormal termination. MASH sometimes hangs.
+
     # DQC result json
     DQC_RESULT_JSON = "dqc_result.json"
+    METRICS_TEXTFILE = None  # Prometheus textfile for performance metrics (--metrics_textfile)
+    RESULTS_DB = None  # SQLite results database the result is appended to (--results_db). See dqc/results_db.py
 
     # admin settings
     NCBI_FTP_SERVER = "https://ftp.ncbi.nlm.nih.gov/"
@@ -6,8 +6,9 @@ from urllib.error import HTTPError, URLError
 from http.client import RemoteDisconnected
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from more_itertools import distribute
-from .common import get_logger, get_ref_path, get_gtdb_ref_genome_dir
+from .common import get_logger, get_ref_path, get_gtdb_ref_genome_dir, file_lock, check_genome_file
 from .config import config
+from .models import Genome_Source
 
 logger = get_logger(__name__)
 
@@ -17,6 +18,11 @@ def download_genomes_from_assembly(accessions, out_dir=None, for_gtdb=False):
         return "/".join(["/genomes", "all", path1, path2, path3, path4])
 
     def _get_target_path(accession):
+        # Use the URL and MD5 prepared by 'dqc_admin_tools.py prepare_genome_sources' if available.
+        if use_genome_source and accession not in stale_sources:
+            source = Genome_Source.get_or_none(Genome_Source.accession == accession)
+            if source:
+                return source.url, source.md5
         base_dir = config.NCBI_FTP_SERVER + _get_base_directory(accession)
         acceesion_escaped = accession.replace(".", "\\.")
         pat_dir_name = re.compile(f'<a href="({acceesion_escaped}_.+?)/">')
@@ -56,6 +62,15 @@ def download_genomes_from_assembly(accessions, out_dir=None, for_gtdb=False):
             logger.warning(f"MD5 does not match. ({accession} Local={md5_local}, Remote={md5})")
             return False
 
+    def _check_gzip(file_name):
+        # Used when MD5 is not available for the remote file
+        status, _ = check_genome_file(file_name)
+        if status == "OK":
+            return True
+        else:
+            logger.warning(f"Downloaded file is broken. ({accession} Status={status})")
+            return False
+
     def delete_file_if_exists(file_name):
         if os.path.exists(file_name):
             os.remove(file_name)
@@ -65,7 +80,18 @@ def download_genomes_from_assembly(accessions, out_dir=None, for_gtdb=False):
         if for_gtdb:
             output_file = os.path.join(out_dir, accession + "_genomic.fna.gz")
         else:
-            output_file = os.path.join(out_dir, accession + ".fna.gz")            
+            output_file = os.path.join(out_dir, accession + ".fna.gz")
+        # Other processes (e.g. dfast_qc jobs sharing the reference directory) may try to download the same genome.
+        # The first process downloads it, and the others wait for it and reuse the file.
+        with file_lock(output_file + ".lock"):
+            if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
+                logger.info(f"{accession} has already been downloaded by another process.")
+                return "SUCCESS", output_file, "-"
+            return _fetch_genome(accession, output_file, max_retry=max_retry)
+
+    def _fetch_genome(accession, output_file, max_retry=3):
+        # download into a temporary file, then rename it to the final path when MD5 is confirmed.
+        tmp_file = f"{output_file}.{os.getpid()}.part"
         logger.debug(f"Downloading genomic FASTA file for {accession}")
         n_trial = 1
         while n_trial <= max_retry:
@@ -75,35 +101,43 @@ def download_genomes_from_assembly(accessions, out_dir=None, for_gtdb=False):
                 # check target file and MD5
                 target_url, md5 = _get_target_path(accession)
                 logger.debug(f"{accession}\tTargetURL={target_url} RemoteMD5={md5}")
-                if target_url and md5:
-                    urlretrieve(target_url, output_file)
-                    if _check_md5(output_file, md5):
+                if target_url:
+                    urlretrieve(target_url, tmp_file)
+                    if md5 is None:
+                        is_valid = _check_gzip(tmp_file)
+                    else:
+                        is_valid = _check_md5(tmp_file, md5)
+                    if is_valid:
+                        os.replace(tmp_file, output_file)
                         return "SUCCESS", output_file, target_url
                     else:
-                        delete_file_if_exists(output_file)
+                        delete_file_if_exists(tmp_file)
                         n_trial += 1
                 else:
                     logger.warning("Target file not found for %s", accession)
-                    delete_file_if_exists(output_file)
+                    delete_file_if_exists(tmp_file)
                     n_trial += 1
                     continue
             except HTTPError as e:
                 logger.error("%s", e)
-                delete_file_if_exists(output_file)
+                delete_file_if_exists(tmp_file)
+                stale_sources.add(accession)  # URL may be outdated. Will look up the directory listing in the next trial.
                 n_trial += 1
             except URLError as e:
                 logger.error("%s", e)
-                delete_file_if_exists(output_file)
+                delete_file_if_exists(tmp_file)
                 n_trial += 1
             except RemoteDisconnected as e:
                 logger.error("%s", e)
-                delete_file_if_exists(output_file)
+                delete_file_if_exists(tmp_file)
                 n_trial += 1
 
         logger.error(f"Failed to download the genome FASTA for {accession}")
         return "FAIL", "-", "-"
 
     # main part starts from here
+    use_genome_source = Genome_Source.table_exists()
+    stale_sources = set()
 
     if not for_gtdb:
         if out_dir is None:
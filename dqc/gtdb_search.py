@@ -1,9 +1,7 @@
 #!/bin/env python
 
-import os
-from .common import get_logger, is_empty_file
-from .select_target_genomes import main as select_target_genomes
-from .calc_ani import main as calc_ani
+from .common import get_logger, get_work_dir
+from .calc_ani import search_and_classify
 
 from .config import config
 
@@ -12,16 +10,12 @@ logger = get_logger(__name__)
 def run():
     input_file = config.QUERY_GENOME
     out_dir = config.OUT_DIR
+    work_dir = get_work_dir()  # for intermediate files
     num_hits = config.MASH_OPTION
     logger.info("===== Start GTDB Search =====")
-
-    target_genome_list_file = select_target_genomes(input_file, out_dir,num_hits,for_gtdb=True)
-
-    if is_empty_file(target_genome_list_file):
+    gtdb_result = search_and_classify(input_file, out_dir, num_hits, for_gtdb=True, work_dir=work_dir)
+    if not gtdb_result:
         logger.error("Task failed. No target genome found.")
-        gtdb_result = []
         return gtdb_result
-
-    gtdb_result = calc_ani(input_file, target_genome_list_file, out_dir, for_gtdb=True)
     logger.info("===== GTDB Search completed =====")
-    return gtdb_result
\ No newline at end of file
+    return gtdb_result
@@ -0,0 +1,145 @@
+import os
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+# Performance metrics of the current run. Stored in the 'metrics' section of dqc_result.json
+_lock = threading.Lock()
+_stages = []
+_commands = []
+_start = None
+
+
+def _get_io_bytes():
+    """
+    Returns (read_bytes, write_bytes) of this process and its terminated children.
+    Falls back to block counts of getrusage if /proc/self/io is not available.
+    """
+    try:
+        io_counters = {}
+        with open("/proc/self/io") as f:
+            for line in f:
+                key, value = line.split(":")
+                io_counters[key] = int(value)
+        return io_counters["read_bytes"], io_counters["write_bytes"]
+    except (OSError, KeyError, ValueError):
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read_blocks = usage_self.ru_inblock + usage_children.ru_inblock
+        write_blocks = usage_self.ru_oublock + usage_children.ru_oublock
+        return read_blocks * 512, write_blocks * 512
+
+
+def _snapshot():
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_bytes, write_bytes = _get_io_bytes()
+    return {
+        "wall": time.time(),
+        "cpu_self": usage_self.ru_utime + usage_self.ru_stime,
+        "cpu_children": usage_children.ru_utime + usage_children.ru_stime,
+        "max_rss_self": usage_self.ru_maxrss,
+        "max_rss_children": usage_children.ru_maxrss,
+        "read_bytes": read_bytes,
+        "write_bytes": write_bytes,
+    }
+
+
+def _diff(before, after):
+    """
+    CPU time and I/O are differences between the two snapshots. Peak RSS (KB) is the maximum so far,
+    as getrusage does not provide the peak within an interval.
+    """
+    return {
+        "wall_time": round(after["wall"] - before["wall"], 3),
+        "cpu_time": round(after["cpu_self"] - before["cpu_self"], 3),
+        "cpu_time_children": round(after["cpu_children"] - before["cpu_children"], 3),
+        "max_rss_kb": after["max_rss_self"],
+        "max_rss_children_kb": after["max_rss_children"],
+        "read_bytes": after["read_bytes"] - before["read_bytes"],
+        "write_bytes": after["write_bytes"] - before["write_bytes"],
+    }
+
+
+def start():
+    global _start
+    _start = _snapshot()
+
+
+@contextmanager
+def stage(name):
+    """
+    Measure a pipeline stage. e.g. with metrics.stage("taxonomy_check"): ...
+    """
+    before = _snapshot()
+    try:
+        yield
+    finally:
+        record = {"name": name}
+        record.update(_diff(before, _snapshot()))
+        with _lock:
+            _stages.append(record)
+
+
+@contextmanager
+def command(task_name, cmd):
+    """
+    Measure an external command. Called from common.run_command.
+    When commands are run in parallel threads, resource usage of concurrent commands is included.
+    """
+    before = _snapshot()
+    record = {"task_name": task_name, "command": cmd if isinstance(cmd, str) else " ".join(cmd)}
+    try:
+        yield record
+    finally:
+        record.update(_diff(before, _snapshot()))
+        with _lock:
+            _commands.append(record)
+
+
+def get_metrics():
+    metrics = {"stages": list(_stages), "commands": list(_commands)}
+    if _start:
+        metrics["total"] = _diff(_start, _snapshot())
+    return metrics
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_prometheus_textfile(metrics, out_file):
+    """
+    Write metrics in the Prometheus text format for the textfile collector of node-exporter.
+    Records with the same name are summed up (peak RSS is the maximum).
+    The file is replaced atomically, as the collector may read it at any time.
+    """
+    fields = [("wall_time", "wall_seconds", 1), ("cpu_time", "cpu_seconds", 1),
+              ("cpu_time_children", "children_cpu_seconds", 1), ("max_rss_kb", "max_rss_bytes", 1024),
+              ("max_rss_children_kb", "children_max_rss_bytes", 1024), ("read_bytes", "read_bytes", 1),
+              ("write_bytes", "write_bytes", 1)]
+    lines = []
+    for kind, records, label in [("stage", metrics["stages"], "name"), ("command", metrics["commands"], "task_name")]:
+        for field, metric_suffix, scale in fields:
+            metric_name = f"dfast_qc_{kind}_{metric_suffix}"
+            values = {}
+            for record in records:
+                key, value = record[label], record[field] * scale
+                if key in values:
+                    value = max(values[key], value) if field.startswith("max_rss") else values[key] + value
+                values[key] = value
+            lines.append(f"# TYPE {metric_name} gauge")
+            for key, value in values.items():
+                lines.append(f'{metric_name}{{{kind}="{_escape(key)}"}} {round(value, 3)}')
+    if "total" in metrics:
+        for field, metric_suffix, scale in fields:
+            metric_name = f"dfast_qc_run_{metric_suffix}"
+            lines.append(f"# TYPE {metric_name} gauge")
+            lines.append(f"{metric_name} {round(metrics['total'][field] * scale, 3)}")
+    lines.append("# TYPE dfast_qc_run_timestamp_seconds gauge")
+    lines.append(f"dfast_qc_run_timestamp_seconds {int(time.time())}")
+    tmp_file = f"{out_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_file, out_file)
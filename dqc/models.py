@@ -74,9 +74,21 @@ class Genome_Size(Model):
     def __str__(self):
         return f"<GenomeSize: {self.species_taxid}, {self.min_ungapped_length}-{self.max_ungapped_length}>"    
 
+class Genome_Source(Model):
+    # Download URL of genomic FASTA resolved from ftp_path in the assembly summary, and its MD5 (if available)
+    accession = CharField(primary_key=True)
+    url = CharField()
+    md5 = CharField(null=True)
+
+    class Meta:
+        database = db
+
+    def __str__(self):
+        return f"<GenomeSource: {self.accession}, {self.url}>"
+
 def init_db():
     db.connect()
-    db.create_tables([Reference, Taxon, GTDB_Reference])
+    db.create_tables([Reference, Taxon, GTDB_Reference, Genome_Source])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,848 @@
+import os
+import io
+import time
+import gzip
+import zlib
+import json
+import tarfile
+import shutil
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError, URLError
+from http.client import HTTPException
+from .common import get_logger, HashingReader
+
+logger = get_logger(__name__)
+
+BUNDLE_DIR_NAME = "dqc_reference_compact"
+GZIP_BLOCK_SIZE = 4 * 1024 * 1024
+# Content-defined chunking for delta updates (see ContentDefinedChunker). Average chunk size is about
+# CDC_MIN_SIZE + 2**CDC_MASK_BITS bytes.
+CDC_WINDOW = 64
+CDC_MIN_SIZE = 64 * 1024
+CDC_MASK_BITS = 18
+CDC_MAX_SIZE = 1024 * 1024
+CDC_BUFFER_SIZE = 16 * 1024 * 1024  # boundaries are searched in this unit
+# Random value of each byte for the rolling hash. Derived from SHA256, so it is the same for the server and clients.
+_CDC_TABLE = np.array([int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "little") for i in range(256)], dtype=np.uint32)
+
+
+def get_manifest_name(archive_name):
+    return archive_name.replace(".tar.gz", "") + ".manifest.json"
+
+
+class SplitFileWriter:
+    """
+    Write a byte stream into a single file, or into fixed-size parts (archive.tar.gz.000, 001, ...) if part_size > 0.
+    SHA256 is computed for each part and for the whole stream.
+    """
+    def __init__(self, out_file, part_size=0):
+        self.out_file = out_file
+        self.part_size = part_size
+        self.parts = []
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self._f = None
+
+    def _open_part(self):
+        if self.part_size > 0:
+            file_name = f"{self.out_file}.{len(self.parts):03d}"
+        else:
+            file_name = self.out_file
+        self._f = open(file_name + ".tmp", "wb")
+        self.parts.append({"name": os.path.basename(file_name), "size": 0, "sha256": hashlib.sha256()})
+
+    def _close_part(self):
+        part = self.parts[-1]
+        self._f.close()
+        file_name = os.path.join(os.path.dirname(self.out_file), part["name"])
+        os.replace(file_name + ".tmp", file_name)
+        part["sha256"] = part["sha256"].hexdigest()
+        self._f = None
+
+    def write(self, data):
+        self.size += len(data)
+        self.sha256.update(data)
+        view = memoryview(data)
+        while view:
+            if self._f is None:
+                self._open_part()
+            part = self.parts[-1]
+            n = len(view) if self.part_size <= 0 else min(len(view), self.part_size - part["size"])
+            self._f.write(view[:n])
+            part["sha256"].update(view[:n])
+            part["size"] += n
+            view = view[n:]
+            if self.part_size > 0 and part["size"] >= self.part_size:
+                self._close_part()
+        return len(data)
+
+    def close(self):
+        if self._f is None and not self.parts:
+            self._open_part()
+        if self._f is not None:
+            self._close_part()
+
+
+class ParallelGzipWriter:
+    """
+    File-like object that compresses data in blocks using multiple threads.
+    Each block is written as an independent gzip member, so the output can be read by gzip/tar as a normal .gz file.
+    """
+    def __init__(self, fileobj, num_threads=1, block_size=GZIP_BLOCK_SIZE, compresslevel=6):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.compresslevel = compresslevel
+        self.executor = ThreadPoolExecutor(max_workers=max(num_threads, 1), thread_name_prefix="gzip")
+        self.max_pending = max(num_threads, 1) * 2
+        self.pending = deque()
+        self.buffer = bytearray()
+
+    def _compress(self, block):
+        return gzip.compress(block, compresslevel=self.compresslevel, mtime=0)
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(self._compress, block))
+        while len(self.pending) >= self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def close(self):
+        if self.buffer or not self.pending:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+
+def get_chunking_params():
+    return {"window": CDC_WINDOW, "min_size": CDC_MIN_SIZE, "mask_bits": CDC_MASK_BITS, "max_size": CDC_MAX_SIZE}
+
+
+class ContentDefinedChunker:
+    """
+    Split a byte stream into variable-size chunks at content-defined boundaries. A boundary is placed after a byte
+    where the rolling hash of the last `window` bytes (sum of random values of the bytes) has its lowest `mask_bits`
+    bits set to 0, within min_size and max_size from the start of the chunk.
+    Because the boundaries depend only on the content, inserting or deleting bytes (e.g. a genome added to a mash
+    sketch) changes only the chunks around the edit, and the following chunks are found again at shifted offsets.
+    """
+    def __init__(self, window=CDC_WINDOW, min_size=CDC_MIN_SIZE, mask_bits=CDC_MASK_BITS, max_size=CDC_MAX_SIZE):
+        assert window < min_size <= max_size
+        self.window = window
+        self.min_size = min_size
+        self.mask = (1 << mask_bits) - 1
+        self.max_size = max_size
+        self.buffer = bytearray()
+
+    def _split(self, final=False):
+        """
+        Returns the chunks in the buffer, and keeps the last incomplete chunk in the buffer unless final is True.
+        The buffer always starts at a chunk boundary, so every window used for a boundary is within the buffer.
+        """
+        cumsum = np.cumsum(_CDC_TABLE[np.frombuffer(bytes(self.buffer), dtype=np.uint8)], dtype=np.uint32)
+        # hash of the window ending at i (i >= window). uint32 arithmetic wraps around.
+        hashes = cumsum[self.window:] - cumsum[:-self.window]
+        hits = np.flatnonzero((hashes & self.mask) == 0) + self.window + 1  # chunk end (exclusive) for each hit
+        chunks, start = [], 0
+        while True:
+            i = np.searchsorted(hits, start + self.min_size)
+            end = int(hits[i]) if i < hits.size else len(self.buffer) + 1
+            end = min(end, start + self.max_size)
+            if end > len(self.buffer):
+                if not final:
+                    break
+                end = len(self.buffer)
+            if end == start:
+                break
+            chunks.append(bytes(self.buffer[start:end]))
+            start = end
+        del self.buffer[:start]
+        return chunks
+
+    def feed(self, data):
+        """
+        Returns the list of chunks completed by data.
+        """
+        self.buffer.extend(data)
+        if len(self.buffer) < CDC_BUFFER_SIZE:
+            return []
+        return self._split()
+
+    def close(self):
+        return self._split(final=True) if self.buffer else []
+
+
+class _BlockHashingReader(HashingReader):
+    """
+    Computes SHA256 of every content-defined chunk (block) in addition to the whole file. Used for delta updates.
+    If objects_dir is specified, each block is also stored as a content-addressed object.
+    """
+    def __init__(self, f, objects_dir=None):
+        super().__init__(f)
+        self.objects_dir = objects_dir
+        self.chunker = ContentDefinedChunker(**get_chunking_params())
+        self.blocks = []
+
+    def _add_block(self, data):
+        block_hash = hashlib.sha256(data).hexdigest()
+        self.blocks.append(block_hash)
+        if self.objects_dir:
+            write_object(self.objects_dir, block_hash, data)
+
+    def read(self, size=-1):
+        data = super().read(size)
+        for block in self.chunker.feed(data):
+            self._add_block(block)
+        return data
+
+    def close(self):
+        for block in self.chunker.close():
+            self._add_block(block)
+
+
+def get_object_path(block_hash):
+    """
+    Path of a block object relative to the objects directory (published as 'objects' next to the tarball)
+    """
+    return f"{block_hash[:2]}/{block_hash}.gz"
+
+
+def write_object(objects_dir, block_hash, data):
+    object_file = os.path.join(objects_dir, get_object_path(block_hash))
+    if os.path.exists(object_file):
+        return
+    os.makedirs(os.path.dirname(object_file), exist_ok=True)
+    tmp_file = f"{object_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(gzip.compress(data, mtime=0))
+    os.replace(tmp_file, object_file)
+
+
+def _add_fileobj(tar, tarinfo, f, file_records, objects_dir):
+    reader = _BlockHashingReader(f, objects_dir)
+    tar.addfile(tarinfo, reader)
+    reader.close()
+    file_records.append({"path": tarinfo.name, "size": tarinfo.size, "sha256": reader.hexdigest(),
+                         "blocks": reader.blocks})
+
+
+def add_file(tar, file_name, arcname, file_records, objects_dir=None):
+    tarinfo = tar.gettarinfo(file_name, arcname)
+    if tarinfo.isfile():
+        with open(file_name, "rb") as f:
+            _add_fileobj(tar, tarinfo, f, file_records, objects_dir)
+    else:
+        tar.addfile(tarinfo)
+
+
+def add_tree(tar, dir_name, arcname, file_records, objects_dir=None):
+    for root, dirs, files in os.walk(dir_name):
+        dirs.sort()
+        rel_root = os.path.relpath(root, dir_name)
+        arc_root = arcname if rel_root == "." else os.path.join(arcname, rel_root)
+        tar.addfile(tar.gettarinfo(root, arc_root))
+        for file_name in sorted(files):
+            add_file(tar, os.path.join(root, file_name), os.path.join(arc_root, file_name), file_records, objects_dir)
+
+
+def add_bytes(tar, data, arcname, file_records, objects_dir=None):
+    tarinfo = tarfile.TarInfo(arcname)
+    tarinfo.size = len(data)
+    tarinfo.mtime = int(time.time())
+    _add_fileobj(tar, tarinfo, io.BytesIO(data), file_records, objects_dir)
+
+
+def write_bundle(out_file, files, dirs, extra_files=None, num_threads=1, part_size=0, metadata=None, objects_dir=None):
+    """
+    Stream reference files into a compressed tarball without making a staging copy.
+        files: list of (file_path, relative path in the bundle)
+        dirs: list of (directory_path, relative path in the bundle)
+        extra_files: dict of {relative path in the bundle: bytes}
+    Files are stored under 'dqc_reference_compact/'. A manifest (*.manifest.json) containing SHA256 of every file
+    (and of every block of the file) and of every part is written next to the archive.
+    If objects_dir is specified, the blocks are also stored as objects for delta updates.
+    """
+    file_records = []
+    writer = SplitFileWriter(out_file, part_size)
+    gz_writer = ParallelGzipWriter(writer, num_threads=num_threads)
+    with tarfile.open(fileobj=gz_writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        tarinfo = tarfile.TarInfo(BUNDLE_DIR_NAME)
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o755
+        tarinfo.mtime = int(time.time())
+        tar.addfile(tarinfo)
+        for file_name, rel_path in files:
+            logger.debug("Adding %s", file_name)
+            add_file(tar, file_name, os.path.join(BUNDLE_DIR_NAME, rel_path), file_records, objects_dir)
+        for dir_name, rel_path in dirs:
+            logger.info("Adding %s", dir_name)
+            add_tree(tar, dir_name, os.path.join(BUNDLE_DIR_NAME, rel_path), file_records, objects_dir)
+        for rel_path, data in (extra_files or {}).items():
+            add_bytes(tar, data, os.path.join(BUNDLE_DIR_NAME, rel_path), file_records, objects_dir)
+    gz_writer.close()
+    writer.close()
+
+    manifest = dict(metadata or {})
+    manifest.update({
+        "archive": os.path.basename(out_file),
+        "size": writer.size,
+        "sha256": writer.sha256.hexdigest(),
+        "parts": writer.parts if part_size > 0 else [],
+        "chunking": get_chunking_params(),
+        "files": file_records,
+    })
+    manifest_file = get_manifest_name(out_file)
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=4)
+    logger.info("Archived %d files into %s (%d bytes, %d parts)", len(file_records), out_file, writer.size, len(manifest["parts"]))
+    logger.info("Manifest was written to %s", manifest_file)
+    return manifest
+
+
+# ---- Download and extraction of DQC_REFERENCE_COMPACT ----
+
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+READ_BUFSIZE = 1024 * 1024
+MAX_RETRY = 3
+
+
+def is_within_directory(directory, target):
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
+    return os.path.commonpath([abs_directory, abs_target]) == abs_directory
+
+
+def check_member(member, path):
+    """
+    Path traversal check for a tar member. Raises an exception for an unsafe member.
+    """
+    member_path = os.path.join(path, member.name)
+    if not is_within_directory(path, member_path):
+        raise Exception("Attempted Path Traversal in Tar File")
+    if not (member.isreg() or member.isdir() or member.issym() or member.islnk()):
+        raise Exception(f"Unsupported member type in Tar File. [{member.name}]")
+    if member.issym():
+        link_path = os.path.join(os.path.dirname(member_path), member.linkname)
+    elif member.islnk():
+        link_path = os.path.join(path, member.linkname)
+    else:
+        return
+    if os.path.isabs(member.linkname) or not is_within_directory(path, link_path):
+        raise Exception("Attempted Path Traversal in Tar File")
+
+
+class GzipStreamReader:
+    """
+    Decompress a gzip stream consisting of one or more members (e.g. written by ParallelGzipWriter).
+    tarfile's stream mode ('r|gz') stops at the end of the first member, so decompression is done here.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = zlib.decompressobj(wbits=31)
+        self.buffer = bytearray()
+        self.in_member = False
+        self.eof = False
+
+    def _fill(self):
+        data = self.fileobj.read(READ_BUFSIZE)
+        if not data:
+            if self.in_member:
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+            self.eof = True
+            return
+        while data:
+            self.buffer.extend(self.decompressor.decompress(data))
+            self.in_member = not self.decompressor.eof
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.decompressor = zlib.decompressobj(wbits=31)
+            else:
+                data = b""
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self._fill()
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+
+def _extract_verified(tar, member, path, record):
+    """
+    Extract a regular file into a temporary file while computing SHA256. It is moved into place only if SHA256
+    matches the manifest record, so a corrupt or tampered file is never left in the destination.
+    """
+    out_file = os.path.join(path, member.name)
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    tmp_file = out_file + ".tmp"
+    sha256 = hashlib.sha256()
+    try:
+        with tar.extractfile(member) as f_in, open(tmp_file, "wb") as f_out:
+            while True:
+                data = f_in.read(READ_BUFSIZE)
+                if not data:
+                    break
+                sha256.update(data)
+                f_out.write(data)
+        if sha256.hexdigest() != record["sha256"]:
+            raise Exception(f"Checksum mismatch. [{member.name}, expected={record['sha256']}, actual={sha256.hexdigest()}]")
+        os.chmod(tmp_file, member.mode)
+        os.utime(tmp_file, (member.mtime, member.mtime))
+        os.replace(tmp_file, out_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def extract_stream(fileobj, path, file_records=None):
+    """
+    Extract a .tar.gz stream while it is being read. Each member is checked before extraction.
+    If file_records (files in the manifest) are given, each file must be listed in them and is verified by SHA256
+    before it is moved into place (see _extract_verified).
+    """
+    records = {record["path"]: record for record in file_records} if file_records is not None else None
+    num_members, extracted_files = 0, set()
+    with tarfile.open(fileobj=GzipStreamReader(fileobj), mode="r|") as tar:
+        for member in tar:
+            check_member(member, path)
+            if records is not None and member.isreg():
+                record = records.get(member.name)
+                if record is None:
+                    raise Exception(f"File not listed in the manifest. [{member.name}]")
+                if record["size"] != member.size:
+                    raise Exception(f"Size mismatch. [{member.name}, expected={record['size']}, actual={member.size}]")
+                _extract_verified(tar, member, path, record)
+                extracted_files.add(member.name)
+            else:
+                tar.extract(member, path)
+            num_members += 1
+    if records is not None:
+        missing_files = set(records) - extracted_files
+        if missing_files:
+            raise Exception(f"{len(missing_files)} files in the manifest are missing in the archive. [{sorted(missing_files)[0]}, ...]")
+    return num_members
+
+
+def _request(url, headers=None, method=None):
+    return urlopen(Request(url, headers=headers or {}, method=method), timeout=60)
+
+
+def probe_url(url):
+    """
+    Returns (size, etag, accept_ranges) of the remote file.
+    """
+    with _request(url, method="HEAD") as resp:
+        size = resp.headers.get("Content-Length")
+        etag = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+        accept_ranges = resp.headers.get("Accept-Ranges", "").lower() == "bytes"
+    return (int(size) if size else None), etag, accept_ranges
+
+
+def fetch_manifest(url):
+    """
+    Returns the manifest (*.manifest.json) published next to the archive, or None if not available.
+    """
+    manifest_url = get_manifest_name(url)
+    try:
+        with _request(manifest_url) as resp:
+            return json.loads(resp.read())
+    except (HTTPError, URLError, ValueError) as e:
+        logger.debug("Manifest is not available. [%s] %s", manifest_url, e)
+        return None
+
+
+class RangeNotSupportedError(Exception):
+    """
+    The server did not answer a range request with 206 Partial Content. Not retried.
+    """
+    pass
+
+
+class RangeDownloader:
+    """
+    Download a file in parallel byte ranges into a part file. Completed chunks are recorded in a state file,
+    so an interrupted download can be resumed. Downloaded data can be read in order via read() while the
+    remaining chunks are being downloaded.
+    """
+    def __init__(self, url, part_file, size, etag, num_threads=4, chunk_size=DOWNLOAD_CHUNK_SIZE):
+        self.url = url
+        self.part_file = part_file
+        self.state_file = part_file + ".json"
+        self.size = size
+        self.etag = etag
+        self.num_threads = max(num_threads, 1)
+        self.chunk_size = chunk_size
+        self.num_chunks = (size + chunk_size - 1) // chunk_size
+        self.completed = self._load_state()
+        self.cond = threading.Condition()
+        self.error = None
+        self.offset = 0
+        self.sha256 = hashlib.sha256()
+
+    def _load_state(self):
+        if os.path.exists(self.state_file) and os.path.exists(self.part_file):
+            with open(self.state_file) as f:
+                state = json.load(f)
+            if state.get("url") == self.url and state.get("size") == self.size and state.get("etag") == self.etag \
+                    and state.get("chunk_size") == self.chunk_size:
+                return set(state["completed"])
+            logger.info("Remote file has been changed. Discarding the partially downloaded file.")
+        with open(self.part_file, "wb") as f:
+            f.truncate(self.size)
+        return set()
+
+    def _save_state(self):
+        state = {"url": self.url, "size": self.size, "etag": self.etag, "chunk_size": self.chunk_size,
+                 "completed": sorted(self.completed)}
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_file, self.state_file)
+
+    def _fetch_chunk(self, fd, i):
+        start = i * self.chunk_size
+        end = min(start + self.chunk_size, self.size) - 1
+        for n in range(1, MAX_RETRY + 1):
+            if self.error:
+                return
+            try:
+                with _request(self.url, headers={"Range": f"bytes={start}-{end}"}) as resp:
+                    if resp.status != 206:
+                        raise RangeNotSupportedError(f"Range request is not supported. [status={resp.status}]")
+                    offset = start
+                    while True:
+                        data = resp.read(READ_BUFSIZE)
+                        if not data:
+                            break
+                        os.pwrite(fd, data, offset)
+                        offset += len(data)
+                if offset != end + 1:
+                    raise URLError(f"Incomplete chunk. [{offset - start}/{end - start + 1} bytes]")
+                break
+            except (HTTPError, URLError, OSError, HTTPException) as e:  # e.g. IncompleteRead if the connection is closed
+                logger.warning("Failed to download bytes %d-%d (%d/%d). [%s]", start, end, n, MAX_RETRY, e)
+                if n == MAX_RETRY:
+                    raise
+        with self.cond:
+            self.completed.add(i)
+            self._save_state()
+            self.cond.notify_all()
+
+    def _download(self):
+        fd = os.open(self.part_file, os.O_WRONLY)
+        try:
+            pending = [i for i in range(self.num_chunks) if i not in self.completed]
+            logger.info("Downloading %d bytes in %d chunks using %d connections. (already downloaded: %d chunks)",
+                        self.size, len(pending), self.num_threads, self.num_chunks - len(pending))
+            with ThreadPoolExecutor(max_workers=self.num_threads, thread_name_prefix="download") as executor:
+                futures = [executor.submit(self._fetch_chunk, fd, i) for i in pending]
+                for future in futures:
+                    future.result()
+        except Exception as e:
+            self.error = e
+        finally:
+            os.close(fd)
+            with self.cond:
+                self.cond.notify_all()
+
+    def start(self):
+        self.thread = threading.Thread(target=self._download, daemon=True)
+        self.thread.start()
+        return self
+
+    def read(self, size=-1):
+        if self.offset >= self.size:
+            return b""
+        i = self.offset // self.chunk_size
+        with self.cond:
+            while i not in self.completed:
+                if self.error:
+                    raise self.error
+                self.cond.wait()
+        chunk_end = min((i + 1) * self.chunk_size, self.size)
+        size = chunk_end - self.offset if size < 0 else min(size, chunk_end - self.offset)
+        with open(self.part_file, "rb") as f:
+            f.seek(self.offset)
+            data = f.read(size)
+        self.offset += len(data)
+        self.sha256.update(data)
+        return data
+
+    def finish(self):
+        """
+        Wait for the download to complete (e.g. trailing bytes not read by tar), and return SHA256 of the file.
+        """
+        while self.read(READ_BUFSIZE):
+            pass
+        self.thread.join()
+        if self.error:
+            raise self.error
+        return self.sha256.hexdigest()
+
+    def cleanup(self):
+        for file_name in [self.part_file, self.state_file]:
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+
+class _StreamReader(HashingReader):
+    """
+    Reader for a server without range support. Data is extracted directly from the HTTP response.
+    """
+    def finish(self):
+        self.consume(READ_BUFSIZE)
+        return self.hexdigest()
+
+
+def _open_reader(url, work_dir, num_threads):
+    """
+    Returns (reader, downloader, response) to read a remote file as a stream. If the server supports range requests,
+    the file is downloaded in parallel byte ranges and the download can be resumed from the partially downloaded
+    file in work_dir (downloader). Otherwise, the file is read from a single response.
+    """
+    size, etag, accept_ranges = probe_url(url)
+    if accept_ranges and size:
+        part_file = os.path.join(work_dir, os.path.basename(url) + ".part")
+        downloader = RangeDownloader(url, part_file, size, etag, num_threads=num_threads).start()
+        return downloader, downloader, None
+    logger.info("Range requests are not supported by the server. Downloading in a single stream.")
+    resp = _request(url)
+    return _StreamReader(resp), None, resp
+
+
+class SplitArchiveReader:
+    """
+    Read the parts of a split archive ('dump --split_size') listed in the manifest, in order as a single stream.
+    The parts are resolved relative to base_url, and each part is verified by SHA256 when it has been read.
+    """
+    def __init__(self, base_url, parts, work_dir=".", num_threads=4):
+        self.base_url = base_url
+        self.parts = parts
+        self.work_dir = work_dir
+        self.num_threads = num_threads
+        self.index = 0
+        self.current = None  # (reader, downloader, response) of the current part
+        self.sha256 = hashlib.sha256()
+
+    def _close_part(self, verify=True):
+        reader, downloader, resp = self.current
+        self.current = None
+        try:
+            if verify:
+                part = self.parts[self.index]
+                sha256 = reader.finish()
+                if sha256 != part["sha256"]:
+                    raise Exception(f"Checksum mismatch. [{part['name']}, expected={part['sha256']}, actual={sha256}]")
+                logger.info("Downloaded part %d/%d. [%s]", self.index + 1, len(self.parts), part["name"])
+                self.index += 1
+                if downloader:
+                    downloader.cleanup()
+        finally:
+            if resp:
+                resp.close()
+
+    def read(self, size=-1):
+        while self.index < len(self.parts):
+            if self.current is None:
+                self.current = _open_reader(self.base_url + "/" + self.parts[self.index]["name"], self.work_dir, self.num_threads)
+            data = self.current[0].read(size)
+            if data:
+                self.sha256.update(data)
+                return data
+            self._close_part()
+        return b""
+
+    def finish(self):
+        while self.read(READ_BUFSIZE):
+            pass
+        return self.sha256.hexdigest()
+
+    def close(self):
+        if self.current is not None:
+            self._close_part(verify=False)
+
+
+def download_and_extract(url, dest_dir, work_dir=".", num_threads=4, manifest=None):
+    """
+    Download a .tar.gz bundle and extract it into dest_dir as data arrives.
+    If the server supports range requests, the file is downloaded in parallel byte ranges and the download can be
+    resumed from the partially downloaded file in work_dir. Otherwise, the file is downloaded in a single stream.
+    If the manifest lists parts (split archive), the parts published next to the manifest are read in order instead.
+    If a manifest is published with the bundle, each file is verified by SHA256 while it is extracted
+    (see extract_stream), and SHA256 of the downloaded file is verified at the end.
+    """
+    if manifest is None:
+        manifest = fetch_manifest(url)
+    if manifest and manifest.get("parts"):
+        logger.info("Downloading %d parts of the split archive.", len(manifest["parts"]))
+        reader = SplitArchiveReader(url.rsplit("/", 1)[0], manifest["parts"], work_dir=work_dir, num_threads=num_threads)
+        downloader, resp = None, None
+    else:
+        reader, downloader, resp = _open_reader(url, work_dir, num_threads)
+    try:
+        num_members = extract_stream(reader, dest_dir, file_records=manifest.get("files") if manifest else None)
+        sha256 = reader.finish()
+    finally:
+        if resp:
+            resp.close()
+        if isinstance(reader, SplitArchiveReader):
+            reader.close()
+    logger.info("Extracted %d files into %s", num_members, dest_dir)
+    if manifest and manifest.get("sha256"):
+        if manifest["sha256"] != sha256:
+            if downloader:
+                downloader.cleanup()
+            raise Exception(f"Checksum mismatch. [expected={manifest['sha256']}, actual={sha256}]")
+        logger.info("Checksum verified. [sha256=%s]", sha256)
+    if downloader:
+        downloader.cleanup()
+    return num_members
+
+
+# ---- Delta update of DQC_REFERENCE_COMPACT ----
+
+def is_delta_available(manifest):
+    return bool(manifest) and "chunking" in manifest and all("blocks" in record for record in manifest["files"])
+
+
+def index_local_blocks(file_name, chunking):
+    """
+    Returns SHA256 of a local file and {block_hash: (offset, size)} of its blocks (content-defined chunks).
+    """
+    sha256, block_index, offset = hashlib.sha256(), {}, 0
+    chunker = ContentDefinedChunker(**chunking)
+    with open(file_name, "rb") as f:
+        while True:
+            data = f.read(READ_BUFSIZE)
+            blocks = chunker.feed(data) if data else chunker.close()
+            for block in blocks:
+                sha256.update(block)
+                block_index.setdefault(hashlib.sha256(block).hexdigest(), (offset, len(block)))
+                offset += len(block)
+            if not data:
+                break
+    return sha256.hexdigest(), block_index
+
+
+def fetch_object(base_url, block_hash, objects_dir):
+    """
+    Download a block object and store it (uncompressed) in objects_dir. Returns the number of downloaded bytes.
+    """
+    object_url = base_url.rstrip("/") + "/objects/" + get_object_path(block_hash)
+    for n in range(1, MAX_RETRY + 1):
+        try:
+            with _request(object_url) as resp:
+                compressed = resp.read()
+            data = gzip.decompress(compressed)
+            if hashlib.sha256(data).hexdigest() != block_hash:
+                raise ValueError(f"Checksum mismatch. [{object_url}]")
+            break
+        except (HTTPError, URLError, OSError, HTTPException, ValueError) as e:
+            logger.warning("Failed to download %s (%d/%d). [%s]", object_url, n, MAX_RETRY, e)
+            if n == MAX_RETRY:
+                raise
+    with open(os.path.join(objects_dir, block_hash), "wb") as f:
+        f.write(data)
+    return len(compressed)
+
+
+def _rebuild_file(record, local_file, block_index, objects_dir, tmp_file):
+    """
+    Rebuild a file of the new version into tmp_file from the blocks of local_file and downloaded blocks, and verify it.
+    """
+    os.makedirs(os.path.dirname(local_file), exist_ok=True)
+    sha256 = hashlib.sha256()
+    with open(tmp_file, "wb") as f_out:
+        f_local = open(local_file, "rb") if block_index else None
+        try:
+            for block_hash in record["blocks"]:
+                if block_hash in block_index:
+                    offset, size = block_index[block_hash]
+                    f_local.seek(offset)
+                    data = f_local.read(size)
+                else:
+                    with open(os.path.join(objects_dir, block_hash), "rb") as f_obj:
+                        data = f_obj.read()
+                sha256.update(data)
+                f_out.write(data)
+        finally:
+            if f_local:
+                f_local.close()
+    if sha256.hexdigest() != record["sha256"]:
+        raise Exception(f"Checksum mismatch. [{record['path']}]")
+
+
+def delta_update(manifest, base_url, ref_dir, local_manifest=None, num_threads=4):
+    """
+    Update the reference directory to the version of the manifest, by downloading only the blocks that are not
+    found in the local files. Files listed in the local manifest but not in the new one are deleted.
+    Changed files are first rebuilt into staging files, and replaced only after all of them have been verified,
+    so a failure leaves the reference directory at the previous version.
+    Returns (number of updated files, number of downloaded bytes)
+    """
+    chunking = manifest["chunking"]
+    prefix = BUNDLE_DIR_NAME + "/"
+    objects_dir = os.path.join(ref_dir, ".delta_objects")
+
+    # Compare local files with the manifest
+    plans, missing_blocks = [], set()
+    for record in manifest["files"]:
+        rel_path = record["path"][len(prefix):]
+        local_file = os.path.join(ref_dir, rel_path)
+        if not record["path"].startswith(prefix) or not is_within_directory(ref_dir, local_file):
+            raise Exception("Attempted Path Traversal in Manifest")
+        if os.path.isfile(local_file):
+            local_sha256, block_index = index_local_blocks(local_file, chunking)
+            if local_sha256 == record["sha256"]:
+                continue
+        else:
+            block_index = {}
+        missing_blocks |= set([block_hash for block_hash in record["blocks"] if block_hash not in block_index])
+        plans.append((record, local_file, block_index))
+    logger.info("Files to be updated: %d/%d, blocks to be downloaded: %d", len(plans), len(manifest["files"]), len(missing_blocks))
+
+    staged_files = []
+    try:
+        # Download missing blocks
+        os.makedirs(objects_dir, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(num_threads, 1), thread_name_prefix="download") as executor:
+            downloaded_bytes = sum(executor.map(lambda block_hash: fetch_object(base_url, block_hash, objects_dir), sorted(missing_blocks)))
+
+        # Rebuild and verify all changed files before replacing any of them
+        for record, local_file, block_index in plans:
+            logger.info("Rebuilding %s", local_file)
+            tmp_file = local_file + ".delta.tmp"
+            staged_files.append((tmp_file, local_file))
+            _rebuild_file(record, local_file, block_index, objects_dir, tmp_file)
+        for tmp_file, local_file in staged_files:
+            os.replace(tmp_file, local_file)
+        staged_files = []
+    finally:
+        for tmp_file, _ in staged_files:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        if os.path.exists(objects_dir):
+            shutil.rmtree(objects_dir)
+
+    # Delete files removed in the new version
+    new_paths = set([record["path"] for record in manifest["files"]])
+    for record in (local_manifest or {}).get("files", []):
+        local_file = os.path.join(ref_dir, record["path"][len(prefix):])
+        if record["path"] not in new_paths and is_within_directory(ref_dir, local_file) and os.path.isfile(local_file):
+            logger.info("Deleting %s", local_file)
+            os.remove(local_file)
+    return len(plans), downloaded_bytes
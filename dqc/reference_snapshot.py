@@ -0,0 +1,208 @@
+# Versioned reference snapshots
+#
+# DQC_REFERENCE_DIR/
+#     current -> snapshots/2026-02-01    (symlink, switched atomically)
+#     snapshots/2026-01-01/              (immutable reference data)
+#     snapshots/2026-02-01/
+#     leases/2026-01-01/<host>_<pid>     (snapshots in use by running jobs)
+#     genomes/                           (entries shared by all the snapshots. See get_ref_path)
+import os
+import time
+import shutil
+import socket
+import atexit
+from .common import get_logger
+from .config import config
+
+logger = get_logger(__name__)
+
+
+def get_infra_entries():
+    return [config.SNAPSHOT_DIR, config.CURRENT_SNAPSHOT_LINK, config.SNAPSHOT_LEASE_DIR]
+
+
+def is_snapshot_layout(root):
+    return os.path.islink(os.path.join(root, config.CURRENT_SNAPSHOT_LINK))
+
+
+def get_current_snapshot(root):
+    """
+    Returns the absolute path of the current snapshot, or None if the directory does not use snapshots.
+    """
+    if not is_snapshot_layout(root):
+        return None
+    return os.path.realpath(os.path.join(root, config.CURRENT_SNAPSHOT_LINK))
+
+
+def list_snapshots(root):
+    snapshot_root = os.path.join(root, config.SNAPSHOT_DIR)
+    if not os.path.exists(snapshot_root):
+        return []
+    return sorted([name for name in os.listdir(snapshot_root)
+                   if not name.startswith(".") and os.path.isdir(os.path.join(snapshot_root, name))])
+
+
+def _copy_tree(src_dir, dest_dir, exclude=(), copy=False):
+    """
+    Copy files by hard links (or by copying if copy=True or hard links are not available).
+    Hard links are safe only if the source files are never modified in place.
+    """
+    for name in os.listdir(src_dir):
+        if name in exclude or name.startswith("tmp_"):
+            continue
+        src = os.path.join(src_dir, name)
+        dest = os.path.join(dest_dir, name)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dest)
+        elif os.path.isdir(src):
+            os.makedirs(dest)
+            _copy_tree(src, dest, copy=copy)
+        elif copy:
+            shutil.copy2(src, dest)
+        else:
+            try:
+                os.link(src, dest)
+            except OSError:
+                shutil.copy2(src, dest)
+
+
+def new_snapshot_dir(root, base_dir=None, copy=False):
+    """
+    Create a temporary directory for a new snapshot. If base_dir is specified, its reference files are copied into it.
+    The directory must be passed to commit_snapshot() to be published.
+    """
+    snapshot_root = os.path.join(root, config.SNAPSHOT_DIR)
+    tmp_dir = os.path.join(snapshot_root, f".tmp_{os.getpid()}_{int(time.time())}")
+    os.makedirs(tmp_dir)
+    if base_dir:
+        logger.info("Preparing a new snapshot from %s", base_dir)
+        _copy_tree(base_dir, tmp_dir, exclude=get_infra_entries() + config.SNAPSHOT_SHARED_ENTRIES, copy=copy)
+    return tmp_dir
+
+
+def activate_snapshot(root, snapshot_dir):
+    """
+    Switch the current snapshot atomically. Jobs started afterwards use the new snapshot.
+    """
+    link_file = os.path.join(root, config.CURRENT_SNAPSHOT_LINK)
+    tmp_link = f"{link_file}.{os.getpid()}.tmp"
+    target = os.path.relpath(snapshot_dir, root)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link_file)
+    logger.info("Current snapshot was switched to %s", target)
+
+
+def commit_snapshot(root, tmp_dir, version):
+    """
+    Publish the temporary snapshot directory as snapshots/<version> and make it current.
+    """
+    snapshot_root = os.path.join(root, config.SNAPSHOT_DIR)
+    name, n = version, 1
+    while os.path.exists(os.path.join(snapshot_root, name)):
+        name, n = f"{version}_{n}", n + 1
+    for entry in config.SNAPSHOT_SHARED_ENTRIES:
+        src = os.path.join(tmp_dir, entry)
+        if os.path.lexists(src):
+            shared_dir = os.path.join(root, entry)
+            if os.path.lexists(shared_dir):
+                logger.warning("'%s' is ignored. Shared data in %s is used.", src, shared_dir)
+                if os.path.isdir(src) and not os.path.islink(src):
+                    shutil.rmtree(src)
+                else:
+                    os.remove(src)
+            else:
+                shutil.move(src, shared_dir)
+    snapshot_dir = os.path.join(snapshot_root, name)
+    os.rename(tmp_dir, snapshot_dir)
+    logger.info("Created snapshot %s", snapshot_dir)
+    activate_snapshot(root, snapshot_dir)
+    return snapshot_dir
+
+
+def discard_snapshot_dir(tmp_dir):
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+
+def _is_lease_alive(lease_file):
+    host, _, pid = os.path.basename(lease_file).rpartition("_")
+    if host == socket.gethostname():
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except (PermissionError, ValueError):
+            pass
+        return True
+    try:
+        return time.time() - os.path.getmtime(lease_file) < config.SNAPSHOT_LEASE_TTL
+    except FileNotFoundError:
+        return False
+
+
+def get_live_leases(root, name):
+    lease_dir = os.path.join(root, config.SNAPSHOT_LEASE_DIR, name)
+    if not os.path.exists(lease_dir):
+        return []
+    return [lease for lease in os.listdir(lease_dir) if _is_lease_alive(os.path.join(lease_dir, lease))]
+
+
+def pin_snapshot():
+    """
+    Resolve the current snapshot at the start of a job and keep using it until the job finishes, even if the current
+    snapshot is switched in the meantime. config.DQC_REFERENCE_DIR is set to the snapshot directory.
+    """
+    root = config.DQC_REFERENCE_DIR
+    if not is_snapshot_layout(root):
+        return None
+    while True:
+        snapshot_dir = get_current_snapshot(root)
+        name = os.path.basename(snapshot_dir)
+        lease_dir = os.path.join(root, config.SNAPSHOT_LEASE_DIR, name)
+        os.makedirs(lease_dir, exist_ok=True)
+        lease_file = os.path.join(lease_dir, f"{socket.gethostname()}_{os.getpid()}")
+        open(lease_file, "w").close()
+        # The snapshot might have been garbage-collected before the lease was taken.
+        if os.path.isdir(snapshot_dir):
+            break
+        os.remove(lease_file)
+    atexit.register(release_snapshot, lease_file)
+    config.DQC_REFERENCE_ROOT = root
+    config.DQC_REFERENCE_DIR = snapshot_dir
+    return snapshot_dir
+
+
+def release_snapshot(lease_file):
+    if os.path.exists(lease_file):
+        os.remove(lease_file)
+
+
+def gc_snapshots(root):
+    """
+    Delete snapshots that are neither current nor in use by running jobs.
+    """
+    current = get_current_snapshot(root)
+    snapshot_root = os.path.join(root, config.SNAPSHOT_DIR)
+    removed = []
+    for name in list_snapshots(root):
+        snapshot_dir = os.path.join(snapshot_root, name)
+        if os.path.realpath(snapshot_dir) == current or get_live_leases(root, name):
+            continue
+        trash_dir = os.path.join(snapshot_root, f".gc_{name}")
+        os.rename(snapshot_dir, trash_dir)
+        # A job may have taken a lease while renaming. If so, the snapshot is restored.
+        if get_live_leases(root, name):
+            os.rename(trash_dir, snapshot_dir)
+            continue
+        shutil.rmtree(trash_dir)
+        lease_dir = os.path.join(root, config.SNAPSHOT_LEASE_DIR, name)
+        if os.path.exists(lease_dir):
+            shutil.rmtree(lease_dir)
+        logger.info("Deleted unused snapshot %s", name)
+        removed.append(name)
+    # temporary directories left by interrupted updates
+    for name in os.listdir(snapshot_root) if os.path.exists(snapshot_root) else []:
+        tmp_dir = os.path.join(snapshot_root, name)
+        if name.startswith(".tmp_") and time.time() - os.path.getmtime(tmp_dir) > config.SNAPSHOT_LEASE_TTL:
+            shutil.rmtree(tmp_dir)
+    return removed
@@ -0,0 +1,307 @@
+"""
+Results warehouse: append-only SQLite database of DFAST_QC results (dfast_qc --results_db, dqc_results.py)
+
+One Run row is inserted for each dqc_result.json with its summary (top hit, completeness, GTDB species, ...),
+and TCHit rows for all the ANI hits. Runs are never updated. Re-running a genome adds another Run.
+The database is opened in WAL mode, so that parallel jobs (e.g. dqc_multi) can write into it while it is queried.
+WAL mode requires a local file system; do not place the database on NFS.
+"""
+import os
+import json
+import socket
+import statistics
+from datetime import datetime
+from peewee import (Model, SqliteDatabase, AutoField, CharField, IntegerField, FloatField, DateTimeField, TextField,
+                    ForeignKeyField, IntegrityError, fn)
+from .common import get_logger, get_ref_inf
+from .config import config
+from . import dqc_version
+
+logger = get_logger(__name__)
+
+db = SqliteDatabase(None)
+
+
+class BaseModel(Model):
+    class Meta:
+        database = db
+
+
+class Run(BaseModel):
+    id = AutoField()
+    source = CharField(unique=True)  # <path of dqc_result.json>:<mtime_ns>. Prevents importing the same result twice
+    query = CharField(index=True)  # base name of the input FASTA
+    input_fasta = CharField(null=True)
+    out_dir = CharField()
+    completed_at = DateTimeField(index=True)
+    host = CharField(null=True)
+    dqc_version = CharField(null=True)
+    ref_version = CharField(null=True)
+    tc_status = CharField(null=True)
+    organism_name = CharField(null=True)
+    species_taxid = IntegerField(null=True)
+    accession = CharField(null=True)
+    ani = FloatField(null=True)
+    completeness = FloatField(null=True)
+    contamination = FloatField(null=True)
+    strain_heterogeneity = FloatField(null=True)
+    ungapped_genome_size = IntegerField(null=True)
+    genome_size_check = CharField(null=True)
+    gtdb_species = CharField(null=True, index=True)
+    gtdb_ani = FloatField(null=True)
+    gtdb_status = CharField(null=True)
+    shigapass_serotype = CharField(null=True)
+    wall_time = FloatField(null=True)
+    cpu_time = FloatField(null=True)
+    result_json = TextField()  # dqc_result.json without metrics
+
+    class Meta:
+        indexes = (
+            (("tc_status", "completed_at"), False),
+            (("species_taxid", "completed_at"), False),
+        )
+
+
+class TCHit(BaseModel):
+    run = ForeignKeyField(Run, backref="hits", on_delete="CASCADE")
+    rank = IntegerField()
+    accession = CharField(index=True)
+    organism_name = CharField()
+    species_taxid = IntegerField(null=True, index=True)
+    ani = FloatField()
+    align_fraction_ref = FloatField(null=True)
+    align_fraction_query = FloatField(null=True)
+    ani_threshold = FloatField(null=True)
+    status = CharField()
+
+
+def open_db(db_file):
+    """
+    Open (and create if not exists) the results database. Concurrent writers wait for the lock up to 60 seconds.
+    """
+    if not db.is_closed():
+        db.close()
+    db.init(db_file, pragmas={"journal_mode": "wal", "busy_timeout": 60000, "foreign_keys": 1, "synchronous": "normal"})
+    db.connect()
+    db.create_tables([Run, TCHit])
+    return db
+
+
+def _int_or_none(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _float_or_none(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_source_key(result_file):
+    return f"{os.path.abspath(result_file)}:{os.stat(result_file).st_mtime_ns}"
+
+
+def insert_result(dqc_result, result_file, input_fasta=None, dqc_version=None, ref_version=None, host=None):
+    """
+    Insert a result (content of dqc_result.json). Returns the Run, or None if the same file has already been inserted.
+    The database must be opened by open_db().
+    """
+    tc_result = dqc_result.get("tc_result") or []
+    cc_result = dqc_result.get("cc_result") or {}
+    gtdb_result = dqc_result.get("gtdb_result") or []
+    shigapass_result = dqc_result.get("shigapass_result") or {}
+    total = (dqc_result.get("metrics") or {}).get("total", {})
+    top_hit = tc_result[0] if tc_result else {}
+    gtdb_hit = gtdb_result[0] if gtdb_result else {}
+    out_dir = os.path.dirname(os.path.abspath(result_file))
+    query = os.path.basename(input_fasta) if input_fasta else os.path.basename(out_dir)
+    completed_at = datetime.fromtimestamp(os.path.getmtime(result_file))
+    result_json = {key: value for key, value in dqc_result.items() if key != "metrics"}
+    try:
+        with db.atomic():
+            run = Run.create(
+                source=get_source_key(result_file), query=query, input_fasta=input_fasta, out_dir=out_dir,
+                completed_at=completed_at, host=host, dqc_version=dqc_version, ref_version=ref_version,
+                tc_status=top_hit.get("status"), organism_name=top_hit.get("organism_name"),
+                species_taxid=_int_or_none(top_hit.get("species_taxid")), accession=top_hit.get("accession"),
+                ani=_float_or_none(top_hit.get("ani")),
+                completeness=cc_result.get("completeness"), contamination=cc_result.get("contamination"),
+                strain_heterogeneity=cc_result.get("strain_heterogeneity"),
+                ungapped_genome_size=cc_result.get("ungapped_genome_size"), genome_size_check=cc_result.get("genome_size_check"),
+                gtdb_species=gtdb_hit.get("gtdb_species"), gtdb_ani=_float_or_none(gtdb_hit.get("ani")),
+                gtdb_status=gtdb_hit.get("status"), shigapass_serotype=shigapass_result.get("Predicted_Serotype"),
+                wall_time=total.get("wall_time"), cpu_time=total.get("cpu_time"),
+                result_json=json.dumps(result_json),
+            )
+            hits = [{
+                "run": run, "rank": i, "accession": hit["accession"], "organism_name": hit["organism_name"],
+                "species_taxid": _int_or_none(hit.get("species_taxid")), "ani": hit["ani"],
+                "align_fraction_ref": _float_or_none(hit.get("align_fraction_ref")),
+                "align_fraction_query": _float_or_none(hit.get("align_fraction_query")),
+                "ani_threshold": _float_or_none(hit.get("ani_threshold")), "status": hit["status"],
+            } for i, hit in enumerate(tc_result, 1)]
+            if hits:
+                TCHit.insert_many(hits).execute()
+    except IntegrityError:
+        return None
+    return run
+
+
+def record_result(db_file, result_file, input_fasta=None):
+    """
+    Called at the end of dfast_qc. A failure is logged but does not fail the run, as the result is already in result_file.
+    """
+    try:
+        open_db(db_file)
+        with open(result_file) as f:
+            dqc_result = json.load(f)
+        ref_version = get_ref_inf().get("version")
+        insert_result(dqc_result, result_file, input_fasta=input_fasta, dqc_version=dqc_version,
+                      ref_version=ref_version, host=socket.gethostname())
+        logger.info("The result was recorded in the results database %s", db_file)
+    except Exception as e:
+        logger.warning("Failed to record the result in the results database %s. %s", db_file, e)
+    finally:
+        db.close()
+
+
+def find_result_files(dirs):
+    for top_dir in dirs:
+        for dir_path, _, file_names in os.walk(top_dir):
+            if config.DQC_RESULT_JSON in file_names:
+                yield os.path.join(dir_path, config.DQC_RESULT_JSON)
+
+
+def import_results(db_file, dirs, batch_size=1000):
+    """
+    Import dqc_result.json files under dirs, committing every batch_size files.
+    Files already imported (same path and mtime) are skipped.
+    Returns (number of imported files, number of skipped files).
+    """
+    open_db(db_file)
+    imported, skipped = 0, 0
+    existing = set(source for source, in Run.select(Run.source).tuples())
+    result_files = find_result_files(dirs)
+    try:
+        while True:
+            batch = [result_file for _, result_file in zip(range(batch_size), result_files)]
+            if not batch:
+                break
+            with db.atomic():
+                for result_file in batch:
+                    if get_source_key(result_file) in existing:
+                        skipped += 1
+                        continue
+                    try:
+                        with open(result_file) as f:
+                            dqc_result = json.load(f)
+                    except ValueError as e:
+                        logger.warning("Failed to parse %s. %s", result_file, e)
+                        continue
+                    if insert_result(dqc_result, result_file):
+                        imported += 1
+                    else:
+                        skipped += 1
+            logger.debug("Imported %d results", imported)
+    finally:
+        db.close()
+    return imported, skipped
+
+
+def select_runs(status=None, species_taxid=None, gtdb_species=None, since=None, until=None, latest_only=False):
+    """
+    Returns a query of Run. since/until are datetime. With latest_only=True, only the latest run of each query genome.
+    """
+    query = Run.select()
+    if status:
+        query = query.where(Run.tc_status == status)
+    if species_taxid is not None:
+        query = query.where(Run.species_taxid == species_taxid)
+    if gtdb_species:
+        query = query.where(Run.gtdb_species == gtdb_species)
+    if since:
+        query = query.where(Run.completed_at >= since)
+    if until:
+        query = query.where(Run.completed_at < until)
+    if latest_only:
+        Latest = Run.alias()
+        latest_ids = Latest.select(fn.MAX(Latest.id)).group_by(Latest.query)
+        query = query.where(Run.id.in_(latest_ids))
+    return query.order_by(Run.completed_at)
+
+
+def count_by_status(**filters):
+    query = select_runs(**filters)
+    counts = (Run.select(Run.tc_status, fn.COUNT(Run.id).alias("cnt"))
+              .where(Run.id.in_(query.select(Run.id).order_by()))
+              .group_by(Run.tc_status).order_by(fn.COUNT(Run.id).desc()))
+    return [(r.tc_status, r.cnt) for r in counts]
+
+
+def count_by_species(limit=20, **filters):
+    query = select_runs(**filters)
+    counts = (Run.select(Run.species_taxid, Run.organism_name, fn.COUNT(Run.id).alias("cnt"))
+              .where(Run.id.in_(query.select(Run.id).order_by()))
+              .group_by(Run.species_taxid).order_by(fn.COUNT(Run.id).desc()).limit(limit))
+    return [(r.species_taxid, r.organism_name, r.cnt) for r in counts]
+
+
+def get_distribution(field_name, **filters):
+    """
+    Summary statistics (n, min, quartiles, max, mean) of a numeric column, e.g. completeness
+    """
+    column = getattr(Run, field_name)
+    values = [row[0] for row in select_runs(**filters).select(column).where(column.is_null(False)).order_by(column).tuples()]
+    if not values:
+        return {"n": 0}
+    if len(values) > 1:
+        q1, median, q3 = statistics.quantiles(values, n=4, method="inclusive")
+    else:
+        q1 = median = q3 = values[0]
+    return {"n": len(values), "min": values[0], "q1": q1, "median": median, "q3": q3, "max": values[-1],
+            "mean": statistics.mean(values)}
+
+
+EXPORT_COLUMNS = ["id", "query", "input_fasta", "out_dir", "completed_at", "host", "dqc_version", "ref_version",
+                  "tc_status", "organism_name", "species_taxid", "accession", "ani", "completeness", "contamination",
+                  "strain_heterogeneity", "ungapped_genome_size", "genome_size_check", "gtdb_species", "gtdb_ani",
+                  "gtdb_status", "shigapass_serotype", "wall_time", "cpu_time"]
+
+
+def export_runs(out_file, query, fmt="tsv", batch_size=10000):
+    """
+    Export runs as TSV or Parquet (requires pyarrow). Returns the number of rows.
+    """
+    columns = [getattr(Run, name) for name in EXPORT_COLUMNS]
+    rows = query.select(*columns).tuples().iterator()
+    cnt = 0
+    if fmt == "parquet":
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            logger.error("pyarrow is required to export in Parquet format. Install it by 'pip install pyarrow'.")
+            exit(1)
+        writer = None
+        while True:
+            batch = [row for _, row in zip(range(batch_size), rows)]
+            if not batch:
+                break
+            table = pa.table({name: [row[i] for row in batch] for i, name in enumerate(EXPORT_COLUMNS)})
+            if writer is None:
+                writer = pq.ParquetWriter(out_file, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            cnt += len(batch)
+        if writer:
+            writer.close()
+    else:
+        with open(out_file, "w") as f:
+            f.write("\t".join(EXPORT_COLUMNS) + "\n")
+            for row in rows:
+                f.write("\t".join("" if value is None else str(value) for value in row) + "\n")
+                cnt += 1
+    return cnt
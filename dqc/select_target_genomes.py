@@ -1,6 +1,10 @@
 import sys
 import os
-from .common import get_logger, run_command, get_ref_path, get_ref_genome_fasta
+import glob
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from .common import get_logger, run_command, get_ref_path, get_ref_genome_fasta, tee_lines
+from .models import Reference, GTDB_Reference
 from argparse import ArgumentError, ArgumentParser
 from logging import StreamHandler, Formatter, INFO, DEBUG, getLogger
 
@@ -11,53 +15,148 @@ from .config import config
 def print_selected_genomes(str_result):
     logger.debug("\n%s\n%s%s", "-"*80, str_result, "-"*80)
 
-def run_mash(input_file, mash_sketch_file, mash_result_file):
-    num_threads = config.NUM_THREADS
-    cmd_mash = ["mash", "dist", mash_sketch_file,input_file, "-p" , str(num_threads), ">", mash_result_file]
-    run_command(cmd_mash, task_name="mash_search")
-    return mash_result_file
+def run_mash(input_file, mash_sketch_file, hits, num_threads=None, task_name="mash_search", debug_file=None):
+    """
+    Run MASH and returns top hits. The output is parsed through a pipe while MASH is running.
+        debug_file: file to keep the MASH output (debug mode)
+    """
+    if num_threads is None:
+        num_threads = config.NUM_THREADS
+    cmd_mash = ["mash", "dist", mash_sketch_file,input_file, "-p" , str(num_threads)]
 
-def main(Query, out_dir, hits = 10, for_gtdb=False):
+    def _parse(stdout):
+        return parse_mash_result(tee_lines(stdout, debug_file) if debug_file else stdout, hits)
+    return run_command(cmd_mash, task_name=task_name, stdout_handler=_parse)
+
+def parse_mash_result(lines, hits):
+    """
+    Returns top hits (list of columns) sorted by MASH distance
+        lines: MASH output (file object or pipe). Only the top hits are kept in memory.
+    """
+    L = (line.strip("\n").split("\t") for line in lines)
+    return heapq.nsmallest(hits, L, key=lambda x: float(x[2]))
+
+def get_sketch_shards(for_gtdb=False):
+    if for_gtdb:
+        shard_dir = get_ref_path(config.GTDB_MASH_SKETCH_SHARD_DIR)
+    else:
+        shard_dir = get_ref_path(config.MASH_SKETCH_SHARD_DIR)
+    return sorted(glob.glob(os.path.join(shard_dir, "shard_*.msh")))
+
+def run_mash_sharded(input_file, shard_files, hits, debug_file=None):
+    """
+    Run MASH against sketch shards concurrently, and merge top hits of each shard into the global top hits.
+        debug_file: file to keep the merged top hits (debug mode)
+    """
+    num_workers = min(config.NUM_THREADS, len(shard_files))
+    logger.info("Running MASH against %d sketch shards using %d threads.", len(shard_files), num_workers)
+
+    def _search_shard(i, shard_file):
+        return run_mash(input_file, shard_file, hits, num_threads=1, task_name=f"mash_search (shard {i + 1}/{len(shard_files)})")
+
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="thread") as executor:
+        futures = [executor.submit(_search_shard, i, shard_file) for i, shard_file in enumerate(shard_files)]
+        L = [cols for f in futures for cols in f.result()]
+    top_hits = heapq.nsmallest(hits, L, key=lambda x: float(x[2]))
+    if debug_file:
+        with open(debug_file, "w") as f:
+            for cols in top_hits:
+                f.write("\t".join(cols) + "\n")
+    return top_hits
+
+def search_mash(Query, hits, for_gtdb=False, work_dir=None):
+    """
+    Returns top MASH hits (list of columns) sorted by MASH distance.
+    If config.MAX_HITS_PER_SPECIES is set, config.MASH_HITS_POOL hits are searched and capped per species.
+    """
+    max_per_species = config.MAX_HITS_PER_SPECIES
     if for_gtdb:
         mash_sketch = get_ref_path(config.GTDB_MASH_SKETCH_FILE)
-        mash_result = os.path.join(out_dir, config.MASH_RESULT_GTDB)
+        mash_result = os.path.join(work_dir, config.MASH_RESULT_GTDB)
     else:
         mash_sketch = get_ref_path(config.MASH_SKETCH_FILE)
-        mash_result = os.path.join(out_dir, config.MASH_RESULT_REF)
-    run_mash(Query, mash_sketch, mash_result)
-    L = []
-    for line in open(mash_result):
-        cols = line.strip("\n").split("\t")
-        L.append(cols)
-    L = sorted(L, key=lambda x: float(x[2]))
-    top_10 = L[: hits]
-    target_accessions = set()
-    ret, target_cnt = "", 0
-    for dat in top_10:
-        accession = dat[0].split("/")[-1]
-        if for_gtdb:
-            accession = accession.replace("_genomic.fna.gz","")
-            target_accessions.add(accession)
-        else: 
-            accession = accession.replace(".fna.gz","")
-            target_accessions.add(accession)
-    for accession in target_accessions:
-        target_genome_path = get_ref_genome_fasta(accession, for_gtdb=for_gtdb)
-        target_cnt += 1
-        ret += target_genome_path + "\n"
+        mash_result = os.path.join(work_dir, config.MASH_RESULT_REF)
+    debug_file = mash_result if config.DEBUG else None
+    num_search = max(config.MASH_HITS_POOL, hits) if max_per_species else hits
+    shard_files = get_sketch_shards(for_gtdb)
+    if shard_files:
+        top_hits = run_mash_sharded(Query, shard_files, num_search, debug_file=debug_file)
+    else:
+        top_hits = run_mash(Query, mash_sketch, num_search, debug_file=debug_file)
+    if max_per_species:
+        top_hits = cap_hits_per_species(top_hits, max_per_species, hits, for_gtdb=for_gtdb)
+    return top_hits
+
+def filter_by_distance(top_hits, margin):
+    """
+    Hits whose MASH distance is within the margin from the best hit (top_hits must be sorted by distance)
+    """
+    if not top_hits:
+        return []
+    max_distance = float(top_hits[0][2]) + margin
+    return [cols for cols in top_hits if float(cols[2]) <= max_distance]
+
+def get_accession(dat, for_gtdb=False):
+    accession = dat[0].split("/")[-1]
     if for_gtdb:
-        target_genome_list_file = os.path.join(out_dir, config.GTDB_TARGET_GENOME_LIST)
+        return accession.replace("_genomic.fna.gz","")
     else:
-        target_genome_list_file = os.path.join(out_dir, config.TARGET_GENOME_LIST)
+        return accession.replace(".fna.gz","")
+
+def cap_hits_per_species(top_hits, max_per_species, hits, for_gtdb=False):
+    """
+    Select up to hits MASH hits in the order of distance, with at most max_per_species hits for each species
+    (species_taxid in references.db, or GTDB species). The remaining slots are filled with the nearest other species.
+    Hits not found in the reference database are counted as separate species.
+    """
+    accessions = [get_accession(dat, for_gtdb) for dat in top_hits]
+    if for_gtdb:
+        query = GTDB_Reference.select(GTDB_Reference.accession, GTDB_Reference.gtdb_species).where(GTDB_Reference.accession.in_(accessions))
+        dict_species = {ref.accession: ref.gtdb_species for ref in query}
+    else:
+        query = Reference.select(Reference.accession, Reference.species_taxid).where(Reference.accession.in_(accessions))
+        dict_species = {ref.accession: ref.species_taxid for ref in query}
+    selected, species_cnt = [], {}
+    for dat, accession in zip(top_hits, accessions):
+        species = dict_species.get(accession, accession)
+        if species_cnt.get(species, 0) >= max_per_species:
+            continue
+        species_cnt[species] = species_cnt.get(species, 0) + 1
+        selected.append(dat)
+        if len(selected) >= hits:
+            break
+    logger.info("Selected %d MASH hits of %d species (up to %d hits per species).", len(selected), len(species_cnt), max_per_species)
+    return selected
+
+def get_target_genomes(top_hits, for_gtdb=False):
+    """
+    Reference genome files of the MASH hits, in the order of the hits
+    """
+    target_accessions = []
+    for dat in top_hits:
+        accession = get_accession(dat, for_gtdb)
+        if accession not in target_accessions:
+            target_accessions.append(accession)
+    return [get_ref_genome_fasta(accession, for_gtdb=for_gtdb) for accession in target_accessions]
 
+def write_target_genome_list(target_genomes, target_genome_list_file):
+    ret = "".join(target_genome_path + "\n" for target_genome_path in target_genomes)
     with open(target_genome_list_file, "w") as f:
         f.write(ret)
-    if not config.DEBUG:
-        os.remove(mash_result)
-    logger.info("Selected %d target genomes.", target_cnt)
+    logger.info("Selected %d target genomes.", len(target_genomes))
     logger.info("Target genome list was writen to %s", target_genome_list_file)
     print_selected_genomes(ret)
-    return target_genome_list_file 
+    return target_genome_list_file
+
+def main(Query, out_dir, hits = 10, for_gtdb=False, work_dir=None):
+    work_dir = work_dir or out_dir  # MASH result is written only in debug mode
+    top_10 = search_mash(Query, hits, for_gtdb=for_gtdb, work_dir=work_dir)
+    target_genomes = get_target_genomes(top_10, for_gtdb=for_gtdb)
+    if for_gtdb:
+        target_genome_list_file = os.path.join(out_dir, config.GTDB_TARGET_GENOME_LIST)
+    else:
+        target_genome_list_file = os.path.join(out_dir, config.TARGET_GENOME_LIST)
+    return write_target_genome_list(target_genomes, target_genome_list_file)
 
 if __name__ == '__main__':
     def parse_args():
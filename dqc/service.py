@@ -0,0 +1,470 @@
+"""
+Local HTTP job service for DFAST_QC (dqc_service)
+
+Jobs are kept in a SQLite table (JOB_DB in the work directory), so that queued jobs survive restarts.
+Each job runs the dfast_qc pipeline in a subprocess and writes dqc_result.json into WORK_DIR/jobs/<job_id>/.
+Jobs are taken in order of priority lane and then submission. Workers reserved for urgent jobs (urgent_workers)
+take only urgent jobs, so that an urgent genome does not wait for long bulk jobs to finish.
+
+Endpoints:
+    POST /jobs                   JSON {"input_fasta": "/path/to/genome.fna", "priority": "urgent", "options": {"enable_gtdb": true}}
+                                 or FASTA (raw or gzipped) in the request body, with ?filename=genome.fna.gz&priority=bulk&<option>=<value>
+    GET  /jobs?status=queued     list of jobs (status and limit are optional)
+    GET  /jobs/<id>              status of a job
+    GET  /jobs/<id>/result       dqc_result.json of a finished job
+    POST /jobs/<id>/cancel       cancel a queued or running job (DELETE /jobs/<id> also works)
+    GET  /health                 number of jobs by status
+"""
+import os
+import sys
+import json
+import uuid
+import shutil
+import signal
+import threading
+import subprocess
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from peewee import Model, SqliteDatabase, AutoField, CharField, IntegerField, DateTimeField, TextField, BooleanField, fn
+from .common import get_logger
+
+logger = get_logger(__name__)
+
+JOB_DB = "dqc_jobs.db"
+PRIORITIES = {"urgent": 0, "normal": 50, "bulk": 100}
+DFAST_QC_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dfast_qc")
+# options of dfast_qc accepted from clients. name: type (bool for flags)
+JOB_OPTIONS = {"num_hits": int, "max_hits_per_species": int, "adaptive_hits": bool, "two_pass_ani": bool,
+               "ani": int, "taxid": int, "num_threads": int, "enable_gtdb": bool, "disable_tc": bool, "disable_cc": bool,
+               "disable_shigapass": bool}
+POLL_INTERVAL = 1.0  # seconds
+
+QUEUED, RUNNING, FINISHED, FAILED, CANCELLED = "queued", "running", "finished", "failed", "cancelled"
+
+db = SqliteDatabase(None)
+
+
+class Job(Model):
+    id = AutoField()
+    status = CharField(default=QUEUED)
+    priority = IntegerField(default=PRIORITIES["normal"])
+    input_fasta = CharField()
+    uploaded = BooleanField(default=False)  # input_fasta was uploaded to the service and is removed after the job
+    options = TextField(default="{}")
+    out_dir = CharField(null=True)
+    submitted_at = DateTimeField(default=datetime.now)
+    started_at = DateTimeField(null=True)
+    finished_at = DateTimeField(null=True)
+    returncode = IntegerField(null=True)
+    error = TextField(null=True)
+
+    class Meta:
+        database = db
+        indexes = (
+            (("status", "priority", "id"), False),
+        )
+
+    def to_dict(self):
+        return {
+            "job_id": self.id, "status": self.status, "priority": self.priority_name(),
+            "input_fasta": None if self.uploaded else self.input_fasta, "options": json.loads(self.options),
+            "submitted_at": self.submitted_at.isoformat(timespec="seconds"),
+            "started_at": self.started_at.isoformat(timespec="seconds") if self.started_at else None,
+            "finished_at": self.finished_at.isoformat(timespec="seconds") if self.finished_at else None,
+            "returncode": self.returncode, "error": self.error,
+        }
+
+    def priority_name(self):
+        for name, value in PRIORITIES.items():
+            if value == self.priority:
+                return name
+        return str(self.priority)
+
+
+class JobError(Exception):
+    """
+    Invalid request from a client. Reported as HTTP 400.
+    """
+    pass
+
+
+def parse_options(options):
+    if not isinstance(options, dict):
+        raise JobError("'options' must be a JSON object.")
+    parsed = {}
+    for name, value in options.items():
+        if name not in JOB_OPTIONS:
+            raise JobError(f"Unknown option '{name}'. Available: {', '.join(JOB_OPTIONS)}")
+        if JOB_OPTIONS[name] is bool:
+            parsed[name] = value if isinstance(value, bool) else str(value).lower() in ("1", "true", "yes")
+        else:
+            try:
+                parsed[name] = int(value)
+            except (TypeError, ValueError):
+                raise JobError(f"Option '{name}' must be an integer.")
+    return parsed
+
+
+def parse_priority(priority):
+    if priority is None:
+        return PRIORITIES["normal"]
+    if not isinstance(priority, str) or priority not in PRIORITIES:
+        raise JobError(f"Unknown priority '{priority}'. Available: {', '.join(PRIORITIES)}")
+    return PRIORITIES[priority]
+
+
+def parse_limit(limit):
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise JobError("'limit' must be an integer.")
+    if limit < 0:
+        raise JobError("'limit' must not be negative.")
+    return limit
+
+
+def remove_upload(upload_file):
+    shutil.rmtree(os.path.dirname(upload_file), ignore_errors=True)
+
+
+class JobService:
+    def __init__(self, work_dir, num_workers=2, urgent_workers=0, ref_dir=None, results_db=None):
+        self.work_dir = os.path.abspath(work_dir)
+        self.upload_dir = os.path.join(self.work_dir, "uploads")
+        self.jobs_dir = os.path.join(self.work_dir, "jobs")
+        self.log_dir = os.path.join(self.work_dir, "logs")
+        for dir_name in [self.upload_dir, self.jobs_dir, self.log_dir]:
+            os.makedirs(dir_name, exist_ok=True)
+        self.num_workers = num_workers
+        self.urgent_workers = urgent_workers
+        self.ref_dir = ref_dir
+        self.results_db = results_db
+        self.processes = {}  # job_id: Popen of running jobs
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition()
+        self.stopping = threading.Event()
+        self.workers = []
+        db.init(os.path.join(self.work_dir, JOB_DB), pragmas={"journal_mode": "wal", "busy_timeout": 30000})
+        db.connect(reuse_if_open=True)
+        db.create_tables([Job])
+        # jobs left running by the previous process (e.g. killed or host restarted) are run again
+        cnt = Job.update(status=QUEUED, started_at=None).where(Job.status == RUNNING).execute()
+        if cnt:
+            logger.warning("%d jobs interrupted in the previous run were queued again.", cnt)
+
+    # --- job submission and queries (called by the HTTP handler) ---
+    def submit(self, input_fasta, priority=None, options=None, uploaded=False):
+        if not isinstance(input_fasta, str):
+            raise JobError("'input_fasta' must be a path to a FASTA file.")
+        if not os.path.isfile(input_fasta):
+            raise JobError(f"Input FASTA not found: {input_fasta}")
+        job = Job.create(input_fasta=os.path.abspath(input_fasta), priority=parse_priority(priority),
+                         options=json.dumps(parse_options({} if options is None else options)), uploaded=uploaded)
+        logger.info("Job %d was queued. [priority=%s, input=%s]", job.id, job.priority_name(), input_fasta)
+        with self.wakeup:
+            self.wakeup.notify_all()
+        return job
+
+    def save_upload(self, stream, length, filename):
+        filename = os.path.basename(filename or "query.fna")
+        upload_dir = os.path.join(self.upload_dir, uuid.uuid4().hex)  # keeps the file name, which is the query name
+        os.makedirs(upload_dir)
+        upload_file = os.path.join(upload_dir, filename)
+        remaining = length
+        with open(upload_file, "wb") as f:
+            while remaining > 0:
+                chunk = stream.read(min(remaining, 1 << 20))
+                if not chunk:
+                    break
+                f.write(chunk)
+                remaining -= len(chunk)
+        if remaining > 0:
+            remove_upload(upload_file)
+            raise JobError("Upload was interrupted.")
+        return upload_file
+
+    def get(self, job_id):
+        return Job.get_or_none(Job.id == job_id)
+
+    def list(self, status=None, limit=100):
+        query = Job.select().order_by(Job.id.desc()).limit(limit)
+        if status:
+            query = query.where(Job.status == status)
+        return list(query)
+
+    def counts(self):
+        counts = {status: 0 for status in [QUEUED, RUNNING, FINISHED, FAILED, CANCELLED]}
+        for status, cnt in Job.select(Job.status, fn.COUNT(Job.id)).group_by(Job.status).tuples():
+            counts[status] = cnt
+        return counts
+
+    def result_file(self, job):
+        return os.path.join(job.out_dir, "dqc_result.json")
+
+    def cancel(self, job_id):
+        with db.atomic("IMMEDIATE"):
+            job = self.get(job_id)
+            if job is None or job.status not in (QUEUED, RUNNING):
+                return job
+            was_queued = job.status == QUEUED
+            job.status, job.finished_at = CANCELLED, datetime.now()
+            job.save()
+        if was_queued and job.uploaded:
+            remove_upload(job.input_fasta)
+        with self.lock:
+            p = self.processes.get(job_id)
+        if p is not None:
+            try:
+                # dfast_qc kills the external command it is running (in another process group) and exits
+                os.killpg(p.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        logger.info("Job %d was cancelled.", job_id)
+        return job
+
+    # --- workers ---
+    def claim(self, urgent_only=False):
+        """
+        Take the next queued job (highest priority, then oldest) and mark it running
+        """
+        with db.atomic("IMMEDIATE"):
+            query = Job.select().where(Job.status == QUEUED)
+            if urgent_only:
+                query = query.where(Job.priority <= PRIORITIES["urgent"])
+            job = query.order_by(Job.priority, Job.id).first()
+            if job is None:
+                return None
+            job.status, job.started_at = RUNNING, datetime.now()
+            job.out_dir = os.path.join(self.jobs_dir, str(job.id))
+            job.save()
+        return job
+
+    def get_command(self, job):
+        cmd = [sys.executable, DFAST_QC_SCRIPT, "-i", job.input_fasta, "-o", job.out_dir, "--force"]
+        if self.ref_dir:
+            cmd += ["--ref_dir", self.ref_dir]
+        if self.results_db:
+            cmd += ["--results_db", self.results_db]
+        for name, value in json.loads(job.options).items():
+            if JOB_OPTIONS[name] is bool:
+                if value:
+                    cmd.append(f"--{name}")
+            else:
+                cmd += [f"--{name}", str(value)]
+        return cmd
+
+    def run_job(self, job):
+        log_file = os.path.join(self.log_dir, f"{job.id}.log")
+        logger.info("Job %d started.", job.id)
+        with open(log_file, "w") as log:
+            p = subprocess.Popen(self.get_command(job), stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+            with self.lock:
+                self.processes[job.id] = p
+            if self.get(job.id).status == CANCELLED:  # cancelled before the process was registered
+                os.killpg(p.pid, signal.SIGTERM)
+            returncode = p.wait()
+            with self.lock:
+                self.processes.pop(job.id, None)
+        with db.atomic("IMMEDIATE"):
+            job = self.get(job.id)
+            if job.status == RUNNING:  # not cancelled
+                if self.stopping.is_set() and returncode < 0:
+                    # terminated by shutdown. Run again after restart
+                    job.status, job.started_at = QUEUED, None
+                    logger.info("Job %d was interrupted and will be run again after restart.", job.id)
+                else:
+                    job.status = FINISHED if returncode == 0 else FAILED
+                    job.finished_at = datetime.now()
+                    job.returncode = returncode
+                    if returncode != 0:
+                        job.error = "".join(open(log_file).readlines()[-10:])
+                job.save()
+        if job.status == QUEUED:
+            return
+        if job.uploaded:
+            remove_upload(job.input_fasta)
+        logger.info("Job %d %s.", job.id, job.status)
+
+    def worker(self, urgent_only=False):
+        while not self.stopping.is_set():
+            try:
+                job = self.claim(urgent_only=urgent_only)
+            except Exception as e:
+                logger.error("Failed to take a job from the queue. %s", e)
+                job = None
+            if job is None:
+                with self.wakeup:
+                    self.wakeup.wait(POLL_INTERVAL)
+                continue
+            try:
+                self.run_job(job)
+            except Exception as e:
+                logger.error("Job %d failed to run. %s", job.id, e)
+                Job.update(status=FAILED, error=str(e), finished_at=datetime.now()).where(Job.id == job.id).execute()
+
+    def start(self):
+        for i in range(self.num_workers):
+            urgent_only = i < self.urgent_workers
+            t = threading.Thread(target=self.worker, kwargs={"urgent_only": urgent_only}, name=f"worker-{i}", daemon=True)
+            t.start()
+            self.workers.append(t)
+
+    def stop(self):
+        """
+        Stop the workers. Running jobs are terminated and queued again.
+        """
+        self.stopping.set()
+        with self.lock:
+            processes = list(self.processes.values())
+        for p in processes:
+            try:
+                os.killpg(p.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        with self.wakeup:
+            self.wakeup.notify_all()
+        for t in self.workers:
+            t.join()
+        db.close()
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    service = None  # JobService, set by serve()
+    max_upload_size = 0
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data, indent=2).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, status, message):
+        self.send_json({"error": message}, status=status)
+
+    def get_job_or_404(self, job_id):
+        job = self.service.get(int(job_id))
+        if job is None:
+            self.send_error_json(404, f"Job {job_id} not found.")
+        return job
+
+    def route(self):
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        return parts, {key: values[-1] for key, values in parse_qs(url.query).items()}
+
+    def do_GET(self):
+        parts, params = self.route()
+        if parts == ["health"]:
+            return self.send_json({"status": "ok", "jobs": self.service.counts()})
+        if parts == ["jobs"]:
+            try:
+                limit = parse_limit(params.get("limit", 100))
+            except JobError as e:
+                return self.send_error_json(400, str(e))
+            return self.send_json([job.to_dict() for job in self.service.list(params.get("status"), limit)])
+        if len(parts) in (2, 3) and parts[0] == "jobs" and parts[1].isdigit():
+            job = self.get_job_or_404(parts[1])
+            if job is None:
+                return
+            if len(parts) == 2:
+                return self.send_json(job.to_dict())
+            if parts[2] == "result":
+                if job.status != FINISHED:
+                    return self.send_error_json(409, f"Job {job.id} is {job.status}.")
+                with open(self.service.result_file(job), "rb") as f:
+                    body = f.read()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+        self.send_error_json(404, "Not found.")
+
+    def do_POST(self):
+        parts, params = self.route()
+        try:
+            if parts == ["jobs"]:
+                return self.submit(params)
+            if len(parts) == 3 and parts[0] == "jobs" and parts[1].isdigit() and parts[2] == "cancel":
+                return self.cancel(parts[1])
+        except JobError as e:
+            return self.send_error_json(400, str(e))
+        self.send_error_json(404, "Not found.")
+
+    def do_DELETE(self):
+        parts, _ = self.route()
+        if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            return self.cancel(parts[1])
+        self.send_error_json(404, "Not found.")
+
+    def cancel(self, job_id):
+        job = self.get_job_or_404(job_id)
+        if job is None:
+            return
+        job = self.service.cancel(job.id)
+        if job.status != CANCELLED:
+            return self.send_error_json(409, f"Job {job.id} is already {job.status}.")
+        self.send_json(job.to_dict())
+
+    def submit(self, params):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            raise JobError("Invalid Content-Length.")
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            try:
+                request = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError:
+                raise JobError("Invalid JSON.")
+            if not isinstance(request, dict):
+                raise JobError("Request body must be a JSON object.")
+            if "input_fasta" not in request:
+                raise JobError("'input_fasta' is required.")
+            job = self.service.submit(request["input_fasta"], request.get("priority"), request.get("options"))
+        else:
+            if length <= 0:
+                raise JobError("Empty request body. Send a FASTA file or JSON.")
+            if length > self.max_upload_size:
+                raise JobError(f"Upload is larger than {self.max_upload_size // (1024 * 1024)} MB.")
+            priority = params.pop("priority", None)
+            filename = params.pop("filename", None)
+            parse_priority(priority)  # validated before receiving the file
+            options = parse_options(params)
+            upload_file = self.service.save_upload(self.rfile, length, filename)
+            try:
+                job = self.service.submit(upload_file, priority, options, uploaded=True)
+            except Exception:
+                remove_upload(upload_file)
+                raise
+        self.send_json(job.to_dict(), status=201)
+
+
+def serve(work_dir, host="127.0.0.1", port=8080, num_workers=2, urgent_workers=0, ref_dir=None, results_db=None, max_upload_mb=200):
+    service = JobService(work_dir, num_workers=num_workers, urgent_workers=urgent_workers, ref_dir=ref_dir, results_db=results_db)
+    JobRequestHandler.service = service
+    JobRequestHandler.max_upload_size = max_upload_mb * 1024 * 1024
+    server = ThreadingHTTPServer((host, port), JobRequestHandler)
+
+    def shutdown(signum, frame):
+        logger.info("Shutting down DFAST_QC service.")
+        service.stopping.set()  # no more jobs are taken while the server is shutting down
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, shutdown)
+
+    service.start()
+    logger.info("DFAST_QC service is listening on http://%s:%d/ with %d workers (%d for urgent jobs). Work directory: %s",
+                host, port, num_workers, urgent_workers, service.work_dir)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
@@ -5,7 +5,7 @@ import shutil
 import csv
 
 from .config import config
-from .common import get_logger, run_command, get_ref_path
+from .common import get_logger, run_command, get_ref_path, get_work_dir
 
 logger = get_logger(__name__)
 
@@ -54,7 +54,7 @@ def _prepare_input(input_file, out_dir):
     """
     temp_fasta = None
     if input_file.endswith(".gz"):
-        # Decompress to output directory
+        # Decompress to the working directory
         base_name = os.path.basename(input_file).replace(".gz", "")
         temp_fasta = os.path.join(out_dir, base_name)
         with gzip.open(input_file, "rb") as f_in:
@@ -151,7 +151,9 @@ def run():
     """
     input_file = config.QUERY_GENOME
     out_dir = config.OUT_DIR
+    work_dir = get_work_dir()
     shigapass_out_dir = os.path.join(out_dir, config.SHIGAPASS_OUTPUT_DIR)
+    shigapass_work_dir = os.path.join(work_dir, config.SHIGAPASS_OUTPUT_DIR)  # per-genome BLAST outputs are kept here
 
     logger.info("===== Start ShigaPass serotype prediction =====")
 
@@ -168,13 +170,13 @@ def run():
         setup_shigapass()
 
     # Prepare input
-    input_list_file, temp_fasta = _prepare_input(input_file, out_dir)
+    input_list_file, temp_fasta = _prepare_input(input_file, work_dir)
 
     # Build command
     cmd = [
         "bash", shigapass_script,
         "-l", input_list_file,
-        "-o", shigapass_out_dir,
+        "-o", shigapass_work_dir,
         "-p", get_ref_path(config.SHIGAPASS_DB_DIR),
         "-t", str(config.NUM_THREADS),
     ]
@@ -186,6 +188,13 @@ def run():
 
     run_command(cmd, task_name="ShigaPass")
 
+    # Copy the summary files to the output directory
+    if shigapass_work_dir != shigapass_out_dir:
+        os.makedirs(shigapass_out_dir, exist_ok=True)
+        for file_name in [config.SHIGAPASS_SUMMARY, config.SHIGAPASS_FLEX_SUMMARY]:
+            if os.path.exists(os.path.join(shigapass_work_dir, file_name)):
+                shutil.copy(os.path.join(shigapass_work_dir, file_name), shigapass_out_dir)
+
     # Parse results
     summary_file = os.path.join(shigapass_out_dir, config.SHIGAPASS_SUMMARY)
     result = parse_summary(summary_file)
@@ -1,16 +1,15 @@
 #!/usr/bin/env python
 
-import os
 import sys
-import json
 from argparse import ArgumentParser
 from dqc.config import config
 from datetime import datetime
 
 config.ADMIN = True
 
-from dqc.common import get_logger, get_ref_inf
+from dqc.common import get_logger, get_ref_inf, update_ref_inf, exit_on_command_error
 logger = get_logger(__name__)
+sys.excepthook = exit_on_command_error
 
 def check_ref_type(args):
     ref_inf = get_ref_inf()
@@ -28,11 +27,9 @@ def add_ref_info(args):
     ref_type = "full"
     ref_inf = {"version": time_stamp, "type": ref_type}    
 
-    # Writing inf.json file
-    out_json_file = os.path.join(config.DQC_REFERENCE_DIR, config.REFERENCE_INF)
+    # Writing inf.json file (other information such as freshness of the master files is kept)
     logger.info("Writing reference info. [version=%s, type=%s]", ref_inf["version"], ref_inf["type"])
-    with open(out_json_file, "w") as f:
-        json.dump(ref_inf, f)
+    update_ref_inf(ref_inf)
 
 
 def download_master_files(args):
@@ -41,11 +38,11 @@ def download_master_files(args):
         target_files = ["asm", "ani", "tsr", "igp", "sst", "egs"]
     else:
         target_files = args.targets
-    download_master_files(target_files)
+    download_master_files(target_files, force=args.force)
 
 def update_taxdump(args):
     from dqc.admin.update_taxdump import main as update_taxdump
-    update_taxdump()
+    update_taxdump(force=args.force)
 
 def download_genomes(args):
     from dqc.admin.download_all_reference_genomes import download_all_genomes
@@ -53,11 +50,11 @@ def download_genomes(args):
 
 def mash_ref_sketch(args):
     from dqc.admin.mash_sketching import sketching
-    sketching()
+    sketching(num_shards=args.num_shards)
 
 def mash_gtdb_sketch(args):
     from dqc.admin.mash_gtdb_sketching import gtdb_sketching
-    gtdb_sketching()
+    gtdb_sketching(num_shards=args.num_shards)
 
 def prepare_sqlite_db(args):
     from dqc.admin.prepare_sqlite_db import prepare_sqlite_db, prepare_sqlite_db_for_gtdb
@@ -66,6 +63,10 @@ def prepare_sqlite_db(args):
     else:
         prepare_sqlite_db()
 
+def prepare_genome_sources(args):
+    from dqc.admin.prepare_genome_sources import prepare_genome_sources
+    prepare_genome_sources(fetch_checksums=not args.skip_md5)
+
 def prepare_checkm_data(args):
     from dqc.admin.prepare_checkm_data import main as prepare_checkm_data
     prepare_checkm_data(delete_existing_data=args.delete_existing_data)
@@ -86,24 +87,49 @@ def setup_shigapass(args):
     from dqc.admin.setup_shigapass import setup_shigapass
     setup_shigapass()
 
+def verify_genomes(args):
+    from dqc.admin.verify_genomes import verify_genomes
+    verify_genomes(targets=args.targets, incremental=args.incremental, redownload=args.redownload)
+
 def update_all(args):
+    # Downstream steps are executed only when their input files have been changed.
     from dqc.admin.download_master_files import download_master_files
-    download_master_files(target_files=["asm", "ani", "tsr", "igp", "sst", "egs"])
+    updated_targets = download_master_files(target_files=["asm", "ani", "tsr", "igp", "sst", "egs"], force=args.force)
     from dqc.admin.update_taxdump import main as update_taxdump
-    update_taxdump()
-    from dqc.admin.download_all_reference_genomes import download_all_genomes
-    download_all_genomes()
-    from dqc.admin.prepare_sqlite_db import prepare_sqlite_db
-    prepare_sqlite_db()
-    from dqc.admin.update_checkm_db import main as update_checkm_db
-    update_checkm_db()
-    from dqc.admin.mash_sketching import sketching
-    sketching()
-    from dqc.admin.prepare_genome_size_data import prepare_genome_size_data
-    prepare_genome_size_data()
+    is_taxdump_updated = update_taxdump(force=args.force)
+    is_report_updated = args.force or "asm" in updated_targets or "ani" in updated_targets
+    is_tsr_updated = "tsr" in updated_targets  # type strain report is also parsed into references.db
+    num_changed_genomes = 0
+    if is_report_updated:
+        from dqc.admin.prepare_genome_sources import prepare_genome_sources
+        prepare_genome_sources()
+        from dqc.admin.download_all_reference_genomes import download_all_genomes
+        num_changed_genomes = download_all_genomes()
+    else:
+        logger.info("Assembly report and ANI report have not been changed. Skipped updating reference genomes.")
+    if is_report_updated or is_taxdump_updated or is_tsr_updated:
+        from dqc.admin.prepare_sqlite_db import prepare_sqlite_db
+        prepare_sqlite_db()
+    else:
+        logger.info("Skipped preparing SQLite DB.")
+    if args.force or is_taxdump_updated:
+        from dqc.admin.update_checkm_db import main as update_checkm_db
+        update_checkm_db()
+    else:
+        logger.info("NCBI taxdump has not been changed. Skipped updating Taxon DB for CheckM.")
+    if args.force or num_changed_genomes > 0:
+        from dqc.admin.mash_sketching import sketching
+        sketching()
+    else:
+        logger.info("Reference genomes have not been changed. Skipped MASH sketching.")
+    if args.force or "egs" in updated_targets:
+        from dqc.admin.prepare_genome_size_data import prepare_genome_size_data
+        prepare_genome_size_data(download=False)  # already downloaded by download_master_files
+    else:
+        logger.info("Expected genome size file has not been changed. Skipped preparing genome size data.")
     from dqc.admin.setup_shigapass import setup_shigapass
     setup_shigapass()
-    add_ref_info()
+    add_ref_info(args)
 
 def parse_args():
     parser = ArgumentParser(description="DFAST_QC utility tools for admin.")
@@ -126,10 +152,12 @@ def parse_args():
              "[asm: Assembly report, ani: ANI report, tsr: Type strain report,igp: indistinguishable groups prokaryotes, sst: ANI species specific threshold, egs: expected genome size, checkm: CheckM reference data, taxdump: NCBI taxdump.tar.gz, gtdb: GTDB representative species list] "
              "(default: asm ani tsr igp, sst, egs)"
     )
+    parser_master.add_argument('--force', action='store_true', help='Download files even if they have not been changed since the last download.')
     parser_master.set_defaults(func=download_master_files)
 
     # subparser for update_taxdump
     parser_update_taxdump = subparsers.add_parser('update_taxdump', help='Update NCBI taxdump data', parents=[common_parser])
+    parser_update_taxdump.add_argument('--force', action='store_true', help='Update even if taxdump has not been changed since the last download.')
     parser_update_taxdump.set_defaults(func=update_taxdump)
 
     # subparser for download reference genomes
@@ -138,10 +166,14 @@ def parse_args():
 
     # subparser for MASH sketching reference genomes
     parser_sketch_ref = subparsers.add_parser('mash_ref_sketch', help='Sketch the reference genomes.', parents=[common_parser])
+    parser_sketch_ref.add_argument("--num_shards", default=0, type=int, metavar="INT",
+        help="Number of sketch shards searched in parallel by dfast_qc (default: 0, do not create shards)")
     parser_sketch_ref.set_defaults(func=mash_ref_sketch)
 
     # subparser for MASH sketching GTDB genomes
     parser_sketch_gtdb = subparsers.add_parser('mash_gtdb_sketch', help='Sketch the GTDB genomes.', parents=[common_parser])
+    parser_sketch_gtdb.add_argument("--num_shards", default=0, type=int, metavar="INT",
+        help="Number of sketch shards searched in parallel by dfast_qc (default: 0, do not create shards)")
     parser_sketch_gtdb.set_defaults(func=mash_gtdb_sketch)
     
     # subparser for prepare sqlite DB
@@ -149,6 +181,11 @@ def parse_args():
     parser_prep_sqlite.add_argument('--for_gtdb', action='store_true', help='Create files for GTDB.')
     parser_prep_sqlite.set_defaults(func=prepare_sqlite_db)
 
+    # subparser for prepare_genome_sources
+    parser_genome_sources = subparsers.add_parser('prepare_genome_sources', help='Store download URLs and MD5 of reference genomes in SQLite database (references.db).', parents=[common_parser])
+    parser_genome_sources.add_argument('--skip_md5', action='store_true', help='Do not fetch MD5 checksums of the genomes.')
+    parser_genome_sources.set_defaults(func=prepare_genome_sources)
+
     # subparser for prepare_checkm_data
     parser_prep_checkm = subparsers.add_parser('prepare_checkm', help='Prepare CheckM data root', parents=[common_parser])
     parser_prep_checkm.add_argument('--delete_existing_data', action='store_true', help='Delete existing data directory.')
@@ -174,8 +211,19 @@ def parse_args():
     parser_setup_shigapass = subparsers.add_parser('setup_shigapass', help='Download and install ShigaPass script and databases.', parents=[common_parser])
     parser_setup_shigapass.set_defaults(func=setup_shigapass)
 
+    # subparser for verify_genomes
+    parser_verify_genomes = subparsers.add_parser('verify_genomes', help='Verify integrity of reference genomes.', parents=[common_parser])
+    parser_verify_genomes.add_argument(
+        "--targets", type=str, required=False, metavar="STR", choices=["ref", "gtdb"], nargs="*", default=["ref", "gtdb"],
+        help="Target(s) for verification. [ref: NCBI reference genomes, gtdb: GTDB representative genomes] (default: ref gtdb)"
+    )
+    parser_verify_genomes.add_argument('--incremental', action='store_true', help='Verify only the files changed since the last verification.')
+    parser_verify_genomes.add_argument('--redownload', action='store_true', help='Re-download the genomes queued for re-download after verification.')
+    parser_verify_genomes.set_defaults(func=verify_genomes)
+
     # subparser for update_all
     parser_update_all = subparsers.add_parser('update_all', help='Update all reference data', parents=[common_parser])
+    parser_update_all.add_argument('--force', action='store_true', help='Re-download all the master files and redo all the steps.')
     parser_update_all.set_defaults(func=update_all)
 
     args = parser.parse_args()
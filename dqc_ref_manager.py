@@ -4,13 +4,11 @@ import sys
 import glob
 import shutil
 import json
-import subprocess
 from datetime import datetime
 from argparse import ArgumentParser
-from urllib.request import urlretrieve
 from urllib.error import HTTPError, URLError
 from dqc.config import config
-from dqc.common import get_logger, get_ref_inf, get_ref_path, safe_tar_extraction
+from dqc.common import get_logger, get_ref_inf, get_ref_path
 
 # logger = None
 config.ADMIN = True
@@ -41,58 +39,43 @@ def dump_dqc_reference(args):
     ref_type = "compact"
     ref_inf = {"version": time_stamp, "type": ref_type}
 
-    # temporaly output directorey
-    tmp_out_dir = "dqc_reference_compact"
-    if os.path.exists(tmp_out_dir):
-        logger.error(f"'{tmp_out_dir}' already exists. Aborted.")
-        exit(1)
+    # Output file names
+    if args.output:
+        # clean args.output and then append .tar.gz
+        out_tar_name = args.output.replace(".tar", "").replace(".gz", "") + ".tar.gz"
     else:
-        os.makedirs(tmp_out_dir)
+        out_tar_name = "dqc_reference_compact.tar.gz"
+    if os.path.exists(out_tar_name) or glob.glob(out_tar_name + ".[0-9][0-9][0-9]"):
+        logger.error(f"'{out_tar_name}' already exists. Aborted.")
+        exit(1)
 
-    logger.info("Dumping reference files.")
+    # Reference files
     ref_file_list = ["INDISTINGUISHABLE_GROUPS_PROKARYOTE", "SPECIES_SPECIFIC_THRESHOLD",
     "SQLITE_REFERENCE_DB", "ETE3_SQLITE_DB", "GTDB_MASH_SKETCH_FILE", "MASH_SKETCH_FILE"]
-    # Reference files
+    files = []
     for name in ref_file_list:
         ref_file = get_ref_path(getattr(config, name))
-        logger.debug("Copying %s into %s", ref_file, tmp_out_dir)
-        shutil.copy(ref_file, tmp_out_dir)
-
-    # CheckM files
-    logger.info("Dumping CheckM reference data.")
-    checkm_data_root = get_ref_path(config.CHECKM_DATA_ROOT)
-    dest_dir = os.path.join(tmp_out_dir, config.CHECKM_DATA_ROOT)
-    logger.debug("Copying %s to %s", checkm_data_root, dest_dir)
-    shutil.copytree(checkm_data_root, dest_dir)
-
-    # ShigaPass files
-    logger.info("Dumping ShigaPass reference data.")
-    shigapass_script = get_ref_path(config.SHIGAPASS_SCRIPT)
-    shigapass_db_dir = get_ref_path(config.SHIGAPASS_DB_DIR)
-    dest_script = os.path.join(tmp_out_dir, config.SHIGAPASS_SCRIPT)
-    dest_db_dir = os.path.join(tmp_out_dir, config.SHIGAPASS_DB_DIR)
-    logger.debug("Copying %s to %s", shigapass_script, dest_script)
-    logger.debug("Copying %s to %s", shigapass_db_dir, dest_db_dir)
-    os.makedirs(os.path.dirname(dest_script), exist_ok=True)
-    shutil.copy(shigapass_script, dest_script)
-    shutil.copytree(shigapass_db_dir, dest_db_dir)
-
-    # Writing inf.json file
-    out_json_file = os.path.join(tmp_out_dir, config.REFERENCE_INF)
-    logger.info("Writing reference info. [version=%s, type=%s]", ref_inf["version"], ref_inf["type"])
-    with open(out_json_file, "w") as f:
-        json.dump(ref_inf, f)
+        files.append((ref_file, os.path.basename(ref_file)))
+    # ShigaPass script
+    files.append((get_ref_path(config.SHIGAPASS_SCRIPT), config.SHIGAPASS_SCRIPT))
+    # CheckM and ShigaPass reference data
+    dirs = [
+        (get_ref_path(config.CHECKM_DATA_ROOT), config.CHECKM_DATA_ROOT),
+        (get_ref_path(config.SHIGAPASS_DB_DIR), config.SHIGAPASS_DB_DIR),
+    ]
+    for file_name, _ in files + dirs:
+        if not os.path.exists(file_name):
+            logger.error("Reference file not found. [%s] Aborted.", file_name)
+            exit(1)
 
-    # Making tarball
-    if args.output:
-        # clean args.output and then append .tar.gz
-        out_tar_name = args.output.replace(".tar", "").replace(".gz", "") + ".tar.gz"
-    else:
-        out_tar_name = "dqc_reference_compact.tar.gz"
-    logger.info(f"Archiving the reference data into {out_tar_name}")
-    subprocess.run(f"tar cfz {out_tar_name} {tmp_out_dir}", shell=True)
-    logger.debug("Deleting temporary directory '%s'", tmp_out_dir)
-    shutil.rmtree(tmp_out_dir)
+    # Files are streamed directly into the tarball (no staging copy).
+    from dqc.reference_bundle import write_bundle
+    logger.info("Writing reference info. [version=%s, type=%s]", ref_inf["version"], ref_inf["type"])
+    extra_files = {config.REFERENCE_INF: json.dumps(ref_inf).encode()}
+    part_size = args.split_size * 1024 * 1024
+    logger.info(f"Archiving the reference data into {out_tar_name} using {args.num_threads} threads.")
+    write_bundle(out_tar_name, files, dirs, extra_files=extra_files, num_threads=args.num_threads,
+                 part_size=part_size, metadata=ref_inf, objects_dir=args.objects_dir)
     logger.info(f"Done.")
 
 def download_dqc_reference(args):
@@ -106,6 +89,15 @@ def download_dqc_reference(args):
     else:
         base_name = "dqc_reference_compact_latest.tar.gz"
 
+    # Versioned snapshots: a new version is prepared in a new snapshot directory and then switched atomically,
+    # so that running jobs keep using the version they started with.
+    from dqc.reference_snapshot import is_snapshot_layout, get_current_snapshot, new_snapshot_dir, commit_snapshot, \
+        discard_snapshot_dir, gc_snapshots
+    root_dir = config.DQC_REFERENCE_DIR
+    use_snapshot = args.snapshot or is_snapshot_layout(root_dir)
+    if is_snapshot_layout(root_dir):
+        config.DQC_REFERENCE_DIR = get_current_snapshot(root_dir)
+
     # Check existing data    
     dqc_reference_dir = config.DQC_REFERENCE_DIR
     if os.path.exists(dqc_reference_dir):
@@ -125,30 +117,71 @@ def download_dqc_reference(args):
     else:
         logger.info("Try to download DQC_REFERENCE_COMPACT into a new directory '%s'.", dqc_reference_dir)
 
-    url = DQC_REF_URL + base_name
+    from dqc.reference_bundle import download_and_extract, fetch_manifest, is_delta_available, delta_update
+    base_url = (args.source_url or DQC_REF_URL).rstrip("/")
+    url = base_url + "/" + base_name
+
+    # Delta update: only the changed blocks are downloaded if the server publishes a manifest with block hashes.
+    manifest = fetch_manifest(url)
+    local_manifest_file = get_ref_path(config.REFERENCE_MANIFEST)
+    if os.path.exists(dqc_reference_dir) and ref_type == "compact" and not args.full and is_delta_available(manifest):
+        if manifest.get("version") == ref_version and not args.force:
+            logger.info("DQC_REFERENCE_COMPACT is up to date. [version=%s]", ref_version)
+            return
+        local_manifest = json.load(open(local_manifest_file)) if os.path.exists(local_manifest_file) else None
+        logger.info("Updating DQC_REFERENCE_COMPACT from version %s to %s (delta update)", ref_version, manifest.get("version"))
+        target_dir = new_snapshot_dir(root_dir, base_dir=dqc_reference_dir) if use_snapshot else dqc_reference_dir
+        try:
+            num_updated, downloaded_bytes = delta_update(manifest, base_url, target_dir, local_manifest,
+                                                         num_threads=args.num_threads)
+        except Exception as e:
+            logger.error("Delta update failed. [%s] Please run this script again with '--full' option.", e)
+            if use_snapshot:
+                discard_snapshot_dir(target_dir)
+            exit(1)
+        with open(os.path.join(target_dir, config.REFERENCE_MANIFEST), "w") as f:
+            json.dump(manifest, f)
+        if use_snapshot:
+            config.DQC_REFERENCE_DIR = commit_snapshot(root_dir, target_dir, manifest.get("version", "n.a."))
+            gc_snapshots(root_dir)
+        ref_inf = get_ref_inf()
+        logger.info("Updated %d files (downloaded %d bytes). [version=%s, type=%s]", num_updated, downloaded_bytes,
+                    ref_inf.get("version", "n.a."), ref_inf.get("type", "n.a."))
+        return
+
     tmp_work_dir = "tmp_" + datetime.now().strftime("%Y%m%d_%H%M%S")
     logger.debug("Creating temporary working directory '%s'", tmp_work_dir)
     os.makedirs(tmp_work_dir)
     logger.info("Downloading DQC_REFERENCE_COMPACT from %s", url)
-    dest_path = os.path.join(tmp_work_dir, base_name)
+    # Downloaded data is extracted as it arrives. The partially downloaded file is kept in the current directory,
+    # so that the download can be resumed by running this script again.
     try:
-        urlretrieve(url, dest_path)
+        download_and_extract(url, tmp_work_dir, work_dir=".", num_threads=args.num_threads, manifest=manifest)
     except HTTPError as e:
         logger.error("HTTPError. Failed to download resources from %s", url)
         if args.date:
             logger.error("Please check the database version you specified. [%s]", args.date)
-        if os.path.exists(tmp_work_dir):
-            shutil.rmtree(tmp_work_dir)
+        shutil.rmtree(tmp_work_dir)
         exit(1)
     except URLError as e:
         logger.error("URLError. Failed to download resources from %s", url)
+        shutil.rmtree(tmp_work_dir)
+        exit(1)
+    except Exception as e:
+        logger.error("Failed to download or extract %s. [%s] Run this script again to resume the download.", base_name, e)
+        shutil.rmtree(tmp_work_dir)
         exit(1)
 
-    logger.info(f"Downloaded {base_name}. Extracting...")
-    safe_tar_extraction(dest_path, tmp_work_dir)
+    logger.info(f"Downloaded and extracted {base_name}.")
     extracted_dir = os.path.join(tmp_work_dir, "dqc_reference_compact")
 
-    if not os.path.exists(dqc_reference_dir):
+    if is_delta_available(manifest):
+        with open(os.path.join(extracted_dir, config.REFERENCE_MANIFEST), "w") as f:
+            json.dump(manifest, f)
+
+    if use_snapshot:
+        dqc_reference_dir = new_snapshot_dir(root_dir)
+    elif not os.path.exists(dqc_reference_dir):
         logger.info("Creating directory %s", dqc_reference_dir)
         os.makedirs(dqc_reference_dir)
 
@@ -161,12 +194,43 @@ def download_dqc_reference(args):
             shutil.rmtree(dst)
         shutil.move(src, dst)
     shutil.rmtree(tmp_work_dir)
+    if use_snapshot:
+        ref_inf = json.load(open(os.path.join(dqc_reference_dir, config.REFERENCE_INF)))
+        dqc_reference_dir = commit_snapshot(root_dir, dqc_reference_dir, ref_inf.get("version", "n.a."))
+        config.DQC_REFERENCE_DIR = dqc_reference_dir
+        gc_snapshots(root_dir)
     ref_inf = get_ref_inf()
     ref_version = ref_inf.get("version", "n.a.")
     ref_type = ref_inf.get("type", "n.a.")
     logger.info("Data retrieved into %s, [version=%s, type=%s]", dqc_reference_dir, ref_version, ref_type)
     logger.info("Please run this script again to update the reference.")
 
+def create_snapshot(args):
+    """
+    Publish reference data built in place (e.g. by 'dqc_admin_tools.py update_all') as a new snapshot.
+    """
+    from dqc.reference_snapshot import new_snapshot_dir, commit_snapshot, gc_snapshots
+    root_dir = config.DQC_REFERENCE_DIR
+    src_dir = args.src_dir or root_dir
+    if not os.path.exists(os.path.join(src_dir, config.REFERENCE_INF)):
+        logger.error("Reference info is not found in '%s'. Aborted.", src_dir)
+        exit(1)
+    ref_inf = json.load(open(os.path.join(src_dir, config.REFERENCE_INF)))
+    version = args.name or ref_inf.get("version", datetime.now().strftime("%Y-%m-%d"))
+    # Files are copied, as the source directory may be updated in place later.
+    tmp_dir = new_snapshot_dir(root_dir, base_dir=src_dir, copy=True)
+    snapshot_dir = commit_snapshot(root_dir, tmp_dir, version)
+    logger.info("Reference snapshot %s is now current. [version=%s, type=%s]", snapshot_dir,
+                ref_inf.get("version", "n.a."), ref_inf.get("type", "n.a."))
+    gc_snapshots(root_dir)
+
+def cleanup_snapshots(args):
+    from dqc.reference_snapshot import gc_snapshots, list_snapshots, get_current_snapshot
+    root_dir = config.DQC_REFERENCE_DIR
+    removed = gc_snapshots(root_dir)
+    logger.info("Deleted %d snapshots. Current snapshot: %s", len(removed), get_current_snapshot(root_dir))
+    logger.info("Remaining snapshots: %s", ", ".join(list_snapshots(root_dir)))
+
 def parse_args():
     parser = ArgumentParser(description="DFAST_QC utility tools for admin.")
     subparsers = parser.add_subparsers(help="")
@@ -183,14 +247,44 @@ def parse_args():
         help="Output file name. ('.tar.gz' will be appended.)")
     parser_dump.add_argument("-d", "--date", default=None, type=str, metavar="YYYYMMDD",
         help="Time stamp for reference data. (default=TODAY)")
+    parser_dump.add_argument("-n", "--num_threads", default=1, type=int, metavar="INT",
+        help="Number of threads for compression (default: 1)")
+    parser_dump.add_argument("--split_size", default=0, type=int, metavar="MB",
+        help="Split the archive into parts (.000, .001, ...) of the specified size in MB. Publish the parts and the manifest " \
+             "with their names unchanged; 'download' reads the parts listed in the manifest. (default: 0, not split)")
+    parser_dump.add_argument("--objects_dir", default=None, type=str, metavar="PATH",
+        help="Directory to store block objects for delta updates. Publish it as 'objects' next to the tarball.")
     parser_dump.set_defaults(func=dump_dqc_reference)
 
     # subparser for dump reference data
     parser_download = subparsers.add_parser('download', help='Download/update reference data for DQC_REFERENCE_COMPACT (.tar.gz file).', parents=[common_parser])
     parser_download.add_argument("-v", "--date", default=None, type=str, metavar="YYYYMMDD",
         help="Time stamp of reference data to be downloaded. (default=latest)")
+    parser_download.add_argument("-n", "--num_threads", default=4, type=int, metavar="INT",
+        help="Number of parallel connections for downloading (default: 4)")
+    parser_download.add_argument("--full", action="store_true",
+        help="Download the whole reference data even if delta update is available.")
+    parser_download.add_argument("--force", action="store_true",
+        help="Update even if the local reference data is the same version.")
+    parser_download.add_argument("--source_url", default=None, type=str, metavar="URL",
+        help=f"Base URL of the reference data (default: {DQC_REF_URL})")
+    parser_download.add_argument("--snapshot", action="store_true",
+        help="Store the reference data as a versioned snapshot and switch to it atomically. " \
+             "(Enabled automatically if the reference directory already uses snapshots)")
     parser_download.set_defaults(func=download_dqc_reference)
 
+    # subparser for creating a snapshot
+    parser_snapshot = subparsers.add_parser('snapshot', help='Publish reference data as a new versioned snapshot and make it current.', parents=[common_parser])
+    parser_snapshot.add_argument("--src_dir", default=None, type=str, metavar="PATH",
+        help="Directory containing the reference data. (default: reference files directly under --ref_dir)")
+    parser_snapshot.add_argument("--name", default=None, type=str, metavar="STR",
+        help="Name of the snapshot. (default: version in dqc_ref_inf.json)")
+    parser_snapshot.set_defaults(func=create_snapshot)
+
+    # subparser for garbage collection of snapshots
+    parser_gc = subparsers.add_parser('gc', help='Delete reference snapshots not used by running jobs.', parents=[common_parser])
+    parser_gc.set_defaults(func=cleanup_snapshots)
+
 
     args = parser.parse_args()
     if not hasattr(args, "func"):
@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+"""
+Query the DFAST_QC results database (dfast_qc/dqc_multi --results_db)
+
+    dqc_results.py import -d results.db dqc_out/          # backfill from existing dqc_result.json files
+    dqc_results.py status -d results.db --since 2024-06-01
+    dqc_results.py species -d results.db --taxid 562
+    dqc_results.py list -d results.db --status inconclusive --since 2024-06-01
+    dqc_results.py export -d results.db -o results.parquet
+"""
+import os
+import sys
+from datetime import datetime
+from argparse import ArgumentParser
+from dqc.config import config
+
+config.ADMIN = True
+
+
+def parse_date(value):
+    for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S", "%Y%m%d"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    logger.error("Invalid date '%s'. Specify date in 'YYYY-MM-DD'. Aborted.", value)
+    exit(1)
+
+
+def get_filters(args):
+    return {
+        "status": getattr(args, "status", None),
+        "species_taxid": getattr(args, "taxid", None),
+        "gtdb_species": getattr(args, "gtdb_species", None),
+        "since": parse_date(args.since) if args.since else None,
+        "until": parse_date(args.until) if args.until else None,
+        "latest_only": args.latest_only,
+    }
+
+
+def open_results_db(args):
+    from dqc.results_db import open_db
+    if not os.path.exists(args.db):
+        logger.error("Results database not found. [%s] Aborted.", args.db)
+        exit(1)
+    open_db(args.db)
+
+
+def import_results(args):
+    from dqc.results_db import import_results
+    imported, skipped = import_results(args.db, args.dirs)
+    logger.info("Imported %d results into %s (%d already imported).", imported, args.db, skipped)
+
+
+def show_status(args):
+    from dqc.results_db import count_by_status
+    open_results_db(args)
+    counts = count_by_status(**get_filters(args))
+    total = sum(cnt for _, cnt in counts)
+    print("tc_status\tcount\tratio")
+    for status, cnt in counts:
+        print(f"{status or '-'}\t{cnt}\t{cnt / total:.3f}")
+    print(f"total\t{total}\t1.000")
+
+
+def show_species(args):
+    from dqc.results_db import count_by_species, get_distribution
+    open_results_db(args)
+    filters = get_filters(args)
+    if args.taxid is None and args.gtdb_species is None:
+        print("species_taxid\torganism_name\tcount")
+        for taxid, organism_name, cnt in count_by_species(limit=args.limit, **filters):
+            print(f"{taxid if taxid is not None else '-'}\t{organism_name or '-'}\t{cnt}")
+        return
+    fields = ["completeness", "contamination", "strain_heterogeneity", "ani", "ungapped_genome_size"]
+    print("field\tn\tmin\tq1\tmedian\tq3\tmax\tmean")
+    for field in fields:
+        dist = get_distribution(field, **filters)
+        if dist["n"] == 0:
+            print(f"{field}\t0" + "\t-" * 6)
+        else:
+            values = [dist[key] for key in ["min", "q1", "median", "q3", "max", "mean"]]
+            print(f"{field}\t{dist['n']}\t" + "\t".join(f"{value:.2f}" for value in values))
+
+
+def list_runs(args):
+    from dqc.results_db import select_runs
+    open_results_db(args)
+    query = select_runs(**get_filters(args))
+    if args.limit:
+        query = query.limit(args.limit)
+    print("completed_at\tquery\ttc_status\torganism_name\tani\tcompleteness\tcontamination\tout_dir")
+    for run in query:
+        values = [run.completed_at.strftime("%Y-%m-%d %H:%M:%S"), run.query, run.tc_status, run.organism_name,
+                  run.ani, run.completeness, run.contamination, run.out_dir]
+        print("\t".join("-" if value is None else str(value) for value in values))
+
+
+def export_results(args):
+    from dqc.results_db import select_runs, export_runs
+    open_results_db(args)
+    fmt = args.format or ("parquet" if args.output.endswith(".parquet") else "tsv")
+    cnt = export_runs(args.output, select_runs(**get_filters(args)), fmt=fmt)
+    logger.info("Exported %d results to %s", cnt, args.output)
+
+
+def parse_args():
+    parser = ArgumentParser(description="Query the DFAST_QC results database.")
+    subparsers = parser.add_subparsers(help="")
+
+    # common parser
+    common_parser = ArgumentParser(add_help=False)
+    common_parser.add_argument('--debug', action='store_true', help='Debug mode')
+    common_parser.add_argument("-d", "--db", required=True, type=str, metavar="PATH",
+        help="Results database (created by 'dfast_qc --results_db')")
+
+    # filters of the results
+    filter_parser = ArgumentParser(add_help=False)
+    filter_parser.add_argument("--since", default=None, type=str, metavar="YYYY-MM-DD",
+        help="Results completed on or after this date")
+    filter_parser.add_argument("--until", default=None, type=str, metavar="YYYY-MM-DD",
+        help="Results completed before this date")
+    filter_parser.add_argument("--latest_only", action="store_true",
+        help="Use only the latest result of each query genome")
+
+    parser_import = subparsers.add_parser('import', help="Import dqc_result.json files under the directories.", parents=[common_parser])
+    parser_import.add_argument("dirs", nargs="+", type=str, metavar="DIR",
+        help="Directories to be searched for dqc_result.json")
+    parser_import.set_defaults(func=import_results)
+
+    parser_status = subparsers.add_parser('status', help="Number of results by taxonomy check status.", parents=[common_parser, filter_parser])
+    parser_status.add_argument("--taxid", default=None, type=int, metavar="INT",
+        help="Species taxid of the top hit")
+    parser_status.set_defaults(func=show_status)
+
+    parser_species = subparsers.add_parser('species', help="Number of results by species, or distribution of completeness, contamination, etc. for a species.", parents=[common_parser, filter_parser])
+    parser_species.add_argument("--taxid", default=None, type=int, metavar="INT",
+        help="Species taxid of the top hit")
+    parser_species.add_argument("--gtdb_species", default=None, type=str, metavar="STR",
+        help="GTDB species of the top hit, e.g. 's__Escherichia coli'")
+    parser_species.add_argument("--status", default=None, type=str, metavar="STR",
+        help="Taxonomy check status, e.g. conclusive")
+    parser_species.add_argument("-l", "--limit", default=20, type=int, metavar="INT",
+        help="Number of species to show (default: 20)")
+    parser_species.set_defaults(func=show_species)
+
+    parser_list = subparsers.add_parser('list', help="List results.", parents=[common_parser, filter_parser])
+    parser_list.add_argument("--status", default=None, type=str, metavar="STR",
+        help="Taxonomy check status, e.g. inconclusive")
+    parser_list.add_argument("--taxid", default=None, type=int, metavar="INT",
+        help="Species taxid of the top hit")
+    parser_list.add_argument("--gtdb_species", default=None, type=str, metavar="STR",
+        help="GTDB species of the top hit")
+    parser_list.add_argument("-l", "--limit", default=None, type=int, metavar="INT",
+        help="Maximum number of results")
+    parser_list.set_defaults(func=list_runs)
+
+    parser_export = subparsers.add_parser('export', help="Export results as TSV or Parquet (requires pyarrow).", parents=[common_parser, filter_parser])
+    parser_export.add_argument("-o", "--output", required=True, type=str, metavar="PATH",
+        help="Output file. Parquet format if it ends with '.parquet'")
+    parser_export.add_argument("--format", default=None, choices=["tsv", "parquet"],
+        help="Output format (default: inferred from the file extension)")
+    parser_export.add_argument("--status", default=None, type=str, metavar="STR",
+        help="Taxonomy check status")
+    parser_export.add_argument("--taxid", default=None, type=int, metavar="INT",
+        help="Species taxid of the top hit")
+    parser_export.set_defaults(func=export_results)
+
+    if len(sys.argv) == 1:
+        parser.print_help()
+        exit()
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.debug:
+        config.DEBUG = True
+    from dqc.common import get_logger
+    logger = get_logger(__name__)
+
+    args.func(args)
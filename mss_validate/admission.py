@@ -0,0 +1,227 @@
+"""
+Memory-aware admission of DFAST_QC jobs for batch execution (see batch_dqc.run_dqc_parallel)
+
+Peak memory of a job is estimated from the size of the query genome and the enabled stages. The stages run
+one after another, so the estimate is the largest of them. A job is started only when the estimates of the running
+jobs plus its own fit into the memory budget, and only while the available memory of the node (or the container)
+stays above a headroom. The actual memory of the running jobs (RSS of their process trees) is monitored,
+and is used instead of the estimate when it is larger.
+"""
+import os
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+MB = 1024 * 1024
+
+# Rough peak memory of each stage in MB: fixed part and part proportional to the genome size (per Mbp).
+# They can be calibrated with the peak RSS of external commands recorded in the metrics section of dqc_result.json.
+STAGE_MEMORY_MB = {
+    "base": (250, 0),  # dfast_qc itself (reference DB and taxonomy lookups)
+    "taxonomy_check": (1200, 40),  # mash dist against the reference sketch, skani search
+    "completeness_check": (1500, 80),  # CheckM taxonomy_wf (prodigal, hmmer)
+    "gtdb_search": (1500, 40),
+    "shigapass": (600, 20),  # blastn
+}
+GZIP_RATIO = 3.5  # uncompressed / gzipped size of genomic FASTA, to estimate the genome size of .gz files
+BUDGET_RATIO = 0.9  # ratio of the available memory at the start used as the budget, unless --max_memory is given
+HEADROOM_MB = 512  # admissions are paused while the available memory is below this
+POLL_INTERVAL = 1.0  # seconds
+
+
+def estimate_genome_size(fasta_file):
+    """
+    Approximate genome size in bp from the file size
+    """
+    size = os.path.getsize(fasta_file)
+    if fasta_file.endswith(".gz"):
+        size *= GZIP_RATIO
+    return int(size)
+
+
+def estimate_job_memory(fasta_file, disable_tc=False, disable_cc=False, enable_gtdb=False):
+    """
+    Estimated peak memory (bytes) of a dfast_qc job
+    """
+    genome_mbp = estimate_genome_size(fasta_file) / 1e6
+    stages = []
+    if not disable_tc:
+        stages += ["taxonomy_check", "shigapass"]
+    if not disable_cc:
+        stages.append("completeness_check")
+    if enable_gtdb:
+        stages.append("gtdb_search")
+    memory = {stage: fixed + per_mbp * genome_mbp for stage, (fixed, per_mbp) in STAGE_MEMORY_MB.items()}
+    peak = max([memory[stage] for stage in stages] + [0])
+    return int((memory["base"] + peak) * MB)
+
+
+def _read_int(file_name):
+    try:
+        with open(file_name) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    return None if value == "max" else int(value)
+
+
+def get_cgroup_available():
+    """
+    Memory available within the cgroup limit (bytes), or None if there is no limit. Supports cgroup v2 and v1.
+    """
+    for limit_file, usage_file in [("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                                   ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")]:
+        limit = _read_int(limit_file)
+        if limit is None or limit >= 1 << 60:  # cgroup v1 reports a huge number when unlimited
+            continue
+        usage = _read_int(usage_file) or 0
+        return max(limit - usage, 0)
+    return None
+
+
+def get_available_memory():
+    """
+    MemAvailable of the node, or the memory available within the cgroup limit if smaller (bytes)
+    """
+    available = None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    available = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        pass
+    cgroup_available = get_cgroup_available()
+    if cgroup_available is not None:
+        available = cgroup_available if available is None else min(available, cgroup_available)
+    return available
+
+
+def get_tree_rss(pids):
+    """
+    Total RSS (bytes) of each process and its descendants, as a dict of {pid: rss}. /proc is scanned once for all the pids.
+    """
+    children = {}
+    rss = {}
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    try:
+        proc_pids = [int(name) for name in os.listdir("/proc") if name.isdigit()]
+    except OSError:
+        return {pid: 0 for pid in pids}
+    for proc_pid in proc_pids:
+        try:
+            with open(f"/proc/{proc_pid}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        fields = stat[stat.rindex(")") + 2:].split()  # fields after the command name
+        children.setdefault(int(fields[1]), []).append(proc_pid)  # ppid
+        rss[proc_pid] = int(fields[21]) * page_size
+    ret = {}
+    for pid in pids:
+        total, stack = 0, [pid]
+        while stack:
+            proc_pid = stack.pop()
+            total += rss.get(proc_pid, 0)
+            stack.extend(children.get(proc_pid, []))
+        ret[pid] = total
+    return ret
+
+
+class MemoryGate:
+    """
+    Admission of jobs in FIFO order. Use as:
+
+        with gate.admit(job_name, estimate) as job:
+            p = subprocess.Popen(...)
+            job.pid = p.pid  # to monitor the actual memory
+    """
+    def __init__(self, max_memory=None, headroom=HEADROOM_MB * MB):
+        if max_memory is None:
+            available = get_available_memory()
+            max_memory = int(available * BUDGET_RATIO) if available else None
+        self.budget = max_memory  # None: no limit (memory cannot be determined)
+        self.headroom = headroom
+        self.cond = threading.Condition()
+        self.running = set()
+        self.queue = []  # waiting jobs in order of arrival
+        self.paused = False
+        self.closed = threading.Event()
+        if self.budget:
+            logger.warning(f"Memory budget for DFAST_QC jobs: {self.budget / MB / 1024:.1f} GB")
+        self.monitor_thread = threading.Thread(target=self._monitor, daemon=True)
+        self.monitor_thread.start()
+
+    def admit(self, name, estimate):
+        return _Admission(self, name, estimate)
+
+    def committed(self):
+        return sum(max(job.estimate, job.peak_rss) for job in self.running)
+
+    def _can_start(self, job):
+        if self.queue[0] is not job:
+            return False
+        if not self.running:  # always start one job, even if it is estimated to exceed the budget
+            return True
+        if self.paused:
+            return False
+        return self.budget is None or self.committed() + job.estimate <= self.budget
+
+    def _acquire(self, job):
+        with self.cond:
+            self.queue.append(job)
+            while not self._can_start(job):
+                self.cond.wait(POLL_INTERVAL)
+            self.queue.pop(0)
+            self.running.add(job)
+            if self.budget and job.estimate > self.budget:
+                logger.warning(f"{job.name} is estimated to use {job.estimate / MB:.0f} MB, more than the memory budget. Running it alone.")
+            self.cond.notify_all()
+
+    def _release(self, job):
+        with self.cond:
+            self.running.discard(job)
+            self.cond.notify_all()
+        if job.peak_rss > job.estimate:
+            logger.warning(f"{job.name} used {job.peak_rss / MB:.0f} MB, more than the estimate ({job.estimate / MB:.0f} MB)")
+
+    def close(self):
+        self.closed.set()
+        self.monitor_thread.join()
+
+    def _monitor(self):
+        while not self.closed.wait(POLL_INTERVAL):
+            with self.cond:
+                jobs = [job for job in self.running if job.pid]
+            tree_rss = get_tree_rss([job.pid for job in jobs]) if jobs else {}
+            for job in jobs:
+                job.peak_rss = max(job.peak_rss, tree_rss[job.pid])
+            available = get_available_memory()
+            with self.cond:
+                paused = available is not None and available < self.headroom
+                if paused != self.paused:
+                    if paused:
+                        logger.warning(f"Available memory is low ({available / MB:.0f} MB). New jobs are paused.")
+                    else:
+                        logger.warning("Available memory recovered. Resuming new jobs.")
+                    self.paused = paused
+                self.cond.notify_all()
+
+
+class _Admission:
+    def __init__(self, gate, name, estimate):
+        self.gate = gate
+        self.name = name
+        self.estimate = estimate
+        self.pid = None
+        self.peak_rss = 0
+
+    def __enter__(self):
+        self.gate._acquire(self)
+        return self
+
+    def __exit__(self, *exc):
+        self.gate._release(self)
+        return False
@@ -19,6 +19,7 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 import subprocess
 # import log module
 import logging
+from .admission import MemoryGate, estimate_job_memory
 
 
 
@@ -42,10 +43,15 @@ def parse_args():
     return args
 
 
-def run_dqc(input_fasta, out_dir, taxid=None, ref_dir=None, disable_tc=False, disable_cc=False, disable_shigapass=False, enable_gtdb=False):
+def run_dqc(input_fasta, out_dir, taxid=None, ref_dir=None, disable_tc=False, disable_cc=False, disable_shigapass=False, enable_gtdb=False, results_db=None, job=None):
+    """
+    job: admission by MemoryGate. The pid of DFAST_QC is set to it to monitor its memory usage.
+    """
     dqc_command = DQC_BASE_COMMAND.format(input_fasta=input_fasta, out_dir=out_dir)
     if ref_dir:
         dqc_command += f" --ref_dir {ref_dir}"
+    if results_db:
+        dqc_command += f" --results_db {results_db}"
     if taxid >= 0:  # -1 for auto, 0 for prokaryote
         dqc_command += f" --taxid {taxid}"
     if disable_cc:
@@ -58,8 +64,16 @@ def run_dqc(input_fasta, out_dir, taxid=None, ref_dir=None, disable_tc=False, di
         dqc_command += " --enable_gtdb"
     logger.warning(f"Running DFAST_QC: {dqc_command}")
     dqc_command = dqc_command.split()
-    result = subprocess.run(dqc_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8")
-    return result.stdout, result.stderr
+    p = subprocess.Popen(dqc_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding="utf-8")
+    if job is not None:
+        job.pid = p.pid
+    stdout, stderr = p.communicate()
+    return stdout, stderr
+
+def run_dqc_admitted(gate, input_fasta, out_dir, taxid=None, disable_tc=False, disable_cc=False, enable_gtdb=False, **kwargs):
+    estimate = estimate_job_memory(input_fasta, disable_tc=disable_tc, disable_cc=disable_cc, enable_gtdb=enable_gtdb)
+    with gate.admit(os.path.basename(input_fasta), estimate) as job:
+        return run_dqc(input_fasta, out_dir, taxid=taxid, disable_tc=disable_tc, disable_cc=disable_cc, enable_gtdb=enable_gtdb, job=job, **kwargs)
 
 def run_dqc_dummy(input_fasta, out_dir, taxid=None, ref_dir=None):
     dqc_command = DQC_BASE_COMMAND.format(input_fasta=input_fasta, out_dir=out_dir)
@@ -79,8 +93,13 @@ def get_fasta_files(input_dir, fasta_ext="fa,fasta,fna,fa.gz,fasta.gz,fna.gz"):
     fasta_files = list(set(fasta_files))  # remove redundant
     return fasta_files
 
-def run_dqc_parallel(fasta_files, out_dir, taxid=None, ref_dir=None, threads=1, disable_tc=False, disable_cc=False, disable_shigapass=False, enable_gtdb=False):
+def run_dqc_parallel(fasta_files, out_dir, taxid=None, ref_dir=None, threads=1, disable_tc=False, disable_cc=False, disable_shigapass=False, enable_gtdb=False, results_db=None, max_memory=None):
+    """
+    Up to threads jobs run at the same time, as long as their estimated memory fits into max_memory (bytes,
+    default: 90% of the available memory at the start). See admission.MemoryGate.
+    """
     logger.warning(f"Start running DFAST_QC using {threads} threads.")
+    gate = MemoryGate(max_memory=max_memory)
     # list_of_fasta_files = distribute(threads, fasta_files)  # divide fasta files into num of threads
     futures = []
     with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="thread") as executor:
@@ -89,9 +108,10 @@ def run_dqc_parallel(fasta_files, out_dir, taxid=None, ref_dir=None, threads=1,
             # prefix, _ext = os.path.splitext(base_name)
             
             dqc_out_dir = os.path.join(out_dir, base_name)
-            f = executor.submit(run_dqc, fasta_file, dqc_out_dir, taxid=taxid, ref_dir=ref_dir, disable_tc=disable_tc, disable_cc=disable_cc, disable_shigapass=disable_shigapass, enable_gtdb=enable_gtdb)
+            f = executor.submit(run_dqc_admitted, gate, fasta_file, dqc_out_dir, taxid=taxid, ref_dir=ref_dir, disable_tc=disable_tc, disable_cc=disable_cc, disable_shigapass=disable_shigapass, enable_gtdb=enable_gtdb, results_db=results_db)
             futures.append(f)
     results = [f.result() for f in as_completed(futures)]  # wait until all the jobs finish
+    gate.close()
     return results
 
 
@@ -4,12 +4,13 @@
 
 
 import json
-from dataclasses import dataclass, field
-from typing import List, Dict, Tuple, Optional
+from dataclasses import dataclass, field, fields, asdict
+from typing import List, Dict, Tuple, Optional, Iterable, Iterator
 import re
 import os
 import glob
 import logging
+from concurrent.futures import ProcessPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +34,7 @@ class TCResult:
     align_fraction_query: float
     ani_threshold: float
     status: str
+    ani_preset: str = "precise"  # "fast" for the hits screened but not recomputed in two-pass ANI
 
     def to_list(self):
         return [getattr(self, key) for key in tc_header]
@@ -71,6 +73,7 @@ class GTDBResult:
     min_intra_species_af: float
     num_clustered_genomes: int
     status: str
+    ani_preset: str = "precise"  # "fast" for the hits screened but not recomputed in two-pass ANI
 
     def to_list(self):
         return [getattr(self, key) for key in gtdb_header]
@@ -132,34 +135,45 @@ class SourceData:
             attrs=source_dict
         )
 
-def load_dqc_result(file_path: str) -> List[TCResult]:
+def read_json(file_path: str) -> dict:
     with open(file_path, 'r') as file:
-        data = json.load(file)
-        if "tc_result" in data:
-            tc_result_list = [TCResult(**item) for item in data["tc_result"]]
-        else:
-            tc_result_list = []
-        if "cc_result" in data and len(data["cc_result"]) > 0:
-            cc_result = CCResult(**data["cc_result"])
-        else:
-            cc_result = None
+        return json.load(file)
+
+def parse_dqc_result(data: dict) -> Tuple[List[TCResult], Optional[CCResult]]:
+    if "tc_result" in data:
+        tc_result_list = [TCResult(**item) for item in data["tc_result"]]
+    else:
+        tc_result_list = []
+    if "cc_result" in data and len(data["cc_result"]) > 0:
+        cc_result = CCResult(**data["cc_result"])
+    else:
+        cc_result = None
     return tc_result_list, cc_result
 
-def load_shigapass_result(file_path: str) -> Optional[ShigaPassResult]:
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-        if "shigapass_result" in data and len(data["shigapass_result"]) > 0:
-            return ShigaPassResult(**data["shigapass_result"])
+# keys in dqc_result.json written by dqc.shigapass_check.parse_summary (column names of ShigaPass_summary.csv)
+shigapass_json_keys = {"mlst": "MLST", "crispr": "CRISPR", "predicted_serotype": "Predicted_Serotype",
+                       "predicted_flex_serotype": "Predicted_FlexSerotype", "comments": "Comments"}
+
+def parse_shigapass_result(data: dict) -> Optional[ShigaPassResult]:
+    if "shigapass_result" in data and len(data["shigapass_result"]) > 0:
+        result = data["shigapass_result"]
+        values = {f.name: result.get(shigapass_json_keys.get(f.name, f.name), "") for f in fields(ShigaPassResult)}
+        return ShigaPassResult(**values)
     return None
 
+def parse_gtdb_result(data: dict) -> List[GTDBResult]:
+    if "gtdb_result" in data:
+        return [GTDBResult(**item) for item in data["gtdb_result"]]
+    return []
+
+def load_dqc_result(file_path: str) -> Tuple[List[TCResult], Optional[CCResult]]:
+    return parse_dqc_result(read_json(file_path))
+
+def load_shigapass_result(file_path: str) -> Optional[ShigaPassResult]:
+    return parse_shigapass_result(read_json(file_path))
+
 def load_gtdb_result(file_path: str) -> List[GTDBResult]:
-    with open(file_path, 'r') as file:
-        data = json.load(file)
-        if "gtdb_result" in data:
-            gtdb_result_list = [GTDBResult(**item) for item in data["gtdb_result"]]
-        else:
-            gtdb_result_list = []
-    return gtdb_result_list
+    return parse_gtdb_result(read_json(file_path))
 
 
 def read_mss_ann(ann_file_path: str) -> Dict[str, str]:
@@ -217,9 +231,13 @@ class DQCResult:
 
     @staticmethod
     def load(query, dqc_result_file) -> 'DQCResult':
-        tc_result_list, cc_result = load_dqc_result(dqc_result_file)
-        gtdb_result = load_gtdb_result(dqc_result_file)
-        shigapass_result = load_shigapass_result(dqc_result_file)
+        return DQCResult.from_dict(query, read_json(dqc_result_file))
+
+    @staticmethod
+    def from_dict(query, data) -> 'DQCResult':
+        tc_result_list, cc_result = parse_dqc_result(data)
+        gtdb_result = parse_gtdb_result(data)
+        shigapass_result = parse_shigapass_result(data)
         return DQCResult(query, tc_result_list, cc_result, gtdb_result, shigapass_result)
 
     def to_list(self, disable_tc=False, disable_cc=False, enable_gtdb=False):
@@ -240,19 +258,133 @@ class DQCResult:
         return ret
 
 
-def collect_dqc_results(fasta_files: List[str], out_dir: str) -> List[DQCResult]:
-    dqc_results = []
+RESULT_INDEX_FILE = "dqc_result_index.json"  # placed in out_dir. See ResultIndex
+RESULT_INDEX_VERSION = 1
+
+def get_report_data(data: dict) -> dict:
+    """
+    Parts of dqc_result.json used in the report (top hits only)
+    """
+    return {
+        "tc_result": data.get("tc_result", [])[:1],
+        "cc_result": data.get("cc_result", {}),
+        "gtdb_result": data.get("gtdb_result", [])[:1],
+        "shigapass_result": data.get("shigapass_result", {}),
+    }
+
+def _read_report_data(dqc_result_file: str, report_only: bool = True):
+    """
+    Runs in a worker process. The file is stat'ed before reading, so that a file updated during reading is read again next time.
+    report_only: keep only the parts used in the report (see get_report_data)
+    """
+    try:
+        st = os.stat(dqc_result_file)
+        data = read_json(dqc_result_file)
+        if report_only:
+            data = get_report_data(data)
+    except FileNotFoundError:
+        return None
+    except ValueError as e:  # incomplete file (the job may still be running)
+        logger.warning(f"Failed to parse {dqc_result_file}: {e}. Skipping...")
+        return None
+    return st.st_mtime_ns, st.st_size, data
+
+class ResultIndex:
+    """
+    Report data of dqc_result.json files with their mtime and size, so that re-collecting the results of
+    a large output directory reads only the files that have changed since the last collection.
+    """
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+        self.entries = {}  # relative path: [mtime_ns, size, report data]
+        self.updated = False
+        if os.path.exists(index_file):
+            try:
+                index = read_json(index_file)
+            except ValueError:
+                logger.warning(f"Result index is broken and will be recreated. [{index_file}]")
+                return
+            if index.get("version") == RESULT_INDEX_VERSION:
+                self.entries = index["files"]
+
+    def _key(self, dqc_result_file):
+        return os.path.relpath(dqc_result_file, os.path.dirname(self.index_file))
+
+    def get(self, dqc_result_file: str, st: os.stat_result) -> Optional[dict]:
+        entry = self.entries.get(self._key(dqc_result_file))
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        return None
+
+    def put(self, dqc_result_file: str, mtime_ns: int, size: int, data: dict):
+        self.entries[self._key(dqc_result_file)] = [mtime_ns, size, data]
+        self.updated = True
+
+    def save(self):
+        if not self.updated:
+            return
+        tmp_file = f"{self.index_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"version": RESULT_INDEX_VERSION, "files": self.entries}, f)
+        os.replace(tmp_file, self.index_file)
+
+def iter_dqc_results(fasta_files: List[str], out_dir: str, num_workers: int = 1, use_index: bool = True, report_only: bool = True) -> Iterator[DQCResult]:
+    """
+    Yield results in the order of fasta_files as soon as they are loaded. Files are parsed in parallel by num_workers
+    processes, and only once each. With use_index=True, unchanged files are not read again (see ResultIndex).
+    With report_only=True, DQCResult objects contain only the top hits used in the report. Otherwise they contain
+    all the hits, and the index (which holds the report data only) is not used.
+    """
+    use_index = use_index and report_only
+    index = ResultIndex(os.path.join(out_dir, RESULT_INDEX_FILE)) if use_index else None
+    tasks = []  # (query, dqc_result_file, report data if cached)
     for fasta_file in fasta_files:
         query = os.path.basename(fasta_file)
         dqc_result_file = os.path.join(out_dir, query, "dqc_result.json")
-        if not os.path.exists(dqc_result_file):
+        try:
+            st = os.stat(dqc_result_file)
+        except FileNotFoundError:
             logger.warning(f"File not found: {dqc_result_file}. The task may have failed. Skipping...")
             continue
-        dqc_result = DQCResult.load(query, dqc_result_file)
-        dqc_results.append(dqc_result)
-    return dqc_results
-
-def save_report(dqc_results: List[DQCResult], output_file: str, disable_tc=False, disable_cc=False, enable_gtdb=False):
+        tasks.append((query, dqc_result_file, index.get(dqc_result_file, st) if index else None))
+    files_to_read = [dqc_result_file for _, dqc_result_file, data in tasks if data is None]
+    if index is not None:
+        logger.info(f"Loading {len(files_to_read)} result files ({len(tasks) - len(files_to_read)} unchanged)")
+    executor = None
+    if num_workers > 1 and len(files_to_read) > 1:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        chunksize = max(1, min(256, len(files_to_read) // (num_workers * 4)))
+        loaded = executor.map(_read_report_data, files_to_read, [report_only] * len(files_to_read), chunksize=chunksize)
+    else:
+        loaded = (_read_report_data(dqc_result_file, report_only) for dqc_result_file in files_to_read)
+    try:
+        for query, dqc_result_file, data in tasks:
+            if data is None:
+                ret = next(loaded)
+                if ret is None:
+                    continue
+                mtime_ns, size, data = ret
+                if index is not None:
+                    index.put(dqc_result_file, mtime_ns, size, data)
+            yield DQCResult.from_dict(query, data)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        if index is not None:
+            index.save()
+
+def collect_dqc_results(fasta_files: List[str], out_dir: str, num_workers: int = 1) -> List[DQCResult]:
+    """
+    Results with all the hits. Use iter_dqc_results for the report.
+    """
+    return list(iter_dqc_results(fasta_files, out_dir, num_workers=num_workers, use_index=False, report_only=False))
+
+def save_report(dqc_results: Iterable[DQCResult], output_file: str, disable_tc=False, disable_cc=False, enable_gtdb=False):
+    """
+    dqc_results can be an iterator (e.g. iter_dqc_results). Rows are written as the results arrive.
+    Returns the number of rows.
+    """
+    cnt = 0
     with open(output_file, 'w') as f:
         header = ["query"]
         if not disable_cc:
@@ -265,6 +397,37 @@ def save_report(dqc_results: List[DQCResult], output_file: str, disable_tc=False
         f.write("\t".join(header) + "\n")
         for dqc_result in dqc_results:
             f.write("\t".join(map(str, dqc_result.to_list(disable_tc, disable_cc, enable_gtdb))) + "\n")
+            cnt += 1
+    return cnt
+
+
+class SpeciesTaxidIndex:
+    """
+    Species names declared in ANN files resolved to species taxids with the NCBI taxonomy of the DQC reference data
+    (which also resolves synonyms). Each name is resolved only once. Without ref_dir, names are not resolved.
+    config.DQC_REFERENCE_DIR must be set to ref_dir by the caller (see the command line entry point below).
+    Raises FileNotFoundError if the NCBI taxonomy DB is not found in the reference directory.
+    """
+    def __init__(self, ref_dir: Optional[str] = None):
+        self.ref_dir = ref_dir
+        self.taxids = {}  # species name: species taxid (None if not resolved)
+        self.resolver = None
+        if ref_dir:
+            from dqc.config import config
+            from dqc.common import get_ref_path
+            ete3_db_file = get_ref_path(config.ETE3_SQLITE_DB)
+            # checked here, because dqc.ete3_helper exits with status 0 if the DB is missing
+            if not os.path.isfile(ete3_db_file):
+                raise FileNotFoundError(f"NCBI taxonomy DB is not found in the reference directory. [{ete3_db_file}]")
+            from dqc.ete3_helper import get_taxid
+            self.resolver = get_taxid
+
+    def get(self, species_name: str) -> Optional[int]:
+        if self.resolver is None:
+            return None
+        if species_name not in self.taxids:
+            self.taxids[species_name] = self.resolver(species_name, "species")
+        return self.taxids[species_name]
 
 
 @dataclass
@@ -279,27 +442,46 @@ class DQCResult_MSS:  # For MSS validation
     comments: List[str] = field(default_factory=list)
 
     @staticmethod
-    def load(fasta_file: str, out_dir: str) -> 'DQCResult_MSS':
+    def load(fasta_file: str, out_dir: str, source: Optional[SourceData] = None) -> 'DQCResult_MSS':
+        """
+        If source is given (e.g. cached by MSSValidationState), the ANN file is not read.
+        """
         ann_file, dqc_result_file = get_associated_files(fasta_file, out_dir)
-        source = SourceData.load_from_ann(ann_file)
+        if source is None:
+            source = SourceData.load_from_ann(ann_file)
         tc_result_list, cc_result = load_dqc_result(dqc_result_file)
         return DQCResult_MSS(fasta_file, source, tc_result_list, cc_result)
 
     def set_best_hit(self):
         if self.tc_result_list:
-            self.best_hit = sorted(self.tc_result_list, key=lambda x: -x.ani)[0]
-            
-
-    def set_declared_species_hit(self):
-        organism = self.source.organism
-        declared_species_name = " ".join(organism.split()[:2])
-        for tc_result in sorted(self.tc_result_list, key=lambda x: -x.ani):
-            if tc_result.organism_name == declared_species_name:
-                self.declared_species_hit = tc_result
-                break
+            self.best_hit = max(self.tc_result_list, key=lambda x: x.ani)
+
+    def get_declared_species_name(self) -> str:
+        return " ".join(self.source.organism.split()[:2])
+
+    def set_declared_species_hit(self, species_index: Optional[SpeciesTaxidIndex] = None):
+        """
+        Hit with the highest ANI among the hits to the declared species.
+        Hits are matched by the species taxid of the declared name, resolved by species_index (reference taxonomy) or,
+        if not resolved, taken from the hits of this submission with the declared name. Hits with the declared name
+        always match.
+        """
+        declared_species_name = self.get_declared_species_name()
+        taxid = species_index.get(declared_species_name) if species_index else None
+        if taxid is not None:
+            taxids = {taxid}
+        else:
+            taxids = {tc_result.species_taxid for tc_result in self.tc_result_list if tc_result.organism_name == declared_species_name}
+        hits = [tc_result for tc_result in self.tc_result_list
+                if tc_result.organism_name == declared_species_name or tc_result.species_taxid in taxids]
+        if hits:
+            self.declared_species_hit = max(hits, key=lambda x: x.ani)
 
-    def to_tsv(self):
-        best_hit_result = [self.best_hit.organism_name, self.best_hit.ani, self.best_hit.status]
+    def to_list(self):
+        if self.best_hit:
+            best_hit_result = [self.best_hit.organism_name, self.best_hit.ani, self.best_hit.status]
+        else:
+            best_hit_result = ["-", "-", "-"]
         if self.declared_species_hit:
             if self.best_hit.accession == self.declared_species_hit.accession:
                 declared_species_result = ["=", "=", "="]
@@ -307,12 +489,15 @@ class DQCResult_MSS:  # For MSS validation
                 declared_species_result = [self.declared_species_hit.organism_name, self.declared_species_hit.ani, self.declared_species_hit.status]
         else:
             declared_species_result = ["-", "-", "-"]
-        ret = [self.query, self.source.organism, self.source.strain,
-               self.status, ",".join(self.comments)] +\
-              best_hit_result + declared_species_result +\
-              [self.cc_result.completeness, self.cc_result.contamination]
+        if self.cc_result:
+            cc_result = [self.cc_result.completeness, self.cc_result.contamination]
+        else:
+            cc_result = ["-", "-"]
+        return [self.query, self.source.organism, self.source.strain,
+                self.status, ",".join(self.comments)] + best_hit_result + declared_species_result + cc_result
 
-        return "\t".join(map(str, ret))
+    def to_tsv(self):
+        return "\t".join(map(str, self.to_list()))
         
     def classify(self):
         # best_hitは一番スコアが高かったもの
@@ -365,6 +550,123 @@ class DQCResult_MSS:  # For MSS validation
                 self.status = "WARNING"
                 self.comments.append("possible new species")
 
+MSS_STATE_FILE = "mss_validation_state.json"  # placed in out_dir. See MSSValidationState
+MSS_STATE_VERSION = 1
+
+def _stat_key(file_path: str) -> Optional[List[int]]:
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+class MSSValidationState:
+    """
+    Source features of ANN files and validation results of each submission, with the mtime and size of
+    the ANN file and dqc_result.json. A submission is validated again only if either of them has changed,
+    and its ANN file is parsed again only if the ANN file has changed.
+    Results are also validated again when the reference directory used to resolve taxids is changed.
+    """
+    def __init__(self, state_file: str, ref_dir: Optional[str] = None):
+        self.state_file = state_file
+        self.ref_dir = ref_dir
+        self.entries = {}  # absolute path of FASTA: {"ann": stat, "dqc": stat, "source": dict, "row": list}
+        self.updated = False
+        if os.path.exists(state_file):
+            try:
+                state = read_json(state_file)
+            except ValueError:
+                logger.warning(f"Validation state is broken and will be recreated. [{state_file}]")
+                return
+            if state.get("version") == MSS_STATE_VERSION:
+                self.entries = state["files"]
+                if state.get("ref_dir") != ref_dir:
+                    for entry in self.entries.values():
+                        entry["row"] = None
+
+    def get_row(self, fasta_file: str, ann_stat, dqc_stat) -> Optional[list]:
+        entry = self.entries.get(os.path.abspath(fasta_file))
+        if entry and entry["ann"] == ann_stat and entry["dqc"] == dqc_stat:
+            return entry["row"]
+        return None
+
+    def get_source(self, fasta_file: str, ann_stat) -> Optional[SourceData]:
+        entry = self.entries.get(os.path.abspath(fasta_file))
+        if entry and entry["ann"] == ann_stat:
+            return SourceData(**entry["source"])
+        return None
+
+    def put(self, fasta_file: str, ann_stat, dqc_stat, source: SourceData, row: list):
+        self.entries[os.path.abspath(fasta_file)] = {"ann": ann_stat, "dqc": dqc_stat, "source": asdict(source), "row": row}
+        self.updated = True
+
+    def save(self):
+        if not self.updated:
+            return
+        tmp_file = f"{self.state_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"version": MSS_STATE_VERSION, "ref_dir": self.ref_dir, "files": self.entries}, f)
+        os.replace(tmp_file, self.state_file)
+
+def _load_mss_result(task) -> Optional[DQCResult_MSS]:
+    """
+    Runs in a worker process: parsing of the ANN file (unless cached) and dqc_result.json
+    """
+    fasta_file, out_dir, source = task
+    try:
+        return DQCResult_MSS.load(fasta_file, out_dir, source=source)
+    except FileNotFoundError as e:
+        logger.warning(f"File not found: {e.filename}. Skipping {fasta_file}...")
+    except (ValueError, IndexError) as e:
+        logger.warning(f"Failed to parse the result of {fasta_file}: {e}. Skipping...")
+    return None
+
+def iter_mss_validation(fasta_files: List[str], out_dir: str, num_workers: int = 1,
+                        species_index: Optional[SpeciesTaxidIndex] = None, use_state: bool = True) -> Iterator[list]:
+    """
+    Yield validation results (rows of the report) in the order of fasta_files. Results are loaded in parallel by
+    num_workers processes. With use_state=True, unchanged submissions are not validated again (see MSSValidationState).
+    """
+    if species_index is None:
+        species_index = SpeciesTaxidIndex()
+    state = MSSValidationState(os.path.join(out_dir, MSS_STATE_FILE), species_index.ref_dir) if use_state else None
+    tasks = []  # (fasta_file, ann_stat, dqc_stat, row if unchanged)
+    for fasta_file in fasta_files:
+        ann_file, dqc_result_file = get_associated_files(fasta_file, out_dir)
+        ann_stat, dqc_stat = _stat_key(ann_file), _stat_key(dqc_result_file)
+        row = state.get_row(fasta_file, ann_stat, dqc_stat) if state else None
+        tasks.append((fasta_file, ann_stat, dqc_stat, row))
+    to_validate = [(fasta_file, out_dir, state.get_source(fasta_file, ann_stat) if state else None)
+                   for fasta_file, ann_stat, _, row in tasks if row is None]
+    if state is not None:
+        logger.info(f"Validating {len(to_validate)} submissions ({len(tasks) - len(to_validate)} unchanged)")
+    executor = None
+    if num_workers > 1 and len(to_validate) > 1:
+        executor = ProcessPoolExecutor(max_workers=num_workers)
+        chunksize = max(1, min(64, len(to_validate) // (num_workers * 4)))
+        loaded = executor.map(_load_mss_result, to_validate, chunksize=chunksize)
+    else:
+        loaded = map(_load_mss_result, to_validate)
+    try:
+        for fasta_file, ann_stat, dqc_stat, row in tasks:
+            if row is None:
+                dqc_result = next(loaded)
+                if dqc_result is None:
+                    continue
+                # declared names are resolved here rather than in the workers, so that each name is resolved once
+                dqc_result.set_best_hit()
+                dqc_result.set_declared_species_hit(species_index)
+                dqc_result.classify()
+                row = dqc_result.to_list()
+                if state is not None:
+                    state.put(fasta_file, ann_stat, dqc_stat, dqc_result.source, row)
+            yield row
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+        if state is not None:
+            state.save()
+
 # L = ["hoge.ann","hoge.annot","hoge.ann.tsv","hoge.annot.tsv"]
 # for a in L:
 #     print(remove_suffix(a))
@@ -398,20 +700,30 @@ if __name__ == '__main__':
         parser = argparse.ArgumentParser()
         parser.add_argument("input_dir", type=str)
         parser.add_argument("--output_dir", "-O", type=str)
+        parser.add_argument("--thread", "-t", type=int, default=1, help="Number of worker processes")
+        parser.add_argument("--ref_dir", "-r", type=str, default=None, help="DQC reference directory to resolve declared species names into taxids (optional)")
+        parser.add_argument("--rebuild", action="store_true", help="Validate all the submissions again, ignoring the previous state")
         return parser.parse_args()
     args = parse_arg()
     input_dir = args.input_dir
     out_dir = args.output_dir
 
-    fasta_files = get_fasta_files(input_dir, fasta_ext="fa,fasta")
+    fasta_files = sorted(get_fasta_files(input_dir, fasta_ext="fa,fasta"))
     # print(fasta_files)
 
-    for fasta_file in fasta_files:
-        dqc_result = DQCResult_MSS.load(fasta_file, out_dir)
-        dqc_result.set_best_hit()
-        dqc_result.set_declared_species_hit()
-        dqc_result.classify()
-        print(dqc_result.to_tsv())
+    import sys
+    if args.ref_dir:
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # for dqc package
+        from dqc.config import config
+        config.DQC_REFERENCE_DIR = args.ref_dir
+        config.ADMIN = True  # do not write application.log into OUT_DIR
+    try:
+        species_index = SpeciesTaxidIndex(args.ref_dir)
+    except FileNotFoundError as e:
+        sys.stderr.write(f"error: {e} Check --ref_dir.\n")
+        sys.exit(1)
+    for row in iter_mss_validation(fasta_files, out_dir, num_workers=args.thread, species_index=species_index, use_state=not args.rebuild):
+        print("\t".join(map(str, row)))
 
     # print(DQCResult.load(fasta_file, out_dir))
 